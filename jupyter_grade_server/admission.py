@@ -0,0 +1,277 @@
+"""
+Admission of grading jobs by the memory and CPU they are expected to use.
+"""
+import collections
+import math
+import os
+import threading
+import time
+
+from statsd import statsd
+
+from .autoscaler import host_headroom
+
+Budget = collections.namedtuple('Budget', 'rss_mb cpus')
+
+DEFAULT_BUDGET = Budget(1024, 1)
+
+
+def total_memory_mb():
+    """
+    Return the host's memory in MB, or None if it cannot be read.
+    """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def process_usage(pid):
+    """
+    Return the peak resident memory in MB and the CPU seconds used by process
+    `pid` and its reaped children, or None if they cannot be read.
+    """
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            peak_kb = next(int(line.split()[1]) for line in status if line.startswith('VmHWM:'))
+        with open(f'/proc/{pid}/stat') as stat:
+            # The fields after the command name, from the process state on
+            fields = stat.read().rsplit(')', 1)[1].split()
+        ticks = sum(int(field) for field in fields[11:15])
+    except (OSError, StopIteration, ValueError, IndexError):
+        return None
+    return peak_kb / 1024, ticks / os.sysconf('SC_CLK_TCK')
+
+
+class Usage:
+    """
+    Measure the memory and CPU used by the job graded in the current thread,
+    from the kernels it runs.
+
+    Kernels are measured when passed to `sample` while the job is graded:
+    the memory is the largest peak of those kernels, the CPU time what they
+    used in between plus that of the grading thread.  Without a kernel
+    measured, `result` is None and nothing is learned from the job.
+    """
+    _current = threading.local()
+
+    def __enter__(self):
+        self.rss_mb = 0
+        # pid -> [CPU seconds when first sampled, when last sampled]
+        self.kernels = {}
+        self.thread_cpu = time.thread_time()
+        self.start = time.monotonic()
+        self._outer = getattr(self._current, 'usage', None)
+        self._current.usage = self
+        return self
+
+    def __exit__(self, *exc):
+        self._current.usage = self._outer
+        if not self.kernels:
+            self.result = None
+            return
+        kernel_cpu = sum(last - first for first, last in self.kernels.values())
+        self.result = {
+            'rss_mb': self.rss_mb,
+            'cpu_seconds': time.thread_time() - self.thread_cpu + kernel_cpu,
+            'seconds': time.monotonic() - self.start,
+        }
+
+    @classmethod
+    def sample(cls, pid):
+        """
+        Measure the kernel process `pid` for the job graded in the current
+        thread, if any.
+        """
+        usage = getattr(cls._current, 'usage', None)
+        if usage is None or pid is None:
+            return
+        measured = process_usage(pid)
+        if measured is None:
+            return
+        peak_mb, cpu_seconds = measured
+        usage.rss_mb = max(usage.rss_mb, peak_mb)
+        usage.kernels.setdefault(pid, [cpu_seconds, cpu_seconds])[1] = cpu_seconds
+
+
+class Ticket:
+    """
+    The memory and CPU reserved for one job of a queue, until `release`.
+
+    In a process forked to grade the job, a ticket only keeps its problem and
+    usage for the parent to pass on, without touching the controller.
+    """
+    def __init__(self, controller, queue_name, budget):
+        self.controller = controller
+        self.queue_name = queue_name
+        self.budget = budget
+        self.problem = None
+        # What the job used, once graded
+        self.used = None
+        self._pid = os.getpid()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.queue_name}, {self.problem}, {self.budget})'
+
+    def assign(self, problem):
+        """
+        Set the job's problem once known, reserving that problem's budget.
+        """
+        self.problem = problem
+        if self._pid == os.getpid():
+            self.controller._assign(self, problem)
+
+    def record(self, rss_mb, cpu_seconds, seconds):
+        """
+        Learn the budget of the job's problem from what this job used.
+        """
+        self.used = {'rss_mb': rss_mb, 'cpu_seconds': cpu_seconds, 'seconds': seconds}
+        if self._pid == os.getpid():
+            self.controller.record(self.queue_name, self.problem, rss_mb, cpu_seconds, seconds)
+
+    def release(self):
+        self.controller._release(self)
+
+
+class AdmissionController:
+    """
+    Admit grading jobs only while the host can afford their budgets.
+
+    A job's budget is its problem's configured budget, else learned from the
+    resources earlier jobs of the problem used, else its queue's default.
+    Jobs are admitted before their submission is pulled, when the problem is
+    not known yet, so the largest budget known for the queue is reserved
+    until `Ticket.assign` names the problem.
+
+    One job is always admitted when none are running, so that a budget larger
+    than the host cannot stall a queue.
+
+    memory_mb = memory to hand out to jobs (default: the host's memory)
+    cpus = CPUs to hand out to jobs (default: the host's CPU count)
+    reserve_mb = memory that must stay available on the host
+    margin = factor applied to learned budgets
+    """
+    def __init__(self, memory_mb=None, cpus=None, reserve_mb=512, margin=1.25):
+        self.memory_mb = memory_mb or total_memory_mb() or math.inf
+        self.cpus = cpus or os.cpu_count() or 1
+        self.reserve_mb = reserve_mb
+        self.margin = margin
+        # Budgets by queue, and by (queue, problem) as configured or learned
+        self.defaults = {}
+        self.configured = {}
+        self.usage = {}
+        self.tickets = set()
+        self._cond = threading.Condition()
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({len(self.tickets)} jobs, '
+                f'{self.reserved().rss_mb:.0f}/{self.memory_mb:.0f} MB)')
+
+    def configure(self, queue_name, default=None, problems=None):
+        """
+        Set a queue's default budget and the budgets of its problems, each
+        a Budget or a {"RSS_MB": ..., "CPUS": ...} dict.
+        """
+        with self._cond:
+            self.defaults[queue_name] = self._budget(default, DEFAULT_BUDGET)
+            for key in [key for key in self.configured if key[0] == queue_name]:
+                del self.configured[key]
+            for problem, budget in (problems or {}).items():
+                self.configured[queue_name, problem] = self._budget(budget, DEFAULT_BUDGET)
+            self._cond.notify_all()
+
+    @staticmethod
+    def _budget(budget, fallback):
+        if budget is None:
+            return fallback
+        if isinstance(budget, dict):
+            return Budget(budget.get('RSS_MB', fallback.rss_mb), budget.get('CPUS', fallback.cpus))
+        return Budget(*budget)
+
+    def budget(self, queue_name, problem=None):
+        """
+        Return the Budget of a problem, or the largest of the queue.
+        """
+        learned = {key: Budget(usage.rss_mb * self.margin, usage.cpus * self.margin)
+                   for key, usage in self.usage.items() if key[0] == queue_name}
+        budgets = {**learned, **{key: budget for key, budget in self.configured.items()
+                                 if key[0] == queue_name}}
+        default = self.defaults.get(queue_name, DEFAULT_BUDGET)
+        if problem is not None:
+            return budgets.get((queue_name, problem), default)
+        if not budgets:
+            return default
+        return Budget(max(b.rss_mb for b in budgets.values()),
+                      max(b.cpus for b in budgets.values()))
+
+    def reserved(self):
+        return Budget(sum(t.budget.rss_mb for t in self.tickets),
+                      sum(t.budget.cpus for t in self.tickets))
+
+    def _fits(self, budget):
+        if not self.tickets:
+            return True
+        reserved = self.reserved()
+        if reserved.rss_mb + budget.rss_mb > self.memory_mb:
+            return False
+        if reserved.cpus + budget.cpus > self.cpus:
+            return False
+        _, available = host_headroom()
+        return available is None or available - self.reserve_mb >= budget.rss_mb
+
+    def _report(self):
+        reserved = self.reserved()
+        statsd.gauge('xqueuewatcher.admission.jobs', len(self.tickets))
+        statsd.gauge('xqueuewatcher.admission.reserved-mb', reserved.rss_mb)
+        statsd.gauge('xqueuewatcher.admission.reserved-cpus', reserved.cpus)
+
+    def acquire(self, queue_name, running=lambda: True, poll=1):
+        """
+        Wait until a job of the queue can be admitted and return its Ticket,
+        or None once `running()` is false.  Host memory is checked again
+        every `poll` seconds while waiting.
+        """
+        with self._cond:
+            budget = self.budget(queue_name)
+            if not self._fits(budget):
+                statsd.increment('xqueuewatcher.admission.waited')
+                while not self._fits(budget):
+                    if not running():
+                        return None
+                    self._cond.wait(poll)
+                    budget = self.budget(queue_name)
+            ticket = Ticket(self, queue_name, budget)
+            self.tickets.add(ticket)
+            self._report()
+        return ticket
+
+    def _assign(self, ticket, problem):
+        with self._cond:
+            ticket.budget = self.budget(ticket.queue_name, problem)
+            self._report()
+            self._cond.notify_all()
+
+    def _release(self, ticket):
+        with self._cond:
+            self.tickets.discard(ticket)
+            self._report()
+            self._cond.notify_all()
+
+    def record(self, queue_name, problem, rss_mb, cpu_seconds, seconds):
+        """
+        Learn a problem's budget from the resources one of its jobs used.
+        """
+        if problem is None:
+            return
+        cpus = cpu_seconds / seconds if seconds > 0 else 1
+        with self._cond:
+            usage = self.usage.get((queue_name, problem))
+            if usage is not None:
+                rss_mb = 0.7 * usage.rss_mb + 0.3 * rss_mb
+                cpus = 0.7 * usage.cpus + 0.3 * cpus
+            self.usage[queue_name, problem] = Budget(rss_mb, cpus)
+            self._cond.notify_all()
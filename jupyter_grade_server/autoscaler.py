@@ -0,0 +1,89 @@
+"""
+Scaling the number of XQueue connections of a queue to its backlog.
+"""
+import math
+import os
+import time
+
+
+def host_headroom():
+    """
+    Return (1 minute load average per CPU, available memory in MB), with
+    None for what cannot be read on this platform.
+    """
+    try:
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        load = None
+    available = None
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) / 1024
+                    break
+    except OSError:
+        pass
+    return load, available
+
+
+class Autoscaler:
+    """
+    Decide how many connections a queue should have, between `minimum` and
+    `maximum`.
+
+    Connections are added as soon as the queue's backlog would take longer
+    than `target_latency` seconds to grade.  They are removed one at a time,
+    only after `cooldown` seconds without a change and only while one fewer
+    connection would still be at most half busy, so that the count does not
+    flap around the threshold.
+
+    target_latency = seconds in which the waiting submissions should be graded
+    cooldown = seconds after a change before connections are removed
+    max_load = do not add connections while the load average per CPU is higher
+    min_free_mb = do not add connections while less memory is available, and
+                  remove one per cooldown
+    """
+    def __init__(self, minimum, maximum, target_latency=60, cooldown=120,
+                 max_load=1.5, min_free_mb=512):
+        self.minimum = max(0, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+        self.max_load = max_load
+        self.min_free_mb = min_free_mb
+        # Last known seconds to grade a submission, kept while no client runs
+        self.grade_time = None
+        self.changed = -math.inf
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.minimum}-{self.maximum})'
+
+    def clamp(self, count):
+        return min(self.maximum, max(self.minimum, count))
+
+    def desired(self, current, queue_length, load=None, free_mb=None, now=None):
+        """
+        Return the number of connections to run, given the `current` number
+        and the number of submissions waiting in the queue.
+        """
+        now = time.monotonic() if now is None else now
+        # Without a measurement, plan for one connection per waiting submission
+        grade_time = self.grade_time or self.target_latency
+        backlog = queue_length * grade_time
+        want = self.clamp(math.ceil(backlog / self.target_latency))
+        short_of_memory = self.min_free_mb and free_mb is not None and free_mb < self.min_free_mb
+        overloaded = self.max_load and load is not None and load > self.max_load
+        cooled = now - self.changed >= self.cooldown
+
+        target = current
+        if short_of_memory and cooled and current > self.minimum:
+            target = current - 1
+        elif want > current and not (short_of_memory or overloaded):
+            target = want
+        elif cooled and current > self.minimum and backlog <= (current - 1) * self.target_latency / 2:
+            target = current - 1
+        target = self.clamp(target)
+        if target != current:
+            self.changed = now
+        return target
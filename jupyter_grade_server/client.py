@@ -1,15 +1,99 @@
+import asyncio
+import collections
+import concurrent.futures
 import time
-import json
 import logging
 import requests
 from requests.auth import HTTPBasicAuth
 import threading
 import multiprocessing
+import os
+import random
+import signal
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+from statsd import statsd
+
+from . import metrics
+from .poster import ResultPoster, retry_delay
 from .settings import MANAGER_CONFIG_DEFAULTS
+from .submission import Submission, loads
 
 log = logging.getLogger(__name__)
 
 
+class SharedSession:
+    """
+    A requests session, with its keep-alive connection pool and XQueue login
+    cookie, shared by the clients of one XQueue server and user.
+
+    Every successful login increments `generation`, so a client that was
+    redirected to the login page can tell whether another client has logged
+    in again since it sent its request.
+
+    XQueueClientAsync clients share an aiohttp session instead, with its own
+    login cookie, `aio_login_lock` and `aio_generation`, used only on the
+    shared event loop.
+    """
+    def __init__(self):
+        self.session = requests.session()
+        self.pool_size = 0
+        self.login_lock = threading.Lock()
+        self.generation = 0
+        self.refs = 0
+        self._lock = threading.Lock()
+        self.aio_session = None
+        self.aio_login_lock = None
+        self.aio_generation = 0
+        self.aio_refs = 0
+
+    def acquire(self, connections=1):
+        """
+        Register a client using up to `connections` connections at a time.
+        """
+        with self._lock:
+            self.refs += 1
+            self.pool_size += connections
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+        return self
+
+    def release(self):
+        """
+        Unregister a client, closing the session after the last one.
+        """
+        with self._lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+        self.session.close()
+
+    async def aio_acquire(self):
+        """
+        Register an XQueueClientAsync and return the aiohttp session.
+        """
+        if self.aio_session is None:
+            self.aio_session = aiohttp.ClientSession()
+            self.aio_login_lock = asyncio.Lock()
+            self.aio_generation = 0
+        self.aio_refs += 1
+        return self.aio_session
+
+    async def aio_release(self):
+        """
+        Unregister an XQueueClientAsync, closing the aiohttp session after
+        the last one.
+        """
+        self.aio_refs -= 1
+        if self.aio_refs > 0:
+            return
+        session, self.aio_session = self.aio_session, None
+        await session.close()
+
+
 class XQueueClient:
     def __init__(self,
                  queue_name,
@@ -18,17 +102,66 @@ class XQueueClient:
                  http_basic_auth=MANAGER_CONFIG_DEFAULTS['HTTP_BASIC_AUTH'],
                  requests_timeout=MANAGER_CONFIG_DEFAULTS['REQUESTS_TIMEOUT'],
                  poll_interval=MANAGER_CONFIG_DEFAULTS['POLL_INTERVAL'],
+                 max_poll_interval=MANAGER_CONFIG_DEFAULTS['MAX_POLL_INTERVAL'],
                  login_poll_interval=MANAGER_CONFIG_DEFAULTS['LOGIN_POLL_INTERVAL'],
-                 follow_client_redirects=MANAGER_CONFIG_DEFAULTS['FOLLOW_CLIENT_REDIRECTS']):
+                 follow_client_redirects=MANAGER_CONFIG_DEFAULTS['FOLLOW_CLIENT_REDIRECTS'],
+                 workers=1,
+                 prefetch=0,
+                 pull_timeout=MANAGER_CONFIG_DEFAULTS['PULL_TIMEOUT'],
+                 post_threads=0,
+                 post_retries=10,
+                 outbox=None,
+                 session=None,
+                 concurrent_handlers=False,
+                 scheduler=None,
+                 admission=None):
+        """
+        poll_interval = seconds between polls of an empty queue at first
+        max_poll_interval = upper bound for the poll interval, which doubles
+                            with every consecutive empty poll
+        workers = number of threads grading submissions in pipeline mode
+        prefetch = maximum number of pulled submissions waiting for a worker;
+                   0 fetches, grades and replies one at a time in one thread
+        pull_timeout = seconds after which XQueue hands a pulled submission
+                       out again, which limits how much work is prefetched
+        post_threads = number of threads posting results in the background,
+                       retrying failed posts; 0 posts inline, without retries
+        post_retries = attempts to post a result before giving up on it
+        outbox = Outbox journaling replies until they are posted
+        session = SharedSession to share with other clients of the same
+                  server and user
+        concurrent_handlers = run the handlers of a submission in parallel
+                              and post each result as soon as it is ready
+        scheduler = FairScheduler shared with the clients of other queues,
+                    from which a grading slot is taken for every submission
+        admission = AdmissionController that must admit every submission
+                    before it is pulled
+        """
         super().__init__()
-        self.session = requests.session()
+        # Connections used at once: polling, grading workers and posting
+        self.shared_session = (session or SharedSession()).acquire(
+            1 + max(1, workers) + post_threads)
+        self.session = self.shared_session.session
         self.xqueue_server = xqueue_server
         self.queue_name = queue_name
         self.handlers = []
+        self.handler_timeouts = {}
+        self._handlers_closed = False
+        self.concurrent_handlers = concurrent_handlers
+        # Runs the handlers of a submission concurrently, see run
+        self._handler_executor = None
+        self.scheduler = scheduler
+        self.admission = admission
         self.daemon = True
         self.username, self.password = xqueue_auth
         self.requests_timeout = requests_timeout
         self.poll_interval = poll_interval
+        self.max_poll_interval = max(poll_interval, max_poll_interval or 0)
+        self._empty_polls = 0
+        # Whether the last process_one pulled a submission, as its result
+        # is whether the submission was graded and posted
+        self._got_work = False
+        self._stopping = threading.Event()
         self.login_poll_interval = login_poll_interval
         self.follow_client_redirects = follow_client_redirects
 
@@ -37,6 +170,20 @@ class XQueueClient:
         else:
             self.http_basic_auth = None
 
+        self.workers = max(1, workers)
+        self.prefetch = prefetch
+        self.pull_timeout = pull_timeout
+        # Pipeline state: pulled (fetch time, content) and their grading time
+        self._buffer = collections.deque()
+        self._outstanding = 0
+        self._pipeline = threading.Condition()
+        self.grade_time = None
+
+        self.outbox = outbox
+        self.post_threads = post_threads
+        self.post_retries = post_retries
+        self.poster = None
+
         self.running = True
         self.processing = False
 
@@ -50,7 +197,7 @@ class XQueueClient:
             return False, error_message
 
         try:
-            xreply = response.json()
+            xreply = loads(response.content)
         except ValueError:
             error_message = "Could not parse xreply."
             log.error(error_message)
@@ -74,6 +221,7 @@ class XQueueClient:
         url = self.xqueue_server + uri
         r = None
         while not r:
+            generation = self.shared_session.generation
             try:
                 r = self.session.request(
                     method,
@@ -92,7 +240,7 @@ class XQueueClient:
             # 301 if the original URL did not have a trailing / and
             # APPEND_SLASH is true in XQueue deployment, which is the default.
             elif r.status_code in (301, 302):
-                if self._login():
+                if self._login(generation):
                     r = None
                 else:
                     return (False, "Could not log in")
@@ -102,7 +250,21 @@ class XQueueClient:
                 log.error(message)
                 return (False, message)
 
-    def _login(self):
+    def _login(self, generation=None):
+        """
+        Log in, unless another client sharing the session has logged in
+        since it was at `generation`.
+        """
+        shared = self.shared_session
+        with shared.login_lock:
+            if generation is not None and shared.generation > generation:
+                return True
+            if not self._post_login():
+                return False
+            shared.generation += 1
+            return True
+
+    def _post_login(self):
         if self.username is None:
             return True
         url = self.xqueue_server + '/xqueue/login/'
@@ -123,60 +285,452 @@ class XQueueClient:
         Close connection and shutdown
         """
         self.running = False
-        self.session.close()
+        if self._signal_stop():
+            self.shared_session.release()
+
+    def _signal_stop(self):
+        """
+        Wake up the client's waits, returning False if it was stopped already.
+        """
+        with self._pipeline:
+            stopped = self._stopping.is_set()
+            self._stopping.set()
+            self._pipeline.notify_all()
+        return not stopped
 
-    def add_handler(self, handler):
+    def add_handler(self, handler, timeout=None):
         """
         Add handler function to be called for every item in the queue
+
+        With concurrent_handlers, a handler that has not returned
+        `timeout` seconds after it started running is no longer waited for
+        and its result is dropped.
         """
         self.handlers.append(handler)
+        self.handler_timeouts[id(handler)] = timeout
 
     def remove_handler(self, handler):
         """
         Remove handler function
         """
         self.handlers.remove(handler)
+        self.handler_timeouts.pop(id(handler), None)
+
+    def close_handlers(self):
+        """
+        Call `close()` on the handlers that have it, such as the worker pools
+        and kernels of a Grader, once the client has stopped.  Only the first
+        call closes them.
+        """
+        with self._pipeline:
+            closed, self._handlers_closed = self._handlers_closed, True
+        if closed:
+            return
+        for handler in self.handlers:
+            close = getattr(handler, 'close', None)
+            if close is None:
+                continue
+            try:
+                close()
+            except Exception:
+                log.exception('%r: could not close %r', self, handler)
+
+    def _journal(self, reply):
+        if self.outbox is None:
+            return None
+        try:
+            return self.outbox.add(self.queue_name, reply)
+        except Exception:
+            log.exception('could not journal a reply')
+            return None
+
+    def _unjournal(self, entry):
+        if self.outbox is None or entry is None:
+            return
+        try:
+            self.outbox.remove(entry)
+        except Exception:
+            log.exception('could not remove a posted reply from the outbox')
+
+    def _post_result(self, item):
+        entry, reply = item
+        status, message = self._request('post', '/xqueue/put_result/', data=reply, verify=False)
+        if status:
+            self._unjournal(entry)
+        return status, message
+
+    def _send_result(self, reply, entry=None):
+        if self.poster is not None:
+            # Go back to pulling work while the result is posted
+            self.poster.submit((entry, reply))
+            return True
+        status, message = self._post_result((entry, reply))
+        if not status:
+            log.error('Failure for %r -> %r', reply, message)
+        return status
+
+    def _flush_outbox(self):
+        """
+        Post the replies of this queue left in the outbox by an earlier run.
+        """
+        if self.outbox is None:
+            return
+        stale = self.outbox.take_stale(self.queue_name)
+        if stale:
+            log.info('%r: posting %d replies left from an earlier run', self, len(stale))
+        for entry, reply in stale:
+            self._send_result(reply, entry)
+
+    def _reply(self, content, result):
+        reply = content.reply(result)
+        return self._send_result(reply, self._journal(reply))
+
+    def _record_wait(self, content):
+        if content.pulled_at is not None:
+            metrics.QUEUE_WAIT_SECONDS.observe(time.monotonic() - content.pulled_at,
+                                               queue=self.queue_name)
 
     def _handle_submission(self, content):
-        content = json.loads(content)
+        content = Submission.parse(content)
+        self._record_wait(content)
+        if self._handler_executor is not None:
+            return self._handle_concurrently(content)
         success = []
         for handler in self.handlers:
             result = handler(content)
             if result:
-                reply = {'xqueue_body': json.dumps(result),
-                         'xqueue_header': content['xqueue_header']}
-                status, message = self._request('post', '/xqueue/put_result/', data=reply, verify=False)
-                if not status:
-                    log.error('Failure for %r -> %r', reply, message)
-                success.append(status)
+                success.append(self._reply(content, result))
         return all(success)
 
+    def _start_handler_executor(self):
+        if self.concurrent_handlers and len(self.handlers) > 1:
+            self._handler_executor = concurrent.futures.ThreadPoolExecutor(
+                len(self.handlers) * self.workers,
+                thread_name_prefix=f'{self.queue_name}-handler')
+
+    def _handle_concurrently(self, content):
+        # When each handler started running: it may wait for a thread that
+        # a handler of an earlier submission still holds after timing out
+        started = {}
+
+        def call(handler):
+            started[id(handler)] = time.monotonic()
+            return handler(content)
+
+        def deadline(future):
+            """
+            The time the handler of `future` times out at, None if it has no
+            timeout, or False until it starts running.
+            """
+            handler = handlers[future]
+            timeout = self.handler_timeouts.get(id(handler))
+            if timeout is None:
+                return None
+            if id(handler) not in started:
+                return False
+            return started[id(handler)] + timeout
+
+        handlers = {self._handler_executor.submit(call, handler): handler
+                    for handler in self.handlers}
+        success = []
+        pending = set(handlers)
+        while pending:
+            deadlines = [deadline(future) for future in pending]
+            due = [d for d in deadlines if d]
+            wait = max(0, min(due) - time.monotonic()) if due else None
+            if False in deadlines:
+                # Look again soon for the deadlines of handlers yet to start
+                wait = self.poll_interval if wait is None else min(wait, self.poll_interval)
+            done, pending = concurrent.futures.wait(
+                pending, timeout=wait, return_when=concurrent.futures.FIRST_COMPLETED)
+            # Post each result as soon as its handler returns
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    log.exception(e)
+                    success.append(False)
+                    continue
+                if result:
+                    success.append(self._reply(content, result))
+            now = time.monotonic()
+            for future in list(pending):
+                if deadline(future) and deadline(future) <= now:
+                    # The handler keeps running, but is no longer waited for
+                    log.error('%r: handler %r timed out', self, handlers[future])
+                    pending.remove(future)
+                    success.append(False)
+        return all(success)
+
+    def _admit(self):
+        """
+        Wait until the admission controller lets this client pull another
+        submission.  Returns the job's ticket, None without admission
+        control, or False if the client was shut down while waiting.
+        """
+        if self.admission is None:
+            return None
+        ticket = self.admission.acquire(self.queue_name, lambda: self.running)
+        return False if ticket is None else ticket
+
+    def _take_slot(self):
+        """
+        Wait for a grading slot of the scheduler before pulling a submission,
+        so that a pulled submission never waits for one past XQueue's pull
+        timeout.  Returns True once held, None without a scheduler, or False
+        if the client was shut down while waiting.
+        """
+        if self.scheduler is None:
+            return None
+        return self.scheduler.acquire(self.queue_name, lambda: self.running, self.poll_interval)
+
+    def _release_slot(self, slot):
+        if slot:
+            self.scheduler.release(self.queue_name)
+
     def process_one(self):
+        self._got_work = False
+        ticket = self._admit()
+        if ticket is False:
+            return True
+        slot = self._take_slot()
+        if slot is False:
+            if ticket is not None:
+                ticket.release()
+            return True
         try:
             self.processing = False
             get_params = {'queue_name': self.queue_name}
             success, content = self._request('get', '/xqueue/get_submission/', params=get_params)
             if success:
+                self._got_work = True
                 self.processing = True
+                self._jobs_changed()
+                content = Submission.parse(content)
+                content.admission = ticket
+                content.pulled_at = time.monotonic()
+                start = time.monotonic()
                 success = self._handle_submission(content)
+                self._record_grade(time.monotonic() - start, success)
             return success
         except requests.exceptions.Timeout:
             return True
         except Exception as e:
             log.exception(e)
             return True
+        finally:
+            if self.processing:
+                self.processing = False
+                self._jobs_changed()
+            self._release_slot(slot)
+            if ticket is not None:
+                ticket.release()
+
+    def _poll_delay(self, got_work):
+        """
+        Return how long to wait before the next poll: no time while there is
+        work, then exponentially longer, jittered intervals.
+        """
+        if got_work:
+            self._empty_polls = 0
+            return 0
+        interval = min(self.max_poll_interval, self.poll_interval * 2 ** min(self._empty_polls, 32))
+        self._empty_polls += 1
+        # Jitter keeps clients from polling in lockstep
+        return random.uniform(interval / 2, interval)
+
+    def _record_grade(self, elapsed, success):
+        metrics.GRADED.inc(queue=self.queue_name)
+        if not success:
+            metrics.FAILED.inc(queue=self.queue_name)
+        metrics.GRADING_SECONDS.observe(elapsed, queue=self.queue_name)
+        if self.grade_time is None:
+            self.grade_time = elapsed
+        else:
+            self.grade_time = 0.8 * self.grade_time + 0.2 * elapsed
+
+    def get_queuelen(self):
+        """
+        Return the number of submissions waiting in the queue, or None if
+        XQueue could not be asked.
+        """
+        try:
+            success, content = self._request('get', '/xqueue/get_queuelen/',
+                                             params={'queue_name': self.queue_name})
+        except requests.exceptions.RequestException as e:
+            log.error('%r: could not get the queue length: %r', self, e)
+            return None
+        if not success:
+            return None
+        try:
+            return int(content)
+        except (TypeError, ValueError):
+            return None
+
+    @property
+    def pipelined(self):
+        return bool(self.prefetch or self.workers > 1)
+
+    def _jobs(self):
+        with self._pipeline:
+            return self._outstanding if self.pipelined else int(self.processing)
+
+    def _jobs_changed(self):
+        """
+        Called whenever the number of submissions being graded changed.
+        """
+
+    def _backlog_changed(self, backlog):
+        """
+        Called whenever the number of replies waiting to be posted changed.
+        """
+
+    def in_flight(self):
+        """
+        Number of submissions pulled but not yet graded and posted.
+        """
+        jobs = self._jobs()
+        if self.poster is not None:
+            jobs += self.poster.backlog
+        return jobs
+
+    def _buffer_limit(self):
+        """
+        Number of submissions that may wait for a worker, so that the last of
+        them is still expected to be finished within the pull timeout.
+        """
+        if not self.grade_time:
+            return self.prefetch
+        # A waiting submission starts after the running ones and then runs itself
+        rounds = self.pull_timeout / self.grade_time - 2
+        return max(0, min(self.prefetch, int(rounds * self.workers)))
+
+    def _fetch(self):
+        """
+        Pull one submission into the buffer, returning False if there was none.
+        """
+        ticket = self._admit()
+        if ticket is False:
+            return False
+        slot = self._take_slot()
+        if slot is False:
+            if ticket is not None:
+                ticket.release()
+            return False
+        try:
+            get_params = {'queue_name': self.queue_name}
+            success, content = self._request('get', '/xqueue/get_submission/', params=get_params)
+            if success:
+                content = Submission.parse(content)
+                content.admission = ticket
+                content.pulled_at = time.monotonic()
+        except Exception as e:
+            if not isinstance(e, requests.exceptions.Timeout):
+                log.exception(e)
+            success = False
+        if not success:
+            self._release_slot(slot)
+            if ticket is not None:
+                ticket.release()
+            return False
+        with self._pipeline:
+            self._outstanding += 1
+            self.processing = True
+            self._buffer.append((time.monotonic(), slot, content))
+            self._pipeline.notify_all()
+        self._jobs_changed()
+        return True
+
+    def _fetch_loop(self):
+        while self.running:
+            with self._pipeline:
+                # Only pull when a worker is free or the buffer has room
+                while self.running and self._outstanding >= self.workers + self._buffer_limit():
+                    self._pipeline.wait(self.poll_interval)
+            if self.running:
+                self._stopping.wait(self._poll_delay(self._fetch()))
+
+    def _grade_loop(self):
+        while True:
+            with self._pipeline:
+                while self.running and not self._buffer:
+                    self._pipeline.wait()
+                if not self._buffer:
+                    break
+                fetched, slot, content = self._buffer.popleft()
+            waited = time.monotonic() - fetched
+            if waited > self.pull_timeout:
+                log.warning('%r: submission waited %.0fs, longer than the pull timeout',
+                            self, waited)
+            start = time.monotonic()
+            success = False
+            try:
+                success = self._handle_submission(content)
+            except Exception as e:
+                log.exception(e)
+            finally:
+                self._release_slot(slot)
+                if content.admission is not None:
+                    content.admission.release()
+            elapsed = time.monotonic() - start
+            with self._pipeline:
+                self._record_grade(elapsed, success)
+                self._outstanding -= 1
+                self.processing = self._outstanding > 0
+                self._pipeline.notify_all()
+            self._jobs_changed()
+
+    def run_pipeline(self):
+        """
+        Fetch submissions into a bounded buffer while worker threads grade
+        them, until shut down.  Buffered submissions are graded before
+        returning.
+        """
+        workers = [threading.Thread(target=self._grade_loop, name=f'{self.queue_name}-worker-{i}',
+                                    daemon=True)
+                   for i in range(self.workers)]
+        for worker in workers:
+            worker.start()
+        try:
+            self._fetch_loop()
+        finally:
+            with self._pipeline:
+                self._pipeline.notify_all()
+            for worker in workers:
+                worker.join()
 
     def run(self):
         """
         Run forever, processing items from the queue
         """
-        if not self._login():
+        if self.post_threads:
+            # Started here so that the threads belong to a client process
+            self.poster = ResultPoster(self._post_result, threads=self.post_threads,
+                                       retries=self.post_retries,
+                                       name=f'{self.queue_name}-poster',
+                                       on_backlog=self._backlog_changed)
+        # Started here too, so that the threads belong to a client process
+        self._start_handler_executor()
+        try:
+            return self._run()
+        finally:
+            if self._handler_executor is not None:
+                # Handlers that timed out are not waited for
+                self._handler_executor.shutdown(wait=False, cancel_futures=True)
+            if self.poster is not None:
+                unposted = self.poster.close()
+                if unposted:
+                    log.error('%r: %d results were not posted', self, unposted)
+
+    def _run(self):
+        # Clients sharing a session that has already logged in skip the login
+        if not self._login(generation=0):
             log.error("Could not log in to Xqueue %s. Retrying every 5 seconds..." % self.queue_name)
             num_tries = 1
             while self.running:
                 num_tries += 1
                 time.sleep(self.login_poll_interval)
-                if not self._login():
+                if not self._login(generation=0):
                     log.error("Still could not log in to %s (%s:%s) tries: %d",
                         self.queue_name,
                         self.username,
@@ -184,9 +738,15 @@ class XQueueClient:
                         num_tries)
                 else:
                     break
+        self._flush_outbox()
+        # Spread out the first polls of clients started together
+        self._stopping.wait(random.uniform(0, self.poll_interval))
+        if self.pipelined:
+            self.run_pipeline()
+            return True
         while self.running:
-            if not self.process_one():
-                time.sleep(self.poll_interval)
+            self.process_one()
+            self._stopping.wait(self._poll_delay(self._got_work))
         return True
 
 
@@ -195,4 +755,394 @@ class XQueueClientThread(XQueueClient, threading.Thread):
 
 
 class XQueueClientProcess(XQueueClient, multiprocessing.Process):
-    pass
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Submissions being graded and replies waiting to be posted, written
+        # by the client process for in_flight() in the parent
+        self._shared_in_flight = multiprocessing.Array('i', 2)
+
+    def _jobs_changed(self):
+        self._shared_in_flight[0] = self._jobs()
+
+    def _backlog_changed(self, backlog):
+        self._shared_in_flight[1] = backlog
+
+    def in_flight(self):
+        """
+        Number of submissions pulled but not yet graded and posted, as last
+        reported by the client process.
+        """
+        return sum(self._shared_in_flight)
+
+    def run(self):
+        # The parent stops this process with a signal, see shutdown
+        for signum in (signal.SIGTERM, signal.SIGUSR1):
+            signal.signal(signum, lambda *args: self.shutdown())
+        try:
+            return super().run()
+        finally:
+            # The handlers' pools and kernels were started in this process
+            self.close_handlers()
+
+    def shutdown(self):
+        """
+        Ask the client process to finish its current work and exit
+        """
+        if self.pid is not None and self.pid != os.getpid() and self.is_alive():
+            os.kill(self.pid, signal.SIGTERM)
+        super().shutdown()
+
+
+class _AsyncRuntime:
+    """
+    One event loop thread shared by all XQueueClientAsync instances, plus
+    the thread pool their handlers run in.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, grading_threads=None):
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            grading_threads, thread_name_prefix='grading')
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name='xqueue-async', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def get(cls, grading_threads=None):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls(grading_threads)
+            return cls._instance
+
+
+class _AsyncResponse:
+    """
+    The parts of a requests.Response that _parse_response uses.
+    """
+    def __init__(self, url, status_code, content):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return loads(self.content)
+
+
+class XQueueClientAsync(XQueueClient):
+    """
+    An XQueue client whose polling, login and put_result requests run on an
+    asyncio event loop shared with all other XQueueClientAsync instances.
+
+    Handlers are called in a thread pool shared by those clients, so idle
+    queues cost a coroutine instead of an OS thread.  With post_threads,
+    results are posted and retried by background tasks instead of threads.
+    Requires aiohttp.
+    """
+    def __init__(self, *args, grading_threads=None, **kwargs):
+        if aiohttp is None:
+            raise ImportError('XQueueClientAsync requires aiohttp')
+        super().__init__(*args, **kwargs)
+        if self.http_basic_auth is not None:
+            self.http_basic_auth = aiohttp.BasicAuth(self.http_basic_auth.username,
+                                                     self.http_basic_auth.password)
+        self.grading_threads = grading_threads
+        self.aio_session = None
+        self._future = None
+        self._stopped = None
+        # Tasks posting results in the background, with post_threads
+        self._posts = set()
+        # Submissions pulled and not yet graded
+        self._active = 0
+
+    def _parse_aio_response(self, url, status, content):
+        return self._parse_response(_AsyncResponse(url, status, content))
+
+    async def _aio_request(self, method, uri, verify=True, **kwargs):
+        url = self.xqueue_server + uri
+        while True:
+            generation = self.shared_session.aio_generation
+            try:
+                async with self.aio_session.request(
+                        method,
+                        url,
+                        auth=self.http_basic_auth,
+                        timeout=aiohttp.ClientTimeout(total=self.requests_timeout),
+                        allow_redirects=self.follow_client_redirects,
+                        ssl=True if verify else False,
+                        **kwargs) as r:
+                    status = r.status
+                    content = await r.read()
+            except aiohttp.ClientConnectionError as e:
+                log.error('Could not connect to server at %s in timeout=%r', url, self.requests_timeout)
+                return (False, e)
+            if status == 200:
+                return self._parse_aio_response(url, status, content)
+            # See XQueueClient._request
+            elif status in (301, 302):
+                if not await self._aio_login(generation):
+                    return (False, "Could not log in")
+            else:
+                message = "Received un expected response status code, {}, calling {}.".format(
+                    status, url)
+                log.error(message)
+                return (False, message)
+
+    async def _aio_login(self, generation=None):
+        """
+        Log in, unless another client sharing the session has logged in
+        since it was at `generation`.
+        """
+        shared = self.shared_session
+        async with shared.aio_login_lock:
+            if generation is not None and shared.aio_generation > generation:
+                return True
+            if not await self._aio_post_login():
+                return False
+            shared.aio_generation += 1
+            return True
+
+    async def _aio_post_login(self):
+        if self.username is None:
+            return True
+        url = self.xqueue_server + '/xqueue/login/'
+        log.debug(f"Trying to login to {url} with user: {self.username}")
+        async with self.aio_session.post(url, auth=self.http_basic_auth, data={
+                'username': self.username,
+                'password': self.password,
+                }) as response:
+            content = await response.read()
+            if response.status != 200:
+                log.error('Log in error %s %s', response.status, content)
+                return False
+        msg = loads(content)
+        log.debug("login response from %r: %r", url, msg)
+        return msg['return_code'] == 0
+
+    async def _aio_run_handler(self, handler, content):
+        loop = asyncio.get_running_loop()
+        call = loop.run_in_executor(self.runtime.executor, handler, content)
+        try:
+            result = await asyncio.wait_for(call, self.handler_timeouts.get(id(handler)))
+        except asyncio.TimeoutError:
+            # The handler keeps running, but is no longer waited for
+            log.error('%r: handler %r timed out', self, handler)
+            return False
+        except Exception as e:
+            log.exception(e)
+            return False
+        if not result:
+            return True
+        reply = content.reply(result)
+        return await self._aio_send_result(reply, self._journal(reply))
+
+    async def _aio_take_slot(self):
+        if self.scheduler is None:
+            return None
+        return await self.scheduler.aio_acquire(self.queue_name, self._stopped)
+
+    async def _aio_handle_submission(self, content):
+        content = Submission.parse(content)
+        self._record_wait(content)
+        if self.concurrent_handlers:
+            success = await asyncio.gather(
+                *(self._aio_run_handler(handler, content) for handler in self.handlers))
+            return all(success)
+        loop = asyncio.get_running_loop()
+        success = []
+        for handler in self.handlers:
+            result = await loop.run_in_executor(self.runtime.executor, handler, content)
+            if result:
+                reply = content.reply(result)
+                success.append(await self._aio_send_result(reply, self._journal(reply)))
+        return all(success)
+
+    async def _aio_post_result(self, reply, entry=None):
+        status, message = await self._aio_request('post', '/xqueue/put_result/', data=reply, verify=False)
+        if status:
+            self._unjournal(entry)
+        return status, message
+
+    async def _aio_send_result(self, reply, entry=None):
+        if self.post_threads:
+            # Go back to pulling work while the result is posted
+            task = asyncio.create_task(self._aio_post_with_retries(reply, entry))
+            self._posts.add(task)
+            task.add_done_callback(self._posts.discard)
+            return True
+        status, message = await self._aio_post_result(reply, entry)
+        if not status:
+            log.error('Failure for %r -> %r', reply, message)
+        return status
+
+    async def _aio_post_with_retries(self, reply, entry=None):
+        """
+        Post a reply as a ResultPoster would: retrying with exponential
+        backoff up to post_retries attempts, and once the client is shut
+        down, once more without waiting.
+        """
+        attempts = 0
+        while True:
+            try:
+                status, message = await self._aio_post_result(reply, entry)
+            except Exception as e:
+                status, message = False, e
+            attempts += 1
+            if status:
+                statsd.increment('xqueuewatcher.put-result.posted')
+                return True
+            if not self.running or attempts >= self.post_retries:
+                log.error('Failure for %r -> %r', reply, message)
+                statsd.increment('xqueuewatcher.put-result.dropped')
+                return False
+            log.warning('put_result failed (attempt %d), retrying: %r', attempts, message)
+            statsd.increment('xqueuewatcher.put-result.retry')
+            await self._sleep(retry_delay(attempts))
+
+    def _jobs(self):
+        return self._active
+
+    def in_flight(self):
+        return super().in_flight() + len(self._posts)
+
+    async def _aio_flush_outbox(self):
+        if self.outbox is None:
+            return
+        stale = self.outbox.take_stale(self.queue_name)
+        if stale:
+            log.info('%r: posting %d replies left from an earlier run', self, len(stale))
+        for entry, reply in stale:
+            await self._aio_send_result(reply, entry)
+
+    async def _aio_process_one(self):
+        """
+        Pull and grade one submission, returning whether there was one.
+        """
+        ticket = None
+        if self.admission is not None:
+            # Waiting for admission blocks, so it happens off the event loop
+            ticket = await asyncio.to_thread(self._admit)
+            if ticket is False:
+                return False
+        slot = await self._aio_take_slot()
+        if slot is False:
+            if ticket is not None:
+                ticket.release()
+            return False
+        pulled = False
+        try:
+            get_params = {'queue_name': self.queue_name}
+            success, content = await self._aio_request('get', '/xqueue/get_submission/', params=get_params)
+            if success:
+                pulled = True
+                self._active += 1
+                self.processing = True
+                content = Submission.parse(content)
+                content.admission = ticket
+                content.pulled_at = time.monotonic()
+                start = time.monotonic()
+                success = await self._aio_handle_submission(content)
+                self._record_grade(time.monotonic() - start, success)
+        except asyncio.TimeoutError:
+            pass
+        except Exception as e:
+            log.exception(e)
+        finally:
+            if pulled:
+                self._active -= 1
+                self.processing = self._active > 0
+            self._release_slot(slot)
+            if ticket is not None:
+                ticket.release()
+        return pulled
+
+    async def _aio_poll(self):
+        while self.running:
+            delay = self._poll_delay(await self._aio_process_one())
+            if delay:
+                await self._sleep(delay)
+
+    async def _sleep(self, seconds):
+        try:
+            await asyncio.wait_for(self._stopped.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _aio_run(self):
+        self._stopped = asyncio.Event()
+        self.aio_session = await self.shared_session.aio_acquire()
+        try:
+            # Clients sharing a session that has already logged in skip the login
+            if not await self._aio_login(generation=0):
+                log.error("Could not log in to Xqueue %s. Retrying every %s seconds..." % (
+                    self.queue_name, self.login_poll_interval))
+                num_tries = 1
+                while self.running:
+                    num_tries += 1
+                    await self._sleep(self.login_poll_interval)
+                    if not await self._aio_login(generation=0):
+                        log.error("Still could not log in to %s (%s) tries: %d",
+                            self.queue_name,
+                            self.username,
+                            num_tries)
+                    else:
+                        break
+            await self._aio_flush_outbox()
+            await self._sleep(random.uniform(0, self.poll_interval))
+            # WORKERS submissions are pulled and graded at once
+            await asyncio.gather(*(self._aio_poll() for _ in range(self.workers)))
+        finally:
+            self.processing = False
+            if self._posts:
+                posted = await asyncio.gather(*self._posts)
+                if not all(posted):
+                    log.error('%r: %d results were not posted', self, posted.count(False))
+            await self.shared_session.aio_release()
+        return True
+
+    def start(self):
+        """
+        Start polling on the shared event loop
+        """
+        self.runtime = _AsyncRuntime.get(self.grading_threads)
+        self._future = asyncio.run_coroutine_threadsafe(self._aio_run(), self.runtime.loop)
+        self._future.add_done_callback(self._log_exit)
+
+    def _log_exit(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            log.error('%r stopped with an error', self, exc_info=future.exception())
+
+    def run(self):
+        self.start()
+        return self.join()
+
+    def is_alive(self):
+        return self._future is not None and not self._future.done()
+
+    def add_done_callback(self, callback):
+        """
+        Call `callback(self)` from the event loop once the client has stopped.
+        """
+        self._future.add_done_callback(lambda future: callback(self))
+
+    def join(self, timeout=None):
+        if self._future is None:
+            return None
+        try:
+            return self._future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            return None
+        except Exception:
+            # Cancelled or failed, as logged by _log_exit
+            return None
+
+    def shutdown(self):
+        """
+        Stop polling once the current submission is done
+        """
+        self.running = False
+        if self._signal_stop():
+            self.shared_session.release()
+        if self._stopped is not None and self.runtime.loop.is_running():
+            self.runtime.loop.call_soon_threadsafe(self._stopped.set)
@@ -1,6 +1,8 @@
 """
 Implementation of a grader compatible with XServer
 """
+import collections
+import contextlib
 import html
 import imp
 import sys
@@ -10,15 +12,25 @@ from path import Path
 import logging
 import multiprocessing
 from statsd import statsd
-from urllib.request import urlretrieve
+from urllib.request import urlopen
 import urllib.error
 import tempfile
 import operator
 import string
 import os
+import threading
 import json
 
+from . import admission
 from . import nbgrader
+from . import resultcache
+from . import workspace
+from .submission import Submission
+from .kernelpool import KernelPool, PreambleKernelPool
+from .workerpool import WorkerPool
+
+# Submissions being graded in this process, shared by all Grader instances
+_in_flight = resultcache.Coalescer()
 
 
 def format_errors(errors):
@@ -93,21 +105,91 @@ class Grader:
 </ul>
 '''
 
-    def __init__(self, grader_root='/tmp/', fork_per_item=True, logger_name=__name__, **kwargs):
+    def __init__(self, grader_root='/tmp/', fork_per_item=True, logger_name=__name__,
+                 worker_pool_size=0, worker_threads=1, worker_max_jobs=100,
+                 worker_max_rss_mb=None,
+                 kernel_pool_size=0, kernel_name='python3', kernel_preimport=(),
+                 setup_cell_snapshots=False, kernel_pool_problems=4,
+                 check_scores=False, workspace_pool_size=0, workspace_root=None,
+                 result_cache_path=None, result_cache_size=10000,
+                 result_cache_ttl=7*24*3600, **kwargs):
         """
         grader_root = root path to graders
         fork_per_item = fork a process for every request
         logger_name = name of logger
+        worker_pool_size = grade in this many pre-forked worker processes
+                           instead of forking per request (0 to disable)
+        worker_threads = number of submissions each worker grades concurrently
+        worker_max_jobs = recycle a worker after this many submissions
+        worker_max_rss_mb = recycle a worker once it uses this much memory
+        kernel_pool_size = keep this many pre-started kernels per grading
+                           process (needs a worker pool or fork_per_item=False)
+        kernel_name = kernel spec name of the pooled kernels
+        kernel_preimport = modules to import in pooled kernels ahead of time
+        setup_cell_snapshots = keep a kernel pool per problem whose kernels
+                               have already run the release notebook's
+                               read-only setup cells
+        kernel_pool_problems = number of per-problem kernel pools to keep
+        check_scores = also read scores back from the gradebook database and
+                       log any difference from the notebook-derived scores
+        workspace_pool_size = keep this many prepared grading directories per
+                              problem in each grading process
+        workspace_root = create grading directories here, e.g. on a tmpfs
+        result_cache_path = SQLite file for caching the results of identical
+                            submissions (relative to the working directory,
+                            None to disable)
+        result_cache_size = maximum number of cached results
+        result_cache_ttl = seconds before a cached result expires
         """
         self.log = logging.getLogger(logger_name)
         self.grader_root = Path(grader_root)
 
         self.fork_per_item = fork_per_item
+        self.check_scores = check_scores
+        self.workspace_pool_size = workspace_pool_size
+        self.workspace_root = workspace_root
 
         self.start_dir = Path(os.getcwd())
 
+        self.result_cache = None
+        if result_cache_path:
+            self.result_cache = resultcache.ResultCache(
+                self.start_dir / result_cache_path,
+                max_entries=result_cache_size,
+                ttl=result_cache_ttl)
+
+        self.kernel_pool_size = kernel_pool_size
+        self.kernel_name = kernel_name
+        self.kernel_preimport = list(kernel_preimport)
+        self.setup_cell_snapshots = setup_cell_snapshots
+        self.kernel_pool_problems = kernel_pool_problems
+        # Warm kernels and nbgrader engines belong to the process that made them
+        self._kernel_pools = collections.OrderedDict()
+        self._engines = {}
+        self._workspace_pool = None
+        self._pools_lock = threading.RLock()
+        self._local_pid = os.getpid()
+
+        self.worker_pool = None
+        if worker_pool_size:
+            self.worker_pool = WorkerPool(
+                self.grade,
+                size=worker_pool_size,
+                threads=worker_threads,
+                max_jobs=worker_max_jobs,
+                max_rss_mb=worker_max_rss_mb,
+                initializer=self._init_worker,
+                finalizer=self.close_pools,
+                name=f'{self.__class__.__name__}-worker')
+        elif kernel_pool_size and fork_per_item:
+            self.log.warning('kernel_pool_size has no effect with fork_per_item '
+                             'and no worker pool')
+
     def __call__(self, content):
-        if self.fork_per_item:
+        if self.worker_pool is not None:
+            # Only the grading step runs in a worker, see _run_grade
+            return self.process_item(content)
+        elif self.fork_per_item:
             q = multiprocessing.Queue()
             proc = multiprocessing.Process(target=self.process_item, args=(content, q))
             proc.start()
@@ -123,6 +205,9 @@ class Grader:
                     'score': results['score'],
                     'msg': self.render_results(results),
                 }
+            ticket = getattr(content, 'admission', None)
+            if ticket is not None and not isinstance(reply, Exception):
+                self._adopt_usage(ticket, q)
             if isinstance(reply, Exception):
                 #raise reply
                 results = self._grade_failed_result(914,
@@ -138,6 +223,126 @@ class Grader:
         else:
             return self.process_item(content)
 
+    def _adopt_usage(self, ticket, q):
+        """
+        Pass the problem and usage that a forked child recorded on its copy
+        of the admission ticket on to the ticket.
+        """
+        try:
+            problem, used = q.get(timeout=1)
+        except Exception:
+            self.log.warning('no usage reported for %r', ticket)
+            return
+        ticket.assign(problem)
+        if used is not None:
+            ticket.record(**used)
+
+    def _check_process(self):
+        if self._local_pid != os.getpid():
+            # Kernels and engines of a parent process cannot be used after a fork
+            self._kernel_pools = collections.OrderedDict()
+            self._engines = {}
+            self._workspace_pool = None
+            self._pools_lock = threading.RLock()
+            self._local_pid = os.getpid()
+
+    def get_autograde_engine(self, prob_name):
+        """
+        Return the nbgrader engine for a problem, loading nbgrader_config.py
+        only when the problem is first seen or the config file changed.
+        """
+        self._check_process()
+        config_dir = self.start_dir / 'relocate'
+        version = (config_dir / 'nbgrader_config.py').stat().st_mtime
+        with self._pools_lock:
+            engine, engine_version = self._engines.get(prob_name, (None, None))
+            if engine is None or engine_version != version:
+                engine = nbgrader.AutogradeEngine(prob_name, config_dir)
+                self._engines[prob_name] = (engine, version)
+        return engine
+
+    def _init_worker(self):
+        if not self.setup_cell_snapshots:
+            # Start warming kernels before the first submission arrives
+            self.get_kernel_pool()
+
+    def _make_kernel_pool(self, prob_name, release_path):
+        if prob_name is None:
+            return KernelPool(
+                size=self.kernel_pool_size,
+                kernel_name=self.kernel_name,
+                preimport=self.kernel_preimport)
+        return PreambleKernelPool(
+            nbgrader.release_setup_cells(prob_name, release_path.dirname().dirname()),
+            size=self.kernel_pool_size,
+            kernel_name=self.kernel_name,
+            preimport=self.kernel_preimport,
+            files=self.start_dir / 'relocate' / 'source' / prob_name)
+
+    def get_kernel_pool(self, prob_name=None):
+        """
+        Return the warm kernel pool of the current process, if enabled.
+
+        With setup_cell_snapshots, there is one pool per problem, replaced
+        whenever the problem's release notebook changes.
+        """
+        if not self.kernel_pool_size:
+            return None
+        if self.fork_per_item and self.worker_pool is None:
+            return None
+        self._check_process()
+
+        release_path = version = None
+        if not self.setup_cell_snapshots:
+            prob_name = None
+        elif prob_name is not None:
+            release_path = self.start_dir / 'relocate' / 'release' / prob_name / f'{prob_name}.ipynb'
+            try:
+                version = release_path.stat().st_mtime
+            except OSError:
+                return None
+
+        with self._pools_lock:
+            pool, pool_version = self._kernel_pools.get(prob_name, (None, None))
+            if pool is not None and pool_version == version:
+                self._kernel_pools.move_to_end(prob_name)
+                return pool
+            if pool is not None:
+                self.log.info('release notebook of %s changed, replacing %r', prob_name, pool)
+                pool.shutdown()
+            try:
+                pool = self._make_kernel_pool(prob_name, release_path)
+            except Exception:
+                self.log.exception('could not create a kernel pool for %s', prob_name)
+                return None
+            self._kernel_pools[prob_name] = (pool, version)
+            while len(self._kernel_pools) > max(1, self.kernel_pool_problems):
+                _, (old_pool, _) = self._kernel_pools.popitem(last=False)
+                old_pool.shutdown()
+            return pool
+
+    def close_pools(self):
+        """
+        Shut down the warm kernels and workspaces of the current process.
+        """
+        self._check_process()
+        with self._pools_lock:
+            while self._kernel_pools:
+                _, (pool, _) = self._kernel_pools.popitem()
+                pool.shutdown()
+            if self._workspace_pool is not None:
+                self._workspace_pool.close()
+                self._workspace_pool = None
+
+    def close(self):
+        """
+        Stop the worker pool and shut down the warm kernels and workspaces of
+        the current process, once no more submissions will be graded.
+        """
+        if self.worker_pool is not None:
+            self.worker_pool.shutdown()
+        self.close_pools()
+
     def _grade_failed_result(self, error_code, priv_msg='', pub_msg='Internal grader error', contact=True, e=None):
         self.log.warning(f'GRADER ERROR {error_code}: {priv_msg} ({repr(e)})')
         if contact:
@@ -155,11 +360,10 @@ class Grader:
             'feedback-html': '',
         }
 
-    def _grade(self, grader_config, files, tmpdir):
-        tmpdir = Path(tmpdir)
-        self.log.info('GRADING START')
-
-        # Parse input config
+    def _parse_grader_config(self, grader_config, files):
+        """
+        Return (prob_name, file_url, None), or (None, None, failed_results).
+        """
         try:
             prob_name = str(grader_config['name'])
             # Sanitize for the file system
@@ -169,63 +373,82 @@ class Grader:
             file_url = str(files[prob_name+'.ipynb'])
             # Sanitize to ensure only a public URL
             if not file_url.startswith('https://'):
-                return self._grade_failed_result(312,
-                        'invalid submitted file download URL ({file_url})',
-                        e=e)
+                return None, None, self._grade_failed_result(312,
+                        f'invalid submitted file download URL ({file_url})')
         except KeyError as e:
-            return self._grade_failed_result(323,
-                    'incorrect grader content from the XQueue ({grader_config}, {files})',
+            return None, None, self._grade_failed_result(323,
+                    f'incorrect grader content from the XQueue ({grader_config}, {files})',
                     e=e)
+        return prob_name, file_url, None
 
-        # Init file structure in the temp dir
-        self._prepare_tmpdir(tmpdir, prob_name)
-        download_path = tmpdir / 'submitted' / 'student' / prob_name / prob_name+'.ipynb'
-
-        # Download student submission notebook to the temp dir
+    def _download(self, file_url):
+        """
+        Return the content of a submitted file, or raise OSError.
+        """
+        exc = AssertionError('this error cannot be thrown')
+        for i in range(3):  # Three tries in case of network interruption
+            if i > 0:
+                time.sleep(5)  # Wait before retrying
+            try:
+                with urlopen(file_url) as f:
+                    return f.read()
+            except urllib.error.URLError as e:
+                exc = e
+                self.log.warning(f'Submitted file download error (retrying): {repr(e)}')
+        raise exc
+
+    def _fetch_notebook(self, file_url):
+        """
+        Return (notebook_bytes, None), or (None, failed_results).
+        """
         try:
-            exc = AssertionError('this error cannot be thrown')
-            for i in range(3):  # Three tries in case of network interruption
-                if i > 0:
-                    time.sleep(5)  # Wait before retrying
-                try:
-                    student_file, headers = urlretrieve(file_url, download_path)
-                    exc = None
-                    break
-                except urllib.error.URLError as e:
-                    exc = e
-                    self.log.warning(f'Submitted file download error (retrying): {repr(e)}')
-            if exc is not None:
-                raise exc
+            notebook = self._download(file_url)
         except OSError as e:  # OSError is a parent class of all urllib errors
-            return self._grade_failed_result(950,
+            return None, self._grade_failed_result(950,
                     f'cannot download submitted file from the XQueue ({file_url})',
                     e=e)
         try:
-            with open(download_path, 'r') as f:
-                json.load(f)  # Test if able to read and parse as JSON
+            json.loads(notebook.decode())  # Test if able to read and parse as JSON
         except UnicodeDecodeError as e:
-            return self._grade_failed_result(669,
+            return None, self._grade_failed_result(669,
                     f'cannot parse JSON of submitted file ({file_url})',
                     'An error occurred during grading.  You may have submitted the wrong file or the file is corrupted.',
                     contact=False,
                     e=e)
         except json.JSONDecodeError as e:
-            return self._grade_failed_result(788,
-                    f'cannot parse JSON of submitted file ({file_url}, {open(download_path).read(50)!r})',
+            return None, self._grade_failed_result(788,
+                    f'cannot parse JSON of submitted file ({file_url}, {notebook[:50]!r})',
                     'An error occurred during grading.  You may have submitted the wrong file or the file is corrupted.',
                     contact=False,
                     e=e)
-        except (OSError, Exception) as e:
+        return notebook, None
+
+    def _grade(self, prob_name, notebook, tmpdir):
+        tmpdir = Path(tmpdir)
+        download_path = tmpdir / 'submitted' / 'student' / prob_name / prob_name+'.ipynb'
+
+        # Save student submission notebook to the temp dir
+        try:
+            download_path.write_bytes(notebook)
+        except OSError as e:
             return self._grade_failed_result(370,
-                    f'cannot read submitted file from disk ({file_url})',
+                    f'cannot write submitted file to disk ({download_path})',
                     e=e)
 
         # Call out to nbgrader to do the grading
-        tmpdir.chdir()
         try:
-            nbgrader.autograde(prob_name)
-            feedback_html = nbgrader.get_feedback(prob_name)
-            points, max_points = nbgrader.get_grade(prob_name)
+            engine = self.get_autograde_engine(prob_name)
+            engine.grade(download_path, kernel_pool=self.get_kernel_pool(prob_name))
+            graded_nb = nbgrader.read_autograded(prob_name, tmpdir)
+            feedback_html = nbgrader.get_feedback(prob_name, graded_nb, tmpdir)
+            points, max_points = nbgrader.get_score(prob_name, graded_nb, tmpdir)
+            if self.check_scores:
+                db_points, db_max_points = nbgrader.get_grade(prob_name, tmpdir)
+                if (points, max_points) != (db_points, db_max_points):
+                    self.log.error(f'score mismatch for {prob_name}: notebook '
+                                   f'{points}/{max_points}, gradebook '
+                                   f'{db_points}/{db_max_points}')
+                    points, max_points = db_points, db_max_points
             if int(points) == points:
                 points = int(points)
             if int(max_points) == max_points:
@@ -241,8 +464,6 @@ class Grader:
                      'much memory.'),
                     contact=False,
                     e=e)
-        finally:
-            self.start_dir.chdir()
 
         # For debugging
         #import subprocess
@@ -264,35 +485,126 @@ class Grader:
         }
 
     def _prepare_tmpdir(self, tmpdir, prob_name):
-        # Make location for the submitted file
-        (tmpdir / 'submitted').mkdir()
-        (tmpdir / 'submitted' / 'student').mkdir()
-        (tmpdir / 'submitted' / 'student' / prob_name).mkdir()
-        # Copy template database
-        relocate = self.start_dir / 'relocate'
-        (relocate / 'gradebook.db').copy(tmpdir / 'gradebook.db')
-        # Symlink grader files
-        (relocate / 'nbgrader_config.py').symlink(tmpdir / 'nbgrader_config.py')
-        (relocate / 'source').symlink(tmpdir / 'source')
-        (relocate / 'release').symlink(tmpdir / 'release')
+        workspace.prepare_workspace(tmpdir, self.start_dir / 'relocate', prob_name)
 
-    def grade(self, grader_config, files):
-        with tempfile.TemporaryDirectory(prefix='notebook-grader-') as tmpdir:
-            return self._grade(grader_config, files, tmpdir)
+    def get_workspace_pool(self):
+        """
+        Return the workspace pool of the current process, if enabled.
+        """
+        if not self.workspace_pool_size:
+            return None
+        if self.fork_per_item and self.worker_pool is None:
+            return None
+        self._check_process()
+        with self._pools_lock:
+            if self._workspace_pool is None:
+                self._workspace_pool = workspace.WorkspacePool(
+                    self.start_dir / 'relocate',
+                    size=self.workspace_pool_size,
+                    root=self.workspace_root)
+            return self._workspace_pool
+
+    @contextlib.contextmanager
+    def _workspace(self, prob_name):
+        pool = self.get_workspace_pool()
+        if pool is None:
+            with tempfile.TemporaryDirectory(prefix='notebook-grader-', dir=self.workspace_root) as tmpdir:
+                # Init file structure in the temp dir
+                self._prepare_tmpdir(Path(tmpdir), prob_name)
+                yield Path(tmpdir)
+        else:
+            ws = pool.acquire(prob_name)
+            try:
+                yield ws
+            finally:
+                pool.release(prob_name, ws)
+
+    def _run_grade(self, prob_name, notebook, ticket=None):
+        if self.worker_pool is None:
+            results = self.grade(prob_name, notebook)
+        else:
+            try:
+                results = self.worker_pool.submit(prob_name, notebook)
+            except Exception as e:
+                return self._grade_failed_result(904,
+                        f'worker pool error ({prob_name})',
+                        e=e)
+        used = results.pop('usage', None)
+        if ticket is not None and used is not None:
+            ticket.record(**used)
+        return results
+
+    def grade(self, prob_name, notebook):
+        """
+        Grade a submitted notebook (bytes) for a problem.
+        """
+        self.log.info('GRADING START')
+        with admission.Usage() as usage:
+            with self._workspace(prob_name) as tmpdir:
+                results = self._grade(prob_name, notebook, tmpdir)
+        # Taken out again by _run_grade, for admission control
+        results['usage'] = usage.result
+        return results
+
+    def _cache_key(self, prob_name, notebook):
+        relocate = self.start_dir / 'relocate'
+        try:
+            release = resultcache.fingerprint(
+                relocate / 'release' / prob_name / f'{prob_name}.ipynb',
+                relocate / 'gradebook.db',
+                relocate / 'nbgrader_config.py')
+        except OSError:
+            return None
+        return resultcache.cache_key(prob_name, notebook, release)
+
+    def _grade_submission(self, grader_config, files, ticket=None):
+        prob_name, file_url, failed = self._parse_grader_config(grader_config, files)
+        if failed is not None:
+            return failed
+        if ticket is not None:
+            ticket.assign(prob_name)
+        notebook, failed = self._fetch_notebook(file_url)
+        if failed is not None:
+            return failed
+
+        key = self._cache_key(prob_name, notebook)
+        if key is not None and self.result_cache is not None:
+            try:
+                results = self.result_cache.get(key)
+            except Exception:
+                self.log.exception('result cache lookup failed')
+                results = None
+            if results is not None:
+                statsd.increment('xqueuewatcher.result-cache.hit')
+                self.log.info('GRADING CACHED')
+                return results
+            statsd.increment('xqueuewatcher.result-cache.miss')
+
+        if key is None:
+            return self._run_grade(prob_name, notebook, ticket)
+        # Identical submissions arriving meanwhile wait for this grade
+        results, shared = _in_flight.run(key, self._run_grade, prob_name, notebook, ticket)
+        if shared:
+            statsd.increment('xqueuewatcher.coalesced')
+            self.log.info('GRADING COALESCED')
+        elif self.result_cache is not None and not results['grader-failed']:
+            try:
+                self.result_cache.put(key, results)
+            except Exception:
+                self.log.exception('result cache update failed')
+        return results
 
     def process_item(self, content, queue=None):
         try:
             statsd.increment('xqueuewatcher.process-item')
-            body = content['xqueue_body']
-            files = content['xqueue_files']
-
-            # Delivery from the lms
-            body = json.loads(body)
-            files = json.loads(files)
+            # Delivery from the lms, decoded at most once
+            submission = Submission.parse(content)
+            body = submission.body
+            files = submission.files
             #student_response = body['student_response']
             payload = body['grader_payload']
             try:
-                grader_config = json.loads(payload)
+                grader_config = submission.grader_payload
             except ValueError as err:
                 # If parsing json fails, erroring is fine--something is wrong in the content.
                 # However, for debugging, still want to see what the problem is
@@ -305,7 +617,7 @@ class Grader:
             #relative_grader_path = grader_config['grader']
             #grader_path = (self.grader_root / relative_grader_path).abspath()
             start = time.time()
-            results = self.grade(grader_config, files)
+            results = self._grade_submission(grader_config, files, submission.admission)
 
             statsd.histogram('xqueuewatcher.grading-time', time.time() - start)
 
@@ -326,6 +638,8 @@ class Grader:
         else:
             if queue:
                 queue.put(reply)
+                if submission.admission is not None:
+                    queue.put((submission.admission.problem, submission.admission.used))
             return reply
 
     def render_results(self, results):
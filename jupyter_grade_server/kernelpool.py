@@ -0,0 +1,232 @@
+"""
+A pool of pre-started Jupyter kernels for notebook execution.
+"""
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+
+from jupyter_client import KernelManager
+from nbformat.v4 import output_from_msg
+
+log = logging.getLogger(__name__)
+
+RETRY_INTERVAL = 5
+
+# Problem files nbgrader does not copy next to the notebook it executes
+IGNORE = ('*.ipynb', '.ipynb_checkpoints', '*.pyc', '__pycache__', 'feedback')
+
+PREIMPORT_CODE = '''\
+import importlib as _importlib
+for _name in {modules!r}:
+    _importlib.import_module(_name)
+del _importlib, _name
+'''
+
+CHDIR_CODE = '''\
+import os as _os
+_os.chdir({path!r})
+del _os
+'''
+
+
+class KernelPool:
+    """
+    Keep `size` kernels started and warmed up ahead of time.
+
+    Each kernel executes exactly one notebook and is then shut down, so
+    student code never sees state left behind by another submission.  A
+    background thread starts a replacement for every kernel checked out.
+
+    preimport = modules imported into sys.modules (without binding any names
+                in the user namespace) before a kernel is handed out
+    """
+    def __init__(self, size=1, kernel_name='python3', preimport=(),
+                 extra_arguments=('--HistoryManager.hist_file=:memory:',),
+                 startup_timeout=60, cwd=None):
+        self.size = size
+        self.cwd = None if cwd is None else str(cwd)
+        self.kernel_name = kernel_name
+        self.preimport = list(preimport)
+        self.extra_arguments = list(extra_arguments)
+        self.startup_timeout = startup_timeout
+        self._ready = queue.Queue()
+        self._wanted = queue.Queue()
+        self.running = True
+        for _ in range(size):
+            self._wanted.put(True)
+        self._thread = threading.Thread(target=self._refill, name='kernel-pool', daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.kernel_name}, size={self.size})'
+
+    def _execute(self, kc, code):
+        reply = kc.execute_interactive(code, silent=True, store_history=False,
+                                       timeout=self.startup_timeout,
+                                       output_hook=lambda msg: None)
+        if reply['content']['status'] != 'ok':
+            raise RuntimeError(f'kernel setup failed: {reply["content"].get("evalue")}')
+
+    def warm_up(self, kc):
+        """
+        Run setup code in a freshly started kernel.  Subclasses may extend this.
+
+        The return value is handed out with the kernel by `checkout`.
+        """
+        if self.preimport:
+            self._execute(kc, PREIMPORT_CODE.format(modules=self.preimport))
+        return None
+
+    def _discard(self, km, state):
+        """
+        Shut down a kernel that is not handed out.  Subclasses may extend this.
+        """
+        km.shutdown_kernel(now=True)
+
+    def _start_kernel(self):
+        km = KernelManager(kernel_name=self.kernel_name)
+        km.start_kernel(extra_arguments=self.extra_arguments, cwd=self.cwd)
+        kc = km.blocking_client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=self.startup_timeout)
+            state = self.warm_up(kc)
+        except Exception:
+            kc.stop_channels()
+            km.shutdown_kernel(now=True)
+            raise
+        return km, kc, state
+
+    def _refill(self):
+        while self.running:
+            if not self._wanted.get():
+                break
+            try:
+                self._ready.put(self._start_kernel())
+            except Exception:
+                log.exception('could not start a %s kernel', self.kernel_name)
+                # Try again later instead of spinning on a broken kernelspec
+                self._wanted.put(True)
+                time.sleep(RETRY_INTERVAL)
+
+    def checkout(self, cwd=None, timeout=0):
+        """
+        Return `(km, state)` for a started kernel running in `cwd`, where
+        `state` is the result of `warm_up`, or `(None, None)` if no warm
+        kernel became ready within `timeout` seconds.
+
+        The caller owns the kernel and must shut it down when done.
+        """
+        while True:
+            try:
+                if timeout:
+                    km, kc, state = self._ready.get(timeout=timeout)
+                else:
+                    km, kc, state = self._ready.get_nowait()
+            except queue.Empty:
+                return None, None
+            self._wanted.put(True)
+            try:
+                if not km.is_alive():
+                    raise RuntimeError('kernel died while idle')
+                if cwd is not None:
+                    self._execute(kc, CHDIR_CODE.format(path=str(cwd)))
+            except Exception:
+                log.exception('discarding pooled kernel')
+                self._discard(km, state)
+                continue
+            finally:
+                kc.stop_channels()
+            return km, state
+
+    def shutdown(self):
+        """
+        Stop refilling and shut down all idle kernels.
+        """
+        self.running = False
+        self._wanted.put(False)
+        while True:
+            try:
+                km, kc, state = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            kc.stop_channels()
+            self._discard(km, state)
+
+
+class PreambleKernelPool(KernelPool):
+    """
+    A kernel pool whose kernels have already executed a notebook's leading
+    read-only setup cells.
+
+    `cells` is the list of setup cell sources.  Each kernel runs them in a
+    private directory laid out like the one nbgrader executes a submission
+    in: a copy of the problem's files from `files`, without the notebooks.
+    `checkout` moves whatever the setup cells created there to the
+    submission's directory, and returns the outputs and execution counts
+    they produced so the executing notebook can reuse them instead of
+    running the cells again.  If the setup cells fail, the pool logs the
+    error and falls back to plain warm kernels.
+    """
+    def __init__(self, cells, *args, files=None, **kwargs):
+        self.cells = list(cells)
+        self.files = None if files is None else str(files)
+        super().__init__(*args, **kwargs)
+
+    def _run_cell(self, kc, source):
+        outputs = []
+
+        def collect(msg):
+            msg_type = msg['msg_type']
+            if msg_type == 'clear_output':
+                outputs[:] = []
+            elif msg_type in ('stream', 'display_data', 'execute_result', 'error'):
+                outputs.append(output_from_msg(msg))
+
+        reply = kc.execute_interactive(source, store_history=True,
+                                       timeout=self.startup_timeout,
+                                       output_hook=collect)
+        content = reply['content']
+        if content['status'] != 'ok':
+            raise RuntimeError(f'setup cell failed: {content.get("evalue")}')
+        return outputs, content.get('execution_count')
+
+    def _make_run_dir(self):
+        path = tempfile.mkdtemp(prefix='kernel-preamble-')
+        if self.files is not None:
+            shutil.copytree(self.files, path, ignore=shutil.ignore_patterns(*IGNORE),
+                            dirs_exist_ok=True)
+        return path
+
+    def warm_up(self, kc):
+        super().warm_up(kc)
+        path = self._make_run_dir()
+        try:
+            self._execute(kc, CHDIR_CODE.format(path=path))
+            return path, [(source,) + self._run_cell(kc, source) for source in self.cells]
+        except Exception:
+            shutil.rmtree(path, ignore_errors=True)
+            log.exception('disabling setup cell snapshots for %r', self)
+            self.cells = []
+            raise
+
+    def _discard(self, km, state):
+        super()._discard(km, state)
+        shutil.rmtree(state[0], ignore_errors=True)
+
+    def checkout(self, cwd=None, timeout=0):
+        km, state = super().checkout(cwd=cwd, timeout=timeout)
+        if km is None:
+            return km, state
+        path, cells = state
+        if cwd is not None:
+            # Files the setup cells wrote are expected next to the notebook
+            for name in os.listdir(path):
+                if not os.path.lexists(os.path.join(cwd, name)):
+                    shutil.move(os.path.join(path, name), os.path.join(cwd, name))
+        shutil.rmtree(path, ignore_errors=True)
+        return km, cells
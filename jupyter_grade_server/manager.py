@@ -1,17 +1,26 @@
 #!/usr/bin/env python
+import collections
 import getpass
 import importlib
 import inspect
 import json
 import logging
 import logging.config
+import multiprocessing.connection
 from path import Path
 import signal
 import sys
+import threading
 import time
 
 from codejail import jail_code
+from statsd import statsd
 
+from . import admission
+from . import autoscaler
+from . import metrics
+from .outbox import Outbox
+from .scheduler import FairScheduler
 from .settings import get_manager_config_values, MANAGER_CONFIG_DEFAULTS
 
 
@@ -19,10 +28,44 @@ class Manager:
     """
     Manages polling connections to XQueue.
     """
+    # Queue settings that can change without replacing the queue's clients
+    LIVE_KEYS = ('CONNECTIONS', 'MIN_CONNECTIONS', 'MAX_CONNECTIONS', 'WEIGHT', 'MIN_SLOTS',
+                 'JOB_BUDGET', 'PROBLEM_BUDGETS')
+
     def __init__(self):
         self.clients = []
         self.log = logging
         self.manager_config = MANAGER_CONFIG_DEFAULTS.copy()
+        self.outbox = None
+        # Grading slots shared by the clients of all queues, with GRADING_SLOTS
+        self.scheduler = None
+        # Admission of jobs by their memory and CPU budgets, with ADMISSION
+        self.admission = None
+        # Shared sessions by (server, username, password)
+        self.sessions = {}
+        # Queue configurations and their clients, for reloading conf.d
+        self.queue_configs = {}
+        self.queue_clients = {}
+        # Clients taken out of service that may still be finishing their work
+        self.retired = []
+        self._retired_lock = threading.Lock()
+        self.confd = None
+        self._confd_version = None
+        # Autoscalers and the idle clients asking XQueue for queue lengths
+        self.autoscalers = {}
+        self.probes = {}
+        self._next_autoscale = 0
+        # Clients that stopped, failures in a row and due restarts by queue
+        self._exited = collections.deque()
+        self._failures = {}
+        self._pending_restarts = []
+        self.restarts = collections.Counter()
+        # Last pass of the monitoring loop, and the /metrics and /healthz server
+        self._heartbeat = None
+        self.metrics_server = None
+        self._drain_requested = threading.Event()
+        self._reload_requested = threading.Event()
+        self._wakeup = threading.Event()
 
     def client_from_config(self, queue_name, watcher_config):
         """
@@ -31,16 +74,46 @@ class Manager:
         from . import client
 
         klass = getattr(client, watcher_config.get('CLASS', 'XQueueClientThread'))
+        server = watcher_config.get('SERVER', 'http://localhost:18040')
+        auth = tuple(watcher_config.get('AUTH', (None, None)))
+        session = self._session_for(server, auth)
+        kwargs = {}
+        if issubclass(klass, client.XQueueClientAsync):
+            kwargs['grading_threads'] = self.manager_config['GRADING_THREADS']
+        if not issubclass(klass, client.XQueueClientProcess):
+            # Slots cannot be shared with client processes
+            kwargs['scheduler'] = self._schedule(queue_name, watcher_config)
+            kwargs['admission'] = self._admission(queue_name, watcher_config)
         watcher = klass(
             queue_name,
-            xqueue_server=watcher_config.get('SERVER', 'http://localhost:18040'),
-            xqueue_auth=watcher_config.get('AUTH', (None, None)),
+            xqueue_server=server,
+            xqueue_auth=auth,
             http_basic_auth=self.manager_config['HTTP_BASIC_AUTH'],
             requests_timeout=self.manager_config['REQUESTS_TIMEOUT'],
             poll_interval=self.manager_config['POLL_INTERVAL'],
+            max_poll_interval=self.manager_config['MAX_POLL_INTERVAL'],
             login_poll_interval=self.manager_config['LOGIN_POLL_INTERVAL'],
+            workers=watcher_config.get('WORKERS', 1),
+            prefetch=watcher_config.get('PREFETCH', 0),
+            pull_timeout=self.manager_config['PULL_TIMEOUT'],
+            post_threads=watcher_config.get('POST_THREADS', 0),
+            post_retries=watcher_config.get('POST_RETRIES', 10),
+            outbox=self.outbox,
+            session=session,
+            concurrent_handlers=watcher_config.get('CONCURRENT_HANDLERS', False),
+            **kwargs
         )
 
+        try:
+            self._add_handlers(watcher, watcher_config)
+        except Exception:
+            # Release its session and the pools of the handlers already made
+            watcher.shutdown()
+            watcher.close_handlers()
+            raise
+        return watcher
+
+    def _add_handlers(self, watcher, watcher_config):
         for handler_config in watcher_config.get('HANDLERS', []):
 
             handler_name = handler_config['HANDLER']
@@ -62,17 +135,98 @@ class Manager:
             if kw or inspect.isclass(handler):
                 # handler could be a function or a class
                 handler = handler(**kw)
-            watcher.add_handler(handler)
-        return watcher
+            watcher.add_handler(handler, timeout=handler_config.get('TIMEOUT'))
+
+    def _session_for(self, server, auth):
+        from . import client
+
+        session = self.sessions.get((server,) + auth)
+        if session is None:
+            session = self.sessions[(server,) + auth] = client.SharedSession()
+        return session
+
+    def _schedule(self, queue_name, config):
+        """
+        Set the WEIGHT and MIN_SLOTS of a queue in the shared scheduler and
+        return the scheduler, or None without GRADING_SLOTS.
+        """
+        if not self.manager_config['GRADING_SLOTS']:
+            return None
+        if self.scheduler is None:
+            self.scheduler = FairScheduler(self.manager_config['GRADING_SLOTS'])
+        self.scheduler.configure(queue_name, weight=config.get('WEIGHT', 1),
+                                 min_slots=config.get('MIN_SLOTS', 0))
+        return self.scheduler
+
+    def _admission(self, queue_name, config):
+        """
+        Set the JOB_BUDGET and PROBLEM_BUDGETS of a queue in the admission
+        controller and return the controller, or None without ADMISSION.
+        """
+        if not self.manager_config['ADMISSION']:
+            return None
+        if self.admission is None:
+            self.admission = admission.AdmissionController(
+                memory_mb=self.manager_config['ADMISSION_MEMORY_MB'],
+                cpus=self.manager_config['ADMISSION_CPUS'],
+                reserve_mb=self.manager_config['ADMISSION_RESERVE_MB'])
+        self.admission.configure(queue_name, default=config.get('JOB_BUDGET'),
+                                 problems=config.get('PROBLEM_BUDGETS'))
+        return self.admission
+
+    def _connections(self, queue_name, config):
+        """
+        Return the number of clients to start for a queue, setting up its
+        autoscaler if it has MAX_CONNECTIONS.
+        """
+        connections = config.get('CONNECTIONS', 1)
+        self.autoscalers.pop(queue_name, None)
+        probe = self.probes.pop(queue_name, None)
+        if probe is not None:
+            probe.shared_session.release()
+        if 'MAX_CONNECTIONS' not in config:
+            return connections
+        scaler = self.autoscalers[queue_name] = autoscaler.Autoscaler(
+            config.get('MIN_CONNECTIONS', 1),
+            config['MAX_CONNECTIONS'],
+            target_latency=self.manager_config['AUTOSCALE_TARGET_LATENCY'],
+            cooldown=self.manager_config['AUTOSCALE_COOLDOWN'],
+            max_load=self.manager_config['AUTOSCALE_MAX_LOAD'],
+            min_free_mb=self.manager_config['AUTOSCALE_MIN_FREE_MB'])
+        return scaler.clamp(connections)
+
+    def _probe(self, queue_name):
+        """
+        Return a client of the queue that is never started, to ask XQueue
+        for the queue length without loading any handlers.
+        """
+        from . import client
+
+        probe = self.probes.get(queue_name)
+        if probe is None:
+            config = self.queue_configs[queue_name]
+            server = config.get('SERVER', 'http://localhost:18040')
+            auth = tuple(config.get('AUTH', (None, None)))
+            probe = self.probes[queue_name] = client.XQueueClient(
+                queue_name,
+                xqueue_server=server,
+                xqueue_auth=auth,
+                http_basic_auth=self.manager_config['HTTP_BASIC_AUTH'],
+                requests_timeout=self.manager_config['REQUESTS_TIMEOUT'],
+                session=self._session_for(server, auth),
+            )
+        return probe
 
     def configure(self, configuration):
         """
         Configure XQueue clients.
         """
         for queue_name, config in configuration.items():
-            for i in range(config.get('CONNECTIONS', 1)):
+            self.queue_configs[queue_name] = config
+            for i in range(self._connections(queue_name, config)):
                 watcher = self.client_from_config(queue_name, config)
                 self.clients.append(watcher)
+                self.queue_clients.setdefault(queue_name, []).append(watcher)
 
     def configure_from_directory(self, directory):
         """
@@ -93,10 +247,188 @@ class Manager:
         app_config_path = directory / 'xqwatcher.json'
         self.manager_config = get_manager_config_values(app_config_path)
 
-        confd = directory / 'conf.d'
-        for watcher in confd.files('*.json'):
+        if self.manager_config['OUTBOX']:
+            self.outbox = Outbox(directory / self.manager_config['OUTBOX'],
+                                 max_bytes=self.manager_config['OUTBOX_MAX_MB'] * 2**20)
+
+        self.confd = directory / 'conf.d'
+        self._confd_version = self._confd_signature()
+        self.configure(self._read_confd())
+
+    def _confd_signature(self):
+        return tuple((f.name, f.mtime, f.size) for f in sorted(self.confd.files('*.json')))
+
+    def _read_confd(self):
+        configuration = {}
+        for watcher in sorted(self.confd.files('*.json')):
             with open(watcher) as queue_config:
-                self.configure(json.load(queue_config))
+                configuration.update(json.load(queue_config))
+        return configuration
+
+    def _start_clients(self, queue_name, config, count):
+        """
+        Make and start `count` clients of a queue.  If any of them cannot be
+        made, none are started.
+        """
+        clients = []
+        try:
+            for i in range(count):
+                clients.append(self.client_from_config(queue_name, config))
+        except Exception:
+            for watcher in clients:
+                watcher.shutdown()
+                watcher.close_handlers()
+            raise
+        for watcher in clients:
+            self.log.info('Starting %r', watcher)
+            watcher.start()
+            self._watch(watcher)
+        return clients
+
+    def reload(self):
+        """
+        Apply changes to the conf.d queue configurations.
+
+        Clients of new queues are started.  When only LIVE_KEYS changed, the
+        scheduler and admission controller are updated and clients are
+        started or drained to match.  When anything else changed, or the
+        queue was removed, the queue's clients are drained and, if it still
+        exists, replaced.  Clients of unchanged queues keep running with
+        their warm grading pools.
+        """
+        try:
+            # Recorded first, so a broken file is not retried until it changes
+            self._confd_version = self._confd_signature()
+            configuration = self._read_confd()
+        except (OSError, ValueError):
+            self.log.exception('could not reload %s, keeping the running configuration',
+                               self.confd)
+            return
+
+        retired = []
+        for queue_name in sorted(set(self.queue_configs) | set(configuration)):
+            old = self.queue_configs.get(queue_name)
+            new = configuration.get(queue_name)
+            if old == new:
+                continue
+            try:
+                retired.extend(self._reconfigure(queue_name, old, new))
+            except Exception:
+                self.log.exception('could not configure queue %s, keeping its running '
+                                   'configuration', queue_name)
+                self._connections(queue_name, old or {})
+                if old is not None:
+                    self.queue_configs[queue_name] = old
+                    self._schedule(queue_name, old)
+                    self._admission(queue_name, old)
+        self._retire(retired)
+
+    def _reconfigure(self, queue_name, old, new):
+        """
+        Apply the configuration `new` of a queue that had `old`, either None
+        when the queue is added or removed.  Replacement clients are started
+        before the running ones are taken out of service, which are returned
+        to be passed to `_retire`.
+        """
+        clients = self.queue_clients.get(queue_name, [])
+        if new is None:
+            self.log.info('queue %s removed, retiring %d clients', queue_name, len(clients))
+            self._connections(queue_name, {})
+            retired = self._resize(queue_name, 0)
+            del self.queue_configs[queue_name]
+            del self.queue_clients[queue_name]
+            return retired
+        only_connections = old is not None and (
+            {k: v for k, v in old.items() if k not in self.LIVE_KEYS} ==
+            {k: v for k, v in new.items() if k not in self.LIVE_KEYS})
+        want = self._connections(queue_name, new)
+        if only_connections and queue_name in self.autoscalers:
+            # Autoscaled queues keep their size within the new bounds
+            want = self.autoscalers[queue_name].clamp(len(clients))
+        self.log.info('queue %s %s, resizing from %d to %d clients',
+                      queue_name, 'added' if old is None else 'changed',
+                      len(clients) if only_connections else 0, want)
+        self._schedule(queue_name, new)
+        self._admission(queue_name, new)
+        if only_connections:
+            self.queue_configs[queue_name] = new
+            return self._resize(queue_name, want)
+        started = self._start_clients(queue_name, new, want)
+        self.queue_configs[queue_name] = new
+        self.queue_clients[queue_name] = started
+        self.clients = [c for c in self.clients if c not in clients] + started
+        return clients
+
+    def _resize(self, queue_name, count):
+        """
+        Start clients of a queue or take them out of service until it has
+        `count` of them.  Returns the clients taken out of service, to be
+        passed to `_retire`.
+        """
+        clients = self.queue_clients.setdefault(queue_name, [])
+        retired = []
+        while len(clients) > count:
+            retired.append(clients.pop())
+        if len(clients) < count:
+            started = self._start_clients(queue_name, self.queue_configs[queue_name],
+                                          count - len(clients))
+            clients.extend(started)
+            self.clients.extend(started)
+        if retired:
+            self.clients = [c for c in self.clients if c not in retired]
+        return retired
+
+    def _retire(self, clients):
+        if clients:
+            with self._retired_lock:
+                self.retired.extend(clients)
+            # Retired clients finish their work without blocking the manager
+            threading.Thread(target=self._drain_retired, args=(clients,),
+                             name='drain-retired', daemon=True).start()
+
+    def _drain_retired(self, clients):
+        self._drain_clients(clients)
+        for client in clients:
+            try:
+                # Its handlers are closed only once its last job is done
+                client.join()
+            except RuntimeError:
+                # Never started
+                pass
+            client.close_handlers()
+        with self._retired_lock:
+            self.retired = [c for c in self.retired if c not in clients]
+
+    def autoscale(self):
+        """
+        Resize queues with MAX_CONNECTIONS to the length of their queue in
+        XQueue, their recent grading time and the host's load and free memory.
+        """
+        load, free_mb = autoscaler.host_headroom()
+        retired = []
+        for queue_name, scaler in list(self.autoscalers.items()):
+            queue_length = self._probe(queue_name).get_queuelen()
+            if queue_length is None:
+                continue
+            clients = self.queue_clients.get(queue_name, [])
+            # Only known for clients running in this process
+            grade_times = [c.grade_time for c in clients if c.grade_time]
+            if grade_times:
+                scaler.grade_time = sum(grade_times) / len(grade_times)
+            current = len(clients)
+            want = scaler.desired(current, queue_length, load, free_mb)
+            statsd.gauge(f'xqueuewatcher.autoscale.{queue_name}.queue-length', queue_length)
+            statsd.gauge(f'xqueuewatcher.autoscale.{queue_name}.connections', want)
+            if want != current:
+                self.log.info('autoscaling %s from %d to %d clients: %d waiting, '
+                              'grade time %s, load %s, %s MB free', queue_name, current, want,
+                              queue_length, scaler.grade_time, load, free_mb)
+                try:
+                    retired.extend(self._resize(queue_name, want))
+                except Exception:
+                    # Other queues are still scaled and supervised
+                    self.log.exception('could not autoscale %s', queue_name)
+        self._retire(retired)
 
     def enable_codejail(self, codejail_config):
         """
@@ -131,24 +463,261 @@ class Manager:
         for c in self.clients:
             self.log.info('Starting %r', c)
             c.start()
+            self._watch(c)
+        if self.manager_config['METRICS_PORT'] and self.metrics_server is None:
+            self.metrics_server = metrics.MetricsServer(
+                self.manager_config['METRICS_PORT'], self.collect, self.check,
+                host=self.manager_config['METRICS_HOST'])
+
+    def collect(self):
+        """
+        Return gauges of the state of the clients, worker pools, outbox,
+        scheduler and admission controller, for the metrics endpoint.
+        """
+        configured = collections.Counter()
+        up = collections.Counter()
+        in_flight = collections.Counter()
+        busy = collections.Counter()
+        slots = collections.Counter()
+        for queue_name, clients in list(self.queue_clients.items()):
+            configured[queue_name] = len(clients)
+            for client in list(clients):
+                up[queue_name] += client.is_alive()
+                in_flight[queue_name] += client.in_flight()
+                for handler in client.handlers:
+                    pool = getattr(handler, 'worker_pool', None)
+                    if pool is not None:
+                        busy[queue_name] += pool.busy()
+                        slots[queue_name] += pool.size * pool.threads
+
+        def by_queue(counts):
+            return [({'queue': queue_name}, value) for queue_name, value in sorted(counts.items())]
+
+        gauges = [
+            metrics.Gauge('xqueue_clients', 'Clients configured', by_queue(configured)),
+            metrics.Gauge('xqueue_clients_up', 'Clients running', by_queue(up)),
+            metrics.Gauge('xqueue_client_restarts_total', 'Clients restarted after they died',
+                          by_queue(self.restarts), type='counter'),
+            metrics.Gauge('xqueue_in_flight', 'Submissions pulled and not yet graded and posted',
+                          by_queue(in_flight)),
+            metrics.Gauge('xqueue_worker_pool_busy', 'Jobs running in grading worker processes',
+                          by_queue(busy)),
+            metrics.Gauge('xqueue_worker_pool_slots', 'Job slots of grading worker processes',
+                          by_queue(slots)),
+        ]
+        if self.outbox is not None:
+            replies, size = self.outbox.size()
+            gauges.append(metrics.Gauge('xqueue_outbox_replies', 'Replies waiting in the outbox',
+                                        [({}, replies)]))
+            gauges.append(metrics.Gauge('xqueue_outbox_bytes', 'Size of the replies in the outbox',
+                                        [({}, size)]))
+        if self.scheduler is not None:
+            gauges.append(metrics.Gauge('xqueue_scheduler_running', 'Grading slots in use',
+                                        by_queue(self.scheduler.running)))
+        if self.admission is not None:
+            reserved = self.admission.reserved()
+            gauges.append(metrics.Gauge('xqueue_admission_reserved_mb',
+                                        'Memory reserved by admitted submissions',
+                                        [({}, reserved.rss_mb)]))
+            gauges.append(metrics.Gauge('xqueue_admission_reserved_cpus',
+                                        'CPUs reserved by admitted submissions',
+                                        [({}, reserved.cpus)]))
+        return gauges
+
+    def check(self):
+        """
+        Return what makes this server unhealthy, for the health endpoint.
+        """
+        problems = []
+        if self._drain_requested.is_set():
+            problems.append('draining')
+        stall = max(60, 3 * self.manager_config['POLL_TIME'])
+        if self._heartbeat is not None and time.monotonic() - self._heartbeat > stall:
+            problems.append('monitoring loop stalled')
+        for queue_name, clients in sorted(list(self.queue_clients.items())):
+            if clients and not any(client.is_alive() for client in list(clients)):
+                problems.append(f'no client of {queue_name} is running')
+        return problems
+
+    def _watch(self, client):
+        """
+        Have `_client_exited` called as soon as a started client stops.
+        """
+        client.started_at = time.monotonic()
+        if hasattr(client, 'add_done_callback'):
+            client.add_done_callback(self._client_exited)
+            return
+        sentinel = getattr(client, 'sentinel', None)
+
+        def watch():
+            if sentinel is not None:
+                # Waiting on the sentinel leaves reaping the process to join
+                multiprocessing.connection.wait([sentinel])
+            else:
+                client.join()
+            self._client_exited(client)
+
+        threading.Thread(target=watch, name=f'watch-{client.queue_name}', daemon=True).start()
+
+    def _client_exited(self, client):
+        self._exited.append(client)
+        self._wakeup.set()
+
+    def supervise(self):
+        """
+        Replace clients that stopped without being shut down, waiting
+        exponentially longer for every failure of the same queue in a row.
+        """
+        now = time.monotonic()
+        while self._exited:
+            client = self._exited.popleft()
+            if client not in self.clients:
+                # Shut down by the manager
+                continue
+            queue_name = client.queue_name
+            self.log.error('Client died -> %r', queue_name)
+            self.clients.remove(client)
+            if client in self.queue_clients.get(queue_name, []):
+                self.queue_clients[queue_name].remove(client)
+            try:
+                client.shutdown()
+                client.join(0)
+            except Exception:
+                self.log.exception('cleaning up %r', client)
+            client.close_handlers()
+            max_backoff = self.manager_config['RESTART_MAX_BACKOFF']
+            if now - client.started_at >= max_backoff:
+                # It had been running fine
+                self._failures[queue_name] = 0
+            failures = self._failures.get(queue_name, 0)
+            self._failures[queue_name] = failures + 1
+            delay = min(max_backoff, self.manager_config['RESTART_BACKOFF'] * 2 ** failures)
+            self.log.info('restarting a client of %s in %ss', queue_name, delay)
+            self._pending_restarts.append((now + delay, queue_name))
+
+        due = [queue_name for when, queue_name in self._pending_restarts if when <= now]
+        self._pending_restarts = [r for r in self._pending_restarts if r[0] > now]
+        for queue_name in due:
+            if queue_name not in self.queue_configs:
+                continue
+            count = len(self.queue_clients.get(queue_name, [])) + 1
+            if queue_name in self.autoscalers:
+                count = self.autoscalers[queue_name].clamp(count)
+            else:
+                # A reload may have replaced the client already
+                count = min(count, self.queue_configs[queue_name].get('CONNECTIONS', 1))
+            running = len(self.queue_clients.get(queue_name, []))
+            try:
+                self._retire(self._resize(queue_name, count))
+            except Exception:
+                self.log.exception('could not restart a client of %s', queue_name)
+                failures = self._failures.get(queue_name, 0)
+                self._failures[queue_name] = failures + 1
+                delay = min(self.manager_config['RESTART_MAX_BACKOFF'],
+                            self.manager_config['RESTART_BACKOFF'] * 2 ** failures)
+                self._pending_restarts.append((now + delay, queue_name))
+                continue
+            if len(self.queue_clients[queue_name]) > running:
+                self.restarts[queue_name] += 1
+                statsd.increment(f'xqueuewatcher.restarts.{queue_name}')
 
     def wait(self):
         """
         Monitor clients.
         """
-        if not self.clients:
+        if not self.clients and self.confd is None and not self.autoscalers:
             return
-        signal.signal(signal.SIGTERM, self.shutdown)
+        signal.signal(signal.SIGTERM, self.request_drain)
+        signal.signal(signal.SIGUSR1, self.request_drain)
+        signal.signal(signal.SIGHUP, self.request_reload)
         while 1:
-            for client in self.clients:
-                if not client.is_alive():
-                    self.log.error('Client died -> %r',
-                                   client.queue_name)
-                    self.shutdown()
+            self._heartbeat = time.monotonic()
+            if self._drain_requested.is_set():
+                self.drain()
+                sys.exit()
+            if self.confd is not None:
                 try:
-                    time.sleep(self.manager_config['POLL_TIME'])
-                except KeyboardInterrupt:  # pragma: no cover
-                    self.shutdown()
+                    changed = self._confd_signature() != self._confd_version
+                except OSError:
+                    changed = False
+                if changed or self._reload_requested.is_set():
+                    self._reload_requested.clear()
+                    self.reload()
+            if self.autoscalers and time.monotonic() >= self._next_autoscale:
+                self._next_autoscale = time.monotonic() + self.manager_config['AUTOSCALE_INTERVAL']
+                self.autoscale()
+            self.supervise()
+            try:
+                timeout = self.manager_config['POLL_TIME']
+                if self.autoscalers:
+                    timeout = min(timeout, self.manager_config['AUTOSCALE_INTERVAL'])
+                if self._pending_restarts:
+                    due = min(when for when, queue_name in self._pending_restarts)
+                    timeout = max(0, min(timeout, due - time.monotonic()))
+                self._wakeup.wait(timeout)
+                self._wakeup.clear()
+            except KeyboardInterrupt:  # pragma: no cover
+                self.shutdown()
+
+    def request_drain(self, *args):
+        """
+        Signal handler starting a drain from the monitoring loop in `wait`.
+        """
+        self._drain_requested.set()
+        self._wakeup.set()
+
+    def request_reload(self, *args):
+        """
+        Signal handler reloading conf.d from the monitoring loop in `wait`.
+        """
+        self._reload_requested.set()
+        self._wakeup.set()
+
+    def drain(self, timeout=None):
+        """
+        Stop pulling new submissions and wait up to `timeout` seconds
+        (DRAIN_TIMEOUT by default) for in-flight grades to finish and their
+        results to be posted.
+
+        Clients retired by a reload, autoscaling or a restart that are still
+        draining are waited for too.
+
+        Returns (drained, abandoned) job counts.
+        """
+        clients, self.clients = self.clients, []
+        self.queue_clients = {}
+        with self._retired_lock:
+            clients += self.retired
+        return self._drain_clients(clients, timeout)
+
+    def _drain_clients(self, clients, timeout=None):
+        if timeout is None:
+            timeout = self.manager_config['DRAIN_TIMEOUT']
+        deadline = time.monotonic() + timeout
+        in_flight = sum(client.in_flight() for client in clients)
+        self.log.info('draining %d clients with %d jobs in flight (timeout %ss)',
+                      len(clients), in_flight, timeout)
+        for client in clients:
+            client.shutdown()
+        abandoned = 0
+        running = 0
+        for client in clients:
+            try:
+                client.join(max(0, deadline - time.monotonic()))
+            except RuntimeError:
+                # Never started
+                client.close_handlers()
+                continue
+            if client.is_alive():
+                running += 1
+                abandoned += client.in_flight()
+            else:
+                # Stop the worker pools and kernels of its handlers
+                client.close_handlers()
+        drained = max(0, in_flight - abandoned)
+        self.log.info('drain done: %d jobs drained, %d jobs abandoned, '
+                      '%d clients still running', drained, abandoned, running)
+        return drained, abandoned
 
     def shutdown(self, *args):
         """
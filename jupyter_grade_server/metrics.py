@@ -0,0 +1,179 @@
+"""
+Prometheus metrics and a health check, served over HTTP by the manager.
+"""
+import bisect
+import http.server
+import logging
+import math
+import threading
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                     for name, value in labels)
+    return '{' + pairs + '}'
+
+
+def _value(value):
+    value = float(value)
+    if value.is_integer():
+        return str(int(value))
+    if value in (math.inf, -math.inf):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+class Counter:
+    """
+    A count of events by label values, only ever increased.
+    """
+    type = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self._values.items())]
+
+
+class Histogram:
+    """
+    Observed values by label values, counted in cumulative buckets.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        # Label values -> ([count per bucket and +Inf], sum)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else _value(bound)
+                    samples.append((f'{self.name}_bucket', key + (('le', le),), cumulative))
+                samples.append((f'{self.name}_sum', key, total))
+                samples.append((f'{self.name}_count', key, cumulative))
+        return samples
+
+
+class Gauge:
+    """
+    Values read at collection time, given as [(labels dict, value)].
+
+    type = 'counter' for totals kept elsewhere
+    """
+    def __init__(self, name, documentation, values, type='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.values = values
+        self.type = type
+
+    def samples(self):
+        return [(self.name, tuple(sorted(labels.items())), value) for labels, value in self.values]
+
+
+# Recorded by the clients running in the manager's process
+GRADED = Counter('xqueue_graded_total', 'Submissions graded')
+FAILED = Counter('xqueue_failed_total', 'Submissions whose handlers failed or whose results '
+                                        'were not posted')
+GRADING_SECONDS = Histogram('xqueue_grading_seconds', 'Time spent grading a submission')
+QUEUE_WAIT_SECONDS = Histogram('xqueue_queue_wait_seconds',
+                               'Time from pulling a submission until grading started')
+
+REGISTRY = [GRADED, FAILED, GRADING_SECONDS, QUEUE_WAIT_SECONDS]
+
+
+def render(metrics):
+    """
+    Return metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{_labels(labels)} {_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+    def _send(self, status, body, content_type='text/plain; charset=utf-8'):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        try:
+            if path == '/metrics':
+                self._send(200, render(REGISTRY + self.server.collect()),
+                           'text/plain; version=0.0.4; charset=utf-8')
+            elif path == '/healthz':
+                problems = self.server.check()
+                if problems:
+                    self._send(503, '\n'.join(problems) + '\n')
+                else:
+                    self._send(200, 'ok\n')
+            else:
+                self._send(404, 'not found\n')
+        except Exception:
+            log.exception('serving %s', path)
+            self._send(500, 'internal error\n')
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """
+    Serve /metrics and /healthz from a daemon thread.
+
+    collect = callable returning metrics to serve next to REGISTRY
+    check = callable returning a list of problems, empty when healthy
+    """
+    daemon_threads = True
+
+    def __init__(self, port, collect, check, host='127.0.0.1'):
+        super().__init__((host, port), _Handler)
+        self.collect = collect
+        self.check = check
+        self.thread = threading.Thread(target=self.serve_forever, name='metrics', daemon=True)
+        self.thread.start()
+        log.info('serving metrics on %s:%d', *self.server_address[:2])
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
@@ -1,33 +1,304 @@
 import base64
 import re
+import threading
 from path import Path
+from traitlets import List
 
 import nbformat
 import ansi2html
+from nbconvert.preprocessors import ExecutePreprocessor
+from nbconvert.writers import FilesWriter
 
 from nbgrader.apps.autogradeapp import AutogradeApp
 from nbgrader.converters import Autograde
 from nbgrader.api import Gradebook
+from nbgrader.coursedir import CourseDirectory
+from nbgrader import utils
+from nbgrader.preprocessors import (
+    Execute, LimitOutput, SaveAutoGrades, AssignLatePenalties, CheckCellMetadata)
 
+from . import admission
 
-def autograde(lab_name):
-    grader = AutogradeApp()
-    # Override methods with unwanted side effects
-    grader.init_syspath = lambda:None
-    grader.fail = grader.log.error
-    # Run
-    grader.initialize([lab_name])
-    super(AutogradeApp, grader).start()
-    if len(grader.extra_args) == 1:
-        grader.coursedir.assignment_id = grader.extra_args[0]
-    converter = Autograde(coursedir=grader.coursedir, parent=grader)
-    converter.start()
 
-def get_feedback(lab_name):
-    nb = nbformat.read(Path() / 'autograded' / 'student' / lab_name / f'{lab_name}.ipynb', as_version=4)
-    release_nb = nbformat.read(Path() / 'release' / lab_name / f'{lab_name}.ipynb', as_version=4)
+def is_setup_cell(cell):
+    '''Whether a cell is read-only setup code: locked, not graded, no solution.'''
+    meta = cell.get('metadata', {}).get('nbgrader', {})
+    return (cell.get('cell_type') == 'code'
+            and meta.get('locked', False)
+            and not meta.get('grade', False)
+            and not meta.get('solution', False))
 
-    color_converter=ansi2html.Ansi2HTMLConverter(inline=True)
+
+def setup_cell_sources(nb):
+    '''Returns the sources of the read-only setup cells at the start of a
+    notebook, up to the first cell a student can edit or that is graded.
+
+    Empty code cells are skipped, as they are never executed.
+    '''
+    sources = []
+    for cell in nb['cells']:
+        if cell.get('cell_type') != 'code' or not cell['source'].strip():
+            continue
+        if not is_setup_cell(cell):
+            break
+        sources.append(cell['source'])
+    return sources
+
+
+def kernel_pid(km):
+    '''Returns the pid of the process of a locally started kernel, or None.'''
+    provisioner = getattr(km, 'provisioner', None)
+    process = getattr(provisioner, 'process', None) or getattr(km, 'kernel', None)
+    return getattr(process, 'pid', None)
+
+
+class _PooledKernel(ExecutePreprocessor):
+    '''Runs ExecutePreprocessor in the kernel PooledExecute checked out, if any.'''
+    _pooled_km = None
+
+    def preprocess(self, nb, resources=None, km=None):
+        return super().preprocess(nb, resources, km=km or self._pooled_km)
+
+
+class PooledExecute(Execute, _PooledKernel):
+    '''Execute preprocessor that runs notebooks in a warm kernel checked out
+    of a KernelPool, falling back to a freshly started kernel.
+
+    If the pooled kernel has already run the notebook's setup cells (see
+    PreambleKernelPool), their recorded outputs are reused instead of
+    executing them again.  Either way the notebook goes through Execute's
+    own preprocess, retries and notebook metadata included.
+    '''
+    kernel_pool = None
+    _snapshot = {}
+
+    def _match_snapshot(self, nb, snapshot):
+        '''Maps cell indices to recorded (outputs, execution_count), or
+        returns None if the notebook does not start with the snapshot cells.
+        '''
+        matched = {}
+        code_cells = ((i, cell) for i, cell in enumerate(nb.cells)
+                      if cell.cell_type == 'code' and cell.source.strip())
+        for (source, outputs, execution_count), (i, cell) in zip(snapshot, code_cells):
+            if cell.source != source:
+                return None
+            matched[i] = (outputs, execution_count)
+        if len(matched) != len(snapshot):
+            return None
+        return matched
+
+    def preprocess(self, nb, resources, retries=None):
+        # Widget state is recorded from this run, not kept from the submission
+        nb.metadata.pop('widgets', None)
+        pool = self.kernel_pool
+        kernel_name = nb.metadata.get('kernelspec', {}).get('name', 'python')
+        km = None
+        snapshot = {}
+        if pool is not None and kernel_name == pool.kernel_name:
+            path = resources.get('metadata', {}).get('path', '') or None
+            km, cells = pool.checkout(cwd=path)
+            if km is not None:
+                snapshot = self._match_snapshot(nb, cells or [])
+                if snapshot is None:
+                    # The kernel state no longer matches what this notebook expects
+                    self.log.warning("Setup cells changed, not using a pooled kernel")
+                    km.shutdown_kernel(now=True)
+                    km = None
+                    snapshot = {}
+        if km is not None:
+            self.kernel_name = kernel_name
+        self._pooled_km, self._snapshot = km, snapshot
+        try:
+            # A retry after a failure comes back here for another kernel
+            return super().preprocess(nb, resources, retries)
+        finally:
+            if km is not None:
+                km.shutdown_kernel(now=True)
+            self._pooled_km, self._snapshot = None, {}
+
+    def preprocess_cell(self, cell, resources, cell_index, **kwargs):
+        if cell_index in self._snapshot:
+            outputs, execution_count = self._snapshot[cell_index]
+            cell.outputs = outputs
+            cell.execution_count = execution_count
+            return cell, resources
+        # Measure the kernel around each cell for admission control
+        pid = kernel_pid(self.km)
+        admission.Usage.sample(pid)
+        try:
+            return super().preprocess_cell(cell, resources, cell_index, **kwargs)
+        finally:
+            admission.Usage.sample(pid)
+
+
+class PooledAutograde(Autograde):
+    '''Autograde converter that executes notebooks with PooledExecute.
+
+    Unlike nbgrader's converters it never changes the working directory,
+    so several submissions can be graded concurrently in one process.
+    '''
+    kernel_pool = None
+
+    autograde_preprocessors = List([
+        PooledExecute,
+        LimitOutput,
+        SaveAutoGrades,
+        AssignLatePenalties,
+        CheckCellMetadata
+    ])
+
+    def _init_preprocessors(self):
+        super()._init_preprocessors()
+        for pp in self.exporter._preprocessors:
+            if isinstance(pp, PooledExecute):
+                pp.kernel_pool = self.kernel_pool
+
+    def start(self):
+        # BaseConverter.start() without the os.chdir(coursedir.root): every
+        # path nbgrader derives from the course directory is already absolute
+        self.init_notebooks()
+        self.writer = FilesWriter(parent=self, config=self.config)
+        self.exporter = self.exporter_class(parent=self, config=self.config)
+        for pp in self.preprocessors:
+            self.exporter.register_preprocessor(pp)
+        self.convert_notebooks()
+
+
+def release_setup_cells(lab_name, release_dir):
+    '''Returns the read-only setup cell sources of a release notebook.'''
+    return get_release_info(Path(release_dir) / lab_name / f'{lab_name}.ipynb').setup_cells
+
+
+class AutogradeEngine:
+    '''A configured nbgrader AutogradeApp for one problem that can grade many
+    submissions.
+
+    nbgrader_config.py and the app are loaded once from config_dir.  Each
+    call to grade() starts from a fresh CourseDirectory and converter, so no
+    per-submission state carries over, and grade() does not depend on the
+    working directory, so it may be called from several threads at once.
+    '''
+    def __init__(self, lab_name, config_dir):
+        self.lab_name = lab_name
+        self.config_dir = Path(config_dir).abspath()
+        app = AutogradeApp()
+        # Override methods with unwanted side effects
+        app.init_syspath = lambda:None
+        app.fail = app.log.error
+        app.initialize([lab_name, f'--CourseDirectory.root={self.config_dir}'])
+        super(AutogradeApp, app).start()
+        self.app = app
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.lab_name})'
+
+    def grade(self, notebook_path, kernel_pool=None):
+        '''Autogrades a notebook at <root>/submitted/<student>/<lab>/<lab>.ipynb,
+        writing results under <root>/autograded and <root>/gradebook.db.
+        '''
+        notebook_path = Path(notebook_path).abspath()
+        student_dir = notebook_path.dirname().dirname()
+        coursedir = CourseDirectory(
+            parent=self.app,
+            root=str(student_dir.dirname().dirname()),
+            assignment_id=self.lab_name,
+            student_id=student_dir.basename())
+        converter = PooledAutograde(coursedir=coursedir, parent=self.app)
+        converter.kernel_pool = kernel_pool
+        converter.start()
+
+
+def autograde(lab_name, kernel_pool=None, root='.'):
+    root = Path(root).abspath()
+    engine = AutogradeEngine(lab_name, root)
+    engine.grade(root / 'submitted' / 'student' / lab_name / f'{lab_name}.ipynb',
+                 kernel_pool=kernel_pool)
+
+
+MISSING_MSG = '''
+<h4>Test {} (MISSING!)</h4>
+<pre style="color: #aa0000">
+You probably deleted the cell containing this test.
+To fix this, download a fresh copy of the notebook file
+and copy your solutions into the fresh notebook.
+</pre>
+<hr>
+'''
+
+
+def test_number(cell):
+    return cell['metadata']['nbgrader'].get('grade_id', ''
+                ).replace('-test', '').replace('test', '').replace('-', '.')
+
+
+def is_test_cell(cell):
+    return (cell.get('metadata', {}).get('nbgrader', {}).get('grade', False)
+            and cell['metadata']['nbgrader'].get('points', 0) > 0)
+
+
+class ReleaseInfo:
+    '''The parts of a release notebook needed to grade submissions.'''
+    def __init__(self, path):
+        self.path = Path(path)
+        self.nb = nbformat.read(self.path, as_version=4)
+        # Ordered test IDs and their prerendered "MISSING" feedback
+        self.missing_html = {}
+        for cell in self.nb['cells']:
+            if is_test_cell(cell):
+                test_id = cell['metadata']['nbgrader'].get('grade_id')
+                if test_id:
+                    self.missing_html[test_id] = MISSING_MSG.format(test_number(cell))
+        self.setup_cells = setup_cell_sources(self.nb)
+        # Code grade cells and their points, as stored in the gradebook
+        self.code_points = {}
+        for cell in self.nb['cells']:
+            if utils.is_grade(cell) and cell['cell_type'] == 'code':
+                self.code_points[cell['metadata']['nbgrader']['grade_id']] = (
+                    float(cell['metadata']['nbgrader']['points']))
+
+
+_release_cache = {}
+_release_cache_lock = threading.Lock()
+
+
+def get_release_info(path):
+    '''Returns the ReleaseInfo of a release notebook, parsing it again only
+    when its modification time changes.
+    '''
+    # Resolve the per-submission release/ symlink to share one cache entry
+    path = Path(path).realpath()
+    mtime = path.stat().st_mtime
+    with _release_cache_lock:
+        cached = _release_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    info = ReleaseInfo(path)
+    with _release_cache_lock:
+        _release_cache[path] = (mtime, info)
+    return info
+
+
+_local = threading.local()
+
+
+def color_converter():
+    '''Returns a reusable ANSI to HTML converter for the current thread.'''
+    converter = getattr(_local, 'color_converter', None)
+    if converter is None:
+        converter = _local.color_converter = ansi2html.Ansi2HTMLConverter(inline=True)
+    return converter
+
+
+def read_autograded(lab_name, root='.'):
+    return nbformat.read(Path(root) / 'autograded' / 'student' / lab_name / f'{lab_name}.ipynb', as_version=4)
+
+
+def get_feedback(lab_name, nb=None, root='.'):
+    if nb is None:
+        nb = read_autograded(lab_name, root)
+    release = get_release_info(Path(root) / 'release' / lab_name / f'{lab_name}.ipynb')
+
+    converter = color_converter()
 
     def formatted_error_output(cell, whole_traceback=True):
         out_html = ''
@@ -37,7 +308,7 @@ def get_feedback(lab_name):
                     out_str = '\n'.join(output.get('traceback', ['Unknown error']))
                 else:
                     out_str = output.get('traceback', ['Unknown error'])[-1]
-                colored = color_converter.convert(out_str, full=False)
+                colored = converter.convert(out_str, full=False)
                 out_html = f'''<pre>{colored}</pre>'''
                 break
         return out_html
@@ -45,8 +316,7 @@ def get_feedback(lab_name):
     def formatted_test_output(cell, whole_traceback=False):
         max_points = cell['metadata']['nbgrader'].get('points', 0)
         points = 0
-        pnumber = cell['metadata']['nbgrader'].get('grade_id', ''
-                    ).replace('-test', '').replace('test', '').replace('-', '.')
+        pnumber = test_number(cell)
 
         out_html = '''<pre><span style="font-weight: bold">Not Graded</span></pre>'''
         for output in reversed(cell['outputs']):
@@ -55,7 +325,7 @@ def get_feedback(lab_name):
                     out_str = '\n'.join(output.get('traceback', ['Unknown error']))
                 else:
                     out_str = output.get('traceback', ['Unknown error'])[-1]
-                colored = color_converter.convert(out_str, full=False)
+                colored = converter.convert(out_str, full=False)
                 out_html = f'''<pre>{colored}</pre>'''
                 break
         else:
@@ -71,31 +341,13 @@ def get_feedback(lab_name):
         <hr>
         '''
 
-    # Find the correct set of tests from the original release document
-    test_id_map = {}
-    missing_msg = '''
-<h4>Test {} (MISSING!)</h4>
-<pre style="color: #aa0000">
-You probably deleted the cell containing this test.
-To fix this, download a fresh copy of the notebook file
-and copy your solutions into the fresh notebook.
-</pre>
-<hr>
-'''
-    for cell in release_nb['cells']:
-        if (cell.get('metadata', {}).get('nbgrader', {}).get('grade', False)
-                and cell['metadata']['nbgrader'].get('points', 0) > 0):
-            test_id = cell['metadata']['nbgrader'].get('grade_id')
-            if test_id:
-                pnumber = cell['metadata']['nbgrader'].get('grade_id', ''
-                            ).replace('-test', '').replace('test', '').replace('-', '.')
-                test_id_map[test_id] = missing_msg.format(pnumber)
+    # Start from the correct set of tests of the original release document
+    test_id_map = dict(release.missing_html)
 
     others_out = []
     pre_output = ''
     for cell in nb['cells']:
-        if (cell.get('metadata', {}).get('nbgrader', {}).get('grade', False)
-                and cell['metadata']['nbgrader'].get('points', 0) > 0):
+        if is_test_cell(cell):
             test_id = cell['metadata']['nbgrader'].get('grade_id', 'unknown')
             if pre_output:
                 pre_output = '<h4>Other Errors</h4>\n' + pre_output
@@ -117,11 +369,34 @@ and copy your solutions into the fresh notebook.
     )
     return all_html
 
-def get_grade(lab_name):
+def get_score(lab_name, nb=None, root='.'):
+    '''Returns the code score computed directly from the autograded notebook,
+    without querying the gradebook.
+
+    Returns a tuple (code_score, max_code_score) equal to get_grade().
+    '''
+    if nb is None:
+        nb = read_autograded(lab_name, root)
+    release = get_release_info(Path(root) / 'release' / lab_name / f'{lab_name}.ipynb')
+    # Same rules as nbgrader's SaveAutoGrades: ungraded and deleted cells score 0
+    scores = {}
+    for cell in nb['cells']:
+        if utils.is_grade(cell):
+            grade_id = cell['metadata']['nbgrader'].get('grade_id')
+            if grade_id in release.code_points:
+                scores[grade_id] = utils.determine_grade(cell)[0]
+    code_score = 0.0
+    max_code_score = 0.0
+    for grade_id, max_points in release.code_points.items():
+        code_score += scores.get(grade_id) or 0.0
+        max_code_score += max_points
+    return code_score, max_code_score
+
+def get_grade(lab_name, root='.'):
     '''Returns the code score, excluding any manually graded problems.
 
     Returns a tuple (code_score, max_code_score)
     '''
-    with Gradebook('sqlite:///gradebook.db') as gb:
+    with Gradebook(f'sqlite:///{Path(root) / "gradebook.db"}') as gb:
         asgn = gb.find_submission(lab_name, 'student')
         return asgn.code_score, asgn.max_code_score
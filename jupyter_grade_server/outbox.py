@@ -0,0 +1,97 @@
+"""
+A durable journal of grading replies that have not been posted to XQueue.
+"""
+import json
+import logging
+import time
+
+from statsd import statsd
+
+from . import sqlitedb
+
+log = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Replies stored in an SQLite database (in WAL mode) from the time a
+    submission is graded until XQueue accepted them.
+
+    Replies left over from a previous run are handed out once by `take_stale`
+    so that they can be posted again.  New replies are not journaled while
+    the stored replies take up more than `max_bytes`.
+    """
+    def __init__(self, path, max_bytes=100*2**20):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        with sqlitedb.connect(self.path, wal=True) as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS replies (
+                              id INTEGER PRIMARY KEY,
+                              queue_name TEXT NOT NULL,
+                              reply TEXT NOT NULL,
+                              created REAL NOT NULL,
+                              claimed INTEGER NOT NULL DEFAULT 0)''')
+            # Everything stored now is from an earlier run and up for grabs
+            db.execute('UPDATE replies SET claimed = 0')
+            self.start_id = db.execute('SELECT COALESCE(MAX(id), 0) FROM replies').fetchone()[0]
+        count, size = self.size()
+        if count:
+            log.warning('%r holds %d unposted replies (%d bytes)', self, count, size)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path})'
+
+    def size(self):
+        """
+        Return (number of replies, bytes of reply data) and report them.
+        """
+        with sqlitedb.connect(self.path) as db:
+            count, size = db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(LENGTH(reply)), 0) FROM replies').fetchone()
+        statsd.gauge('xqueuewatcher.outbox.replies', count)
+        statsd.gauge('xqueuewatcher.outbox.bytes', size)
+        return count, size
+
+    def add(self, queue_name, reply):
+        """
+        Journal a reply, returning its id, or None if the outbox is full.
+        """
+        data = json.dumps(reply)
+        with sqlitedb.connect(self.path) as db:
+            db.execute('BEGIN IMMEDIATE')
+            size = db.execute('SELECT COALESCE(SUM(LENGTH(reply)), 0) FROM replies').fetchone()[0]
+            if self.max_bytes and size + len(data) > self.max_bytes:
+                db.execute('ROLLBACK')
+                log.error('%r is full (%d bytes), not journaling a reply', self, size)
+                statsd.increment('xqueuewatcher.outbox.full')
+                return None
+            entry = db.execute(
+                'INSERT INTO replies (queue_name, reply, created, claimed) VALUES (?, ?, ?, 1)',
+                (queue_name, data, time.time())).lastrowid
+            db.execute('COMMIT')
+        statsd.gauge('xqueuewatcher.outbox.bytes', size + len(data))
+        return entry
+
+    def remove(self, entry):
+        """
+        Delete a reply once it has been posted.
+        """
+        if entry is None:
+            return
+        with sqlitedb.connect(self.path) as db:
+            db.execute('DELETE FROM replies WHERE id = ?', (entry,))
+
+    def take_stale(self, queue_name):
+        """
+        Return [(id, reply)] for the replies of a queue left over from an
+        earlier run.  Each is returned to only one caller.
+        """
+        with sqlitedb.connect(self.path) as db:
+            db.execute('BEGIN IMMEDIATE')
+            rows = db.execute(
+                'SELECT id, reply FROM replies WHERE queue_name = ? AND id <= ? AND claimed = 0',
+                (queue_name, self.start_id)).fetchall()
+            db.executemany('UPDATE replies SET claimed = 1 WHERE id = ?',
+                           [(entry,) for entry, _ in rows])
+            db.execute('COMMIT')
+        return [(entry, json.loads(reply)) for entry, reply in rows]
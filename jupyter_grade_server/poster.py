@@ -0,0 +1,146 @@
+"""
+Background posting of grading results to XQueue.
+"""
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from statsd import statsd
+
+log = logging.getLogger(__name__)
+
+
+def retry_delay(attempts, backoff=1, max_backoff=60):
+    """
+    Return the seconds to wait before retrying after `attempts` failures.
+    """
+    delay = min(max_backoff, backoff * 2 ** (attempts - 1))
+    # Jitter keeps retries from many clients from arriving in step
+    return delay * random.uniform(0.5, 1)
+
+
+class ResultPoster:
+    """
+    Post replies from `threads` background threads, retrying failed posts
+    with exponential backoff.
+
+    post = callable taking a reply and returning (success, message)
+    retries = give up on a reply after this many failed attempts
+    backoff = seconds before the first retry, doubled for every further one
+    max_backoff = upper bound on the delay between retries
+    on_backlog = callable given the backlog whenever it changes
+    """
+    def __init__(self, post, threads=2, retries=10, backoff=1, max_backoff=60,
+                 name='result-poster', on_backlog=None):
+        self.post = post
+        self.on_backlog = on_backlog
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.name = name
+        # (due time, sequence number, reply, failed attempts)
+        self._queue = []
+        self._seq = itertools.count()
+        self._posting = 0
+        self._cond = threading.Condition()
+        self.running = True
+        self.posted = 0
+        self.dropped = 0
+        self._threads = [threading.Thread(target=self._work, name=f'{name}-{i}', daemon=True)
+                         for i in range(max(1, threads))]
+        for thread in self._threads:
+            thread.start()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name}, backlog={self.backlog})'
+
+    @property
+    def backlog(self):
+        """
+        Number of replies queued, waiting for a retry or being posted.
+        """
+        with self._cond:
+            return len(self._queue) + self._posting
+
+    def _report(self):
+        backlog = len(self._queue) + self._posting
+        statsd.gauge('xqueuewatcher.put-result.backlog', backlog)
+        if self.on_backlog is not None:
+            self.on_backlog(backlog)
+
+    def submit(self, reply):
+        """
+        Queue a reply for posting and return immediately.
+        """
+        self._schedule(reply, 0, time.monotonic())
+
+    def _schedule(self, reply, attempts, due):
+        with self._cond:
+            heapq.heappush(self._queue, (due, next(self._seq), reply, attempts))
+            self._report()
+            self._cond.notify()
+
+    def _delay(self, attempts):
+        return retry_delay(attempts, self.backoff, self.max_backoff)
+
+    def _next(self):
+        with self._cond:
+            while True:
+                if not self._queue:
+                    if not self.running:
+                        return None
+                    self._cond.wait()
+                    continue
+                due = self._queue[0][0]
+                now = time.monotonic()
+                if due <= now or not self.running:
+                    _, _, reply, attempts = heapq.heappop(self._queue)
+                    self._posting += 1
+                    return reply, attempts
+                self._cond.wait(due - now)
+
+    def _work(self):
+        while True:
+            item = self._next()
+            if item is None:
+                break
+            reply, attempts = item
+            try:
+                status, message = self.post(reply)
+            except Exception as e:
+                status, message = False, e
+            attempts += 1
+            with self._cond:
+                self._posting -= 1
+                retry = not status and self.running and attempts < self.retries
+                if status:
+                    self.posted += 1
+                elif not retry:
+                    self.dropped += 1
+                self._report()
+                self._cond.notify_all()
+            if status:
+                statsd.increment('xqueuewatcher.put-result.posted')
+            elif retry:
+                log.warning('put_result failed (attempt %d), retrying: %r', attempts, message)
+                statsd.increment('xqueuewatcher.put-result.retry')
+                self._schedule(reply, attempts, time.monotonic() + self._delay(attempts))
+            else:
+                log.error('Failure for %r -> %r', reply, message)
+                statsd.increment('xqueuewatcher.put-result.dropped')
+
+    def close(self, timeout=None):
+        """
+        Post what is queued once more, without waiting for retries, and stop
+        the threads.  Returns the number of replies that were not posted.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        return self.backlog
@@ -0,0 +1,153 @@
+"""
+An on-disk cache of grading results keyed by submission content.
+"""
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+
+from . import sqlitedb
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def file_digest(path):
+    """
+    Return the sha256 hex digest of a file, cached by modification time.
+    """
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    version = (st.st_mtime_ns, st.st_size)
+    with _digests_lock:
+        cached = _digests.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    digest = h.hexdigest()
+    with _digests_lock:
+        _digests[path] = (version, digest)
+    return digest
+
+
+def fingerprint(*paths):
+    """
+    Return a digest of the content of all grading input files.
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        h.update(file_digest(path).encode())
+    return h.hexdigest()
+
+
+def cache_key(prob_name, notebook, release_fingerprint):
+    """
+    Return the cache key of a submitted notebook (bytes) for a problem.
+    """
+    h = hashlib.sha256()
+    for part in (prob_name.encode(), release_fingerprint.encode(), notebook):
+        # Length prefixes keep the parts from running into each other
+        h.update(len(part).to_bytes(8, 'big'))
+        h.update(part)
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    Grading results stored in an SQLite database, so they survive restarts
+    and are shared by all grading processes.
+
+    max_entries = evict the least recently used results beyond this many
+    ttl = results older than this many seconds are not returned
+    """
+    def __init__(self, path, max_entries=10000, ttl=7*24*3600):
+        self.path = str(path)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        with sqlitedb.connect(self.path, wal=True) as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS results (
+                              key TEXT PRIMARY KEY,
+                              value TEXT NOT NULL,
+                              created REAL NOT NULL,
+                              used REAL NOT NULL)''')
+            db.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path})'
+
+    def get(self, key):
+        """
+        Return the cached results for `key`, or None.
+        """
+        now = time.time()
+        with sqlitedb.connect(self.path) as db:
+            row = db.execute('SELECT value, created FROM results WHERE key = ?',
+                             (key,)).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if self.ttl and created + self.ttl < now:
+                db.execute('DELETE FROM results WHERE key = ?', (key,))
+                return None
+            db.execute('UPDATE results SET used = ? WHERE key = ?', (now, key))
+        return json.loads(value)
+
+    def put(self, key, results):
+        """
+        Store results for `key` and evict expired and excess entries.
+        """
+        now = time.time()
+        with sqlitedb.connect(self.path) as db:
+            db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                       (key, json.dumps(results), now, now))
+            if self.ttl:
+                db.execute('DELETE FROM results WHERE created < ?', (now - self.ttl,))
+            if self.max_entries:
+                db.execute('''DELETE FROM results WHERE key IN (
+                                  SELECT key FROM results ORDER BY used DESC
+                                  LIMIT -1 OFFSET ?)''', (self.max_entries,))
+
+    def __len__(self):
+        with sqlitedb.connect(self.path) as db:
+            return db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+
+class Coalescer:
+    """
+    Share the result of a call among concurrent calls with the same key.
+
+    While a call for a key is running, later calls with that key wait for
+    its result instead of running the function again.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, func, *args, **kwargs):
+        """
+        Return (result, shared), where `shared` is True if the result came
+        from a call that was already in flight.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+        if not leader:
+            return future.result(), True
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
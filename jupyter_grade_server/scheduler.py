@@ -0,0 +1,169 @@
+"""
+Weighted fair sharing of grading slots between queues.
+"""
+import asyncio
+import collections
+import contextlib
+import itertools
+import threading
+
+from statsd import statsd
+
+
+class FairScheduler:
+    """
+    Hand out `slots` grading slots to the clients of all queues.
+
+    A free slot goes to a waiting queue below its guaranteed `min_slots`
+    first, otherwise to the waiting queue with the fewest running jobs per
+    unit of `weight`, and between equals to the one waiting longest.  Slots
+    are not reserved: a busy queue uses the slots that quiet ones leave free,
+    and gets them back to the others as its jobs finish.
+    """
+    def __init__(self, slots):
+        self.slots = max(1, slots)
+        self.weights = {}
+        self.min_slots = {}
+        self.running = collections.Counter()
+        # Queue name -> deque of (sequence number, grant callback)
+        self.waiting = collections.defaultdict(collections.deque)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({sum(self.running.values())}/{self.slots})'
+
+    def configure(self, queue_name, weight=1, min_slots=0):
+        with self._lock:
+            self.weights[queue_name] = max(weight, 1e-6)
+            self.min_slots[queue_name] = min_slots
+            grants = self._dispatch()
+        for grant in grants:
+            grant()
+
+    def _pick(self):
+        candidates = [queue_name for queue_name, waiters in self.waiting.items() if waiters]
+        if not candidates:
+            return None
+        below = [queue_name for queue_name in candidates
+                 if self.running[queue_name] < self.min_slots.get(queue_name, 0)]
+        return min(below or candidates, key=lambda queue_name: (
+            self.running[queue_name] / self.weights.get(queue_name, 1),
+            self.waiting[queue_name][0][0]))
+
+    def _dispatch(self):
+        grants = []
+        while sum(self.running.values()) < self.slots:
+            queue_name = self._pick()
+            if queue_name is None:
+                break
+            _, grant = self.waiting[queue_name].popleft()
+            self.running[queue_name] += 1
+            statsd.gauge(f'xqueuewatcher.scheduler.{queue_name}.running', self.running[queue_name])
+            grants.append(grant)
+        return grants
+
+    def request(self, queue_name, grant):
+        """
+        Call `grant()` once the queue has been given a slot, which must then
+        be given back with `release`.
+        """
+        with self._lock:
+            self.waiting[queue_name].append((next(self._seq), grant))
+            grants = self._dispatch()
+        for callback in grants:
+            callback()
+
+    def cancel(self, queue_name, grant):
+        """
+        Withdraw a request, returning False if it has been granted already.
+        """
+        with self._lock:
+            for waiter in self.waiting[queue_name]:
+                if waiter[1] is grant:
+                    self.waiting[queue_name].remove(waiter)
+                    return True
+        return False
+
+    def release(self, queue_name):
+        with self._lock:
+            self.running[queue_name] -= 1
+            statsd.gauge(f'xqueuewatcher.scheduler.{queue_name}.running', self.running[queue_name])
+            grants = self._dispatch()
+        for grant in grants:
+            grant()
+
+    def waiting_jobs(self, queue_name):
+        with self._lock:
+            return len(self.waiting[queue_name])
+
+    def acquire(self, queue_name, running=lambda: True, poll=1):
+        """
+        Wait for a slot of the queue, to be given back with `release`.
+        Returns True once granted, or False without a slot once `running()`
+        is false, as checked every `poll` seconds.
+        """
+        granted = threading.Event()
+        grant = granted.set
+        self.request(queue_name, grant)
+        while not granted.wait(poll):
+            if not running():
+                if not self.cancel(queue_name, grant):
+                    # Granted meanwhile
+                    self.release(queue_name)
+                return False
+        return True
+
+    async def aio_acquire(self, queue_name, stopped=None):
+        """
+        Wait for a slot of the queue without blocking the event loop, to be
+        given back with `release`.  Returns True once granted, or False
+        without a slot once the asyncio.Event `stopped` is set.
+        """
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def grant():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        self.request(queue_name, grant)
+        waits = [granted]
+        if stopped is not None:
+            waits.append(asyncio.ensure_future(stopped.wait()))
+        try:
+            await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            if not self.cancel(queue_name, grant):
+                self.release(queue_name)
+            raise
+        finally:
+            for wait in waits[1:]:
+                wait.cancel()
+        if granted.done():
+            return True
+        if not self.cancel(queue_name, grant):
+            self.release(queue_name)
+        return False
+
+    @contextlib.contextmanager
+    def slot(self, queue_name):
+        """
+        Hold a slot of the queue for the duration of a with block.
+        """
+        self.acquire(queue_name)
+        try:
+            yield
+        finally:
+            self.release(queue_name)
+
+    @contextlib.asynccontextmanager
+    async def aio_slot(self, queue_name):
+        """
+        Hold a slot of the queue for the duration of an async with block,
+        without blocking the event loop while waiting for it.
+        """
+        await self.aio_acquire(queue_name)
+        try:
+            yield
+        finally:
+            self.release(queue_name)
@@ -5,8 +5,28 @@ MANAGER_CONFIG_DEFAULTS = {
     'POLL_TIME': 10,
     'REQUESTS_TIMEOUT': 1,
     'POLL_INTERVAL': 1,
+    'MAX_POLL_INTERVAL': 30,
     'LOGIN_POLL_INTERVAL': 5,
-    'FOLLOW_CLIENT_REDIRECTS': False
+    'FOLLOW_CLIENT_REDIRECTS': False,
+    'GRADING_THREADS': None,
+    'GRADING_SLOTS': None,
+    'ADMISSION': False,
+    'ADMISSION_MEMORY_MB': None,
+    'ADMISSION_CPUS': None,
+    'ADMISSION_RESERVE_MB': 512,
+    'PULL_TIMEOUT': 60,
+    'OUTBOX': None,
+    'OUTBOX_MAX_MB': 100,
+    'DRAIN_TIMEOUT': 300,
+    'METRICS_PORT': None,
+    'METRICS_HOST': '127.0.0.1',
+    'RESTART_BACKOFF': 1,
+    'RESTART_MAX_BACKOFF': 300,
+    'AUTOSCALE_INTERVAL': 30,
+    'AUTOSCALE_TARGET_LATENCY': 60,
+    'AUTOSCALE_COOLDOWN': 120,
+    'AUTOSCALE_MAX_LOAD': 1.5,
+    'AUTOSCALE_MIN_FREE_MB': 512,
 }
 
 
@@ -0,0 +1,23 @@
+"""
+SQLite databases shared by the threads and processes of a grading server.
+"""
+import contextlib
+import sqlite3
+
+
+@contextlib.contextmanager
+def connect(path, wal=False):
+    """
+    Open the database at `path` in autocommit mode for a with block.
+
+    A connection per use keeps a database safe across threads and forks.
+    With `wal`, the database is switched to write-ahead logging first, so
+    that readers do not block the writer; the mode sticks to the file.
+    """
+    db = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        if wal:
+            db.execute('PRAGMA journal_mode=WAL')
+        yield db
+    finally:
+        db.close()
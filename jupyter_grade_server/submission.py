@@ -0,0 +1,82 @@
+"""
+The XQueue submission envelope, decoded once where it enters the client.
+"""
+import functools
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    loads = orjson.loads
+    # Accept the results json.dumps accepts, and numpy scalars
+    DUMPS_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(obj):
+        try:
+            return orjson.dumps(obj, option=DUMPS_OPTIONS).decode()
+        except TypeError:
+            # What orjson does not support, such as integers above 64 bits
+            return json.dumps(obj)
+else:
+    loads = json.loads
+    dumps = json.dumps
+
+
+class Submission(dict):
+    """
+    A submission pulled from XQueue.
+
+    As a dict it holds the envelope as XQueue sends it, with the JSON
+    encoded strings 'xqueue_header', 'xqueue_body' and 'xqueue_files', so
+    handlers written for plain dicts keep working.  The decoded body, files
+    and grader payload are available as attributes, each decoded at most
+    once.
+
+    `admission` holds the admission.Ticket of the job, if admission control
+    is enabled, and `pulled_at` the time.monotonic() it was pulled at.
+    """
+    admission = None
+    pulled_at = None
+
+    @classmethod
+    def parse(cls, content):
+        """
+        Return a Submission from the JSON string XQueue returns as content.
+        """
+        if isinstance(content, cls):
+            return content
+        if isinstance(content, (str, bytes)):
+            content = loads(content)
+        return cls(content)
+
+    @property
+    def header(self):
+        """
+        The header as sent by XQueue, to be returned with the reply.
+        """
+        return self['xqueue_header']
+
+    @functools.cached_property
+    def body(self):
+        body = self['xqueue_body']
+        return loads(body) if isinstance(body, (str, bytes)) else body
+
+    @functools.cached_property
+    def files(self):
+        files = self.get('xqueue_files') or '{}'
+        return loads(files) if isinstance(files, (str, bytes)) else files
+
+    @functools.cached_property
+    def grader_payload(self):
+        payload = self.body['grader_payload']
+        return loads(payload) if isinstance(payload, (str, bytes)) else payload
+
+    def reply(self, result):
+        """
+        Return the put_result form data for a handler result.
+        """
+        return {'xqueue_body': dumps(result),
+                'xqueue_header': self.header}
@@ -0,0 +1,277 @@
+"""
+A pool of pre-forked, long-lived grading worker processes.
+
+Workers are started once, pre-import the grading modules and then receive
+jobs over a pipe.  A worker is recycled after a number of jobs or when its
+resident memory grows past a limit so that leaks stay isolated.
+"""
+import concurrent.futures
+import importlib
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PRELOAD = ('jupyter_grade_server.nbgrader',)
+
+
+class WorkerError(RuntimeError):
+    """
+    Raised when a worker process dies before returning a result.
+    """
+
+
+def rss_mb():
+    """
+    Return the resident set size of the current process in MB.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, IndexError):
+        import resource
+        # Peak RSS in KB on Linux, the best available approximation
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _worker_main(conn, target, preload, initializer, finalizer, threads):
+    for mod_name in preload:
+        try:
+            importlib.import_module(mod_name)
+        except ImportError:
+            log.exception('worker could not preload %s', mod_name)
+    if initializer is not None:
+        initializer()
+
+    send_lock = threading.Lock()
+
+    def run(job_id, args, kwargs):
+        try:
+            ok, value = True, target(*args, **kwargs)
+        except Exception as e:
+            ok, value = False, e
+        with send_lock:
+            try:
+                conn.send((job_id, ok, value, rss_mb()))
+            except Exception as e:
+                # The result or exception could not be pickled
+                conn.send((job_id, False, WorkerError(f'unpicklable result: {value!r} ({e!r})'), rss_mb()))
+
+    executor = None
+    if threads > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(threads)
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+        if executor is None:
+            run(*job)
+        else:
+            executor.submit(run, *job)
+    if executor is not None:
+        executor.shutdown(wait=True)
+    conn.close()
+    if finalizer is not None:
+        finalizer()
+
+
+class _Worker:
+    def __init__(self, target, preload, initializer, finalizer, threads, name):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_worker_main,
+            args=(child_conn, target, preload, initializer, finalizer, threads),
+            name=name,
+            daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+        self.active = 0
+        self.rss_mb = 0
+        self.retiring = False
+        self.dead = False
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read, name=f'{name}-reader', daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        while True:
+            try:
+                job_id, ok, value, self.rss_mb = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                future = self._pending.pop(job_id)
+            future.set_result((ok, value))
+        with self._lock:
+            self.dead = True
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(WorkerError(f'worker {self.process.pid} died '
+                                             f'(exitcode={self.process.exitcode})'))
+
+    def run(self, args, kwargs):
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self.dead:
+                raise WorkerError(f'worker {self.process.pid} is not running')
+            self.jobs += 1
+            self._pending[self.jobs] = future
+            try:
+                self.conn.send((self.jobs, args, kwargs))
+            except OSError as e:
+                del self._pending[self.jobs]
+                raise WorkerError(f'worker {self.process.pid} is not running') from e
+        return future.result()
+
+    def stop(self, timeout=5):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self._reader.join(timeout)
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    Run `target(*args, **kwargs)` in a pool of warm worker processes.
+
+    size = number of worker processes
+    threads = number of jobs each worker runs concurrently
+    max_jobs = recycle a worker after this many jobs (None for no limit)
+    max_rss_mb = recycle a worker once its RSS exceeds this many MB
+    preload = modules each worker imports before accepting jobs
+    initializer = callable run in each worker before accepting jobs
+    finalizer = callable run in each worker when it is stopped
+    """
+    def __init__(self, target, size=1, threads=1, max_jobs=None, max_rss_mb=None,
+                 preload=DEFAULT_PRELOAD, initializer=None, finalizer=None,
+                 name='grading-worker'):
+        self.target = target
+        self.size = size
+        self.threads = max(1, threads)
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.preload = tuple(preload)
+        self.initializer = initializer
+        self.finalizer = finalizer
+        self.name = name
+        # One entry per free job slot of a worker
+        self._slots = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self.started = False
+        self.recycled = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name}, size={self.size})'
+
+    def busy(self):
+        """
+        Number of jobs running in the workers.
+        """
+        with self._lock:
+            return sum(worker.active for worker in self._workers)
+
+    def _spawn(self):
+        worker = _Worker(self.target, self.preload, self.initializer,
+                         self.finalizer, self.threads, self.name)
+        with self._lock:
+            self._workers.append(worker)
+        for _ in range(self.threads):
+            self._slots.put(worker)
+        return worker
+
+    def _replace(self, worker):
+        with self._lock:
+            if worker.retiring:
+                return False
+            worker.retiring = True
+        self._spawn()
+        return True
+
+    def _release(self, worker):
+        with self._lock:
+            worker.active -= 1
+            stop = worker.retiring and worker.active == 0
+            if stop and worker in self._workers:
+                self._workers.remove(worker)
+        if stop:
+            worker.stop()
+        elif not worker.retiring:
+            self._slots.put(worker)
+
+    def start(self):
+        """
+        Fork the worker processes.  Called automatically by `submit`.
+        """
+        with self._lock:
+            if self.started:
+                return
+            self.started = True
+        for _ in range(self.size):
+            self._spawn()
+        log.info('started %r', self)
+
+    def _needs_recycle(self, worker):
+        if not worker.process.is_alive():
+            return True
+        if self.max_jobs and worker.jobs >= self.max_jobs:
+            return True
+        if self.max_rss_mb and worker.rss_mb >= self.max_rss_mb:
+            return True
+        return False
+
+    def submit(self, *args, **kwargs):
+        """
+        Run one job in a worker with a free slot, blocking until it finishes.
+
+        Exceptions raised by the target are re-raised here.
+        """
+        if not self.started:
+            self.start()
+        while True:
+            worker = self._slots.get()
+            with self._lock:
+                # Slots of recycled workers are dropped as they come up
+                if not worker.retiring:
+                    worker.active += 1
+                    break
+        try:
+            ok, value = worker.run(args, kwargs)
+            if self._needs_recycle(worker) and self._replace(worker):
+                log.info('recycling worker %s after %d jobs (%.0f MB)',
+                         worker.process.pid, worker.jobs, worker.rss_mb)
+                self.recycled += 1
+        except WorkerError:
+            self._replace(worker)
+            raise
+        finally:
+            self._release(worker)
+        if not ok:
+            raise value
+        return value
+
+    def shutdown(self):
+        """
+        Stop all worker processes.
+        """
+        with self._lock:
+            workers, self._workers = self._workers, []
+            self.started = False
+            self._slots = queue.Queue()
+        for worker in workers:
+            worker.stop()
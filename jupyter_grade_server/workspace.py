@@ -0,0 +1,137 @@
+"""
+Grading workspaces: per-submission copies of the nbgrader course layout.
+"""
+import collections
+import logging
+import queue
+import tempfile
+import threading
+from path import Path
+
+log = logging.getLogger(__name__)
+
+# Entries linked to the shared course files, kept when a workspace is scrubbed
+LINKED = ('nbgrader_config.py', 'source', 'release')
+
+
+def prepare_workspace(workspace, relocate, prob_name):
+    """
+    Lay out an empty nbgrader course root for grading one problem.
+    """
+    workspace = Path(workspace)
+    # Make location for the submitted file
+    (workspace / 'submitted' / 'student' / prob_name).makedirs_p()
+    # Copy template database: autograding reads the released cells from it
+    # and records the submission and its grades in it
+    (relocate / 'gradebook.db').copy(workspace / 'gradebook.db')
+    # Symlink grader files
+    for name in LINKED:
+        if not (workspace / name).islink():
+            (relocate / name).symlink(workspace / name)
+
+
+def scrub_workspace(workspace):
+    """
+    Remove everything a grading run left behind, keeping the links.
+    """
+    for entry in Path(workspace).listdir():
+        if entry.basename() in LINKED and entry.islink():
+            continue
+        if entry.islink() or not entry.isdir():
+            entry.remove()
+        else:
+            entry.rmtree()
+
+
+class WorkspacePool:
+    """
+    Keep `size` ready-to-use workspaces per problem.
+
+    Workspaces are handed out by `acquire` and returned with `release`; a
+    background thread scrubs returned workspaces and tops the pool up, so
+    the filesystem work stays off the grading path.
+
+    relocate = directory holding gradebook.db, nbgrader_config.py, source
+               and release
+    root = directory to create workspaces in, e.g. a tmpfs like /dev/shm
+           (defaults to the system temp directory)
+    """
+    def __init__(self, relocate, size=2, root=None, prefix='notebook-grader-'):
+        self.relocate = Path(relocate)
+        self.size = size
+        self.root = root
+        self.prefix = prefix
+        self._ready = collections.defaultdict(list)
+        self._lock = threading.Lock()
+        self._tasks = queue.Queue()
+        self._thread = threading.Thread(target=self._work, name='workspace-pool', daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.relocate}, size={self.size})'
+
+    def _new(self, prob_name):
+        workspace = Path(tempfile.mkdtemp(prefix=self.prefix, dir=self.root))
+        prepare_workspace(workspace, self.relocate, prob_name)
+        return workspace
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            try:
+                task()
+            except Exception:
+                log.exception('workspace pool task failed')
+            finally:
+                self._tasks.task_done()
+
+    def _refill(self, prob_name):
+        with self._lock:
+            missing = self.size - len(self._ready[prob_name])
+        for _ in range(missing):
+            workspace = self._new(prob_name)
+            with self._lock:
+                self._ready[prob_name].append(workspace)
+
+    def _recycle(self, prob_name, workspace):
+        with self._lock:
+            keep = len(self._ready[prob_name]) < self.size
+        if not keep:
+            workspace.rmtree_p()
+            return
+        scrub_workspace(workspace)
+        prepare_workspace(workspace, self.relocate, prob_name)
+        with self._lock:
+            self._ready[prob_name].append(workspace)
+
+    def acquire(self, prob_name):
+        """
+        Return a prepared workspace for a problem.
+        """
+        with self._lock:
+            ready = self._ready[prob_name]
+            workspace = ready.pop() if ready else None
+        if workspace is None:
+            workspace = self._new(prob_name)
+            self._tasks.put(lambda: self._refill(prob_name))
+        return workspace
+
+    def release(self, prob_name, workspace):
+        """
+        Give a workspace back to be scrubbed and reused.
+        """
+        self._tasks.put(lambda: self._recycle(prob_name, Path(workspace)))
+
+    def close(self):
+        """
+        Stop the background thread and delete all idle workspaces.
+        """
+        self._tasks.put(None)
+        self._thread.join()
+        with self._lock:
+            ready, self._ready = self._ready, collections.defaultdict(list)
+        for workspaces in ready.values():
+            for workspace in workspaces:
+                workspace.rmtree_p()
@@ -0,0 +1,90 @@
+"""
+A minimal XQueue server for client tests.
+"""
+import http.server
+import json
+import threading
+import urllib.parse
+
+
+class FakeXQueueHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, content, return_code=0):
+        body = json.dumps({'return_code': return_code, 'content': content}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        if self.path.startswith('/xqueue/get_submission/'):
+            with server.lock:
+                submission = server.submissions.pop(0) if server.submissions else None
+            if submission is not None:
+                self.reply(json.dumps(submission))
+            else:
+                self.reply('Queue is empty', return_code=1)
+        elif self.path.startswith('/xqueue/get_queuelen/'):
+            with server.lock:
+                self.reply(len(server.submissions))
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers['Content-Length'])
+        data = urllib.parse.parse_qs(self.rfile.read(length).decode())
+        if self.path == '/xqueue/login/':
+            with server.lock:
+                server.logins += 1
+            self.reply('Logged in')
+        elif self.path == '/xqueue/put_result/':
+            with server.lock:
+                if server.fail_posts:
+                    server.fail_posts -= 1
+                    self.send_response(500)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                server.results.append(data)
+                if len(server.results) >= server.expected:
+                    server.done.set()
+            self.reply('')
+
+
+class FakeXQueue(http.server.ThreadingHTTPServer):
+    """
+    Serves `submissions` and collects posted results, setting `done` once
+    `expected` results have arrived.
+    """
+    def __init__(self, submissions=(), expected=1):
+        super().__init__(('127.0.0.1', 0), FakeXQueueHandler)
+        self.submissions = list(submissions)
+        self.results = []
+        self.logins = 0
+        # Number of put_result requests to fail before accepting results
+        self.fail_posts = 0
+        self.expected = expected
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f'http://{host}:{port}'
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+def submission(i):
+    return {
+        'xqueue_header': json.dumps({'id': i}),
+        'xqueue_body': json.dumps({'grader_payload': '{}'}),
+        'xqueue_files': '{}',
+    }
@@ -0,0 +1,29 @@
+"""
+A handler grading in a worker pool, like a Grader with worker_pool_size,
+for manager tests.
+"""
+import time
+
+from jupyter_grade_server.workerpool import WorkerPool
+
+
+def grade(content):
+    return {'correct': True, 'score': 1, 'msg': ''}
+
+
+class PoolHandler:
+    def __init__(self, size=1):
+        self.worker_pool = WorkerPool(grade, size=size, preload=())
+        self.worker_pool.start()
+        self.processes = [worker.process for worker in self.worker_pool._workers]
+
+    def __call__(self, content):
+        return self.worker_pool.submit(dict(content))
+
+    def close(self):
+        self.worker_pool.shutdown()
+
+
+def slow_grade(content):
+    time.sleep(0.5)
+    return grade(content)
@@ -0,0 +1,136 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+import unittest.mock
+
+from jupyter_grade_server import admission, client
+from jupyter_grade_server.admission import AdmissionController, Budget
+from tests.fixtures.fake_xqueue import FakeXQueue, submission
+
+
+class AdmissionTests(unittest.TestCase):
+    def setUp(self):
+        # Plenty of host memory, so that only the budgets decide
+        patcher = unittest.mock.patch.object(admission, 'host_headroom',
+                                             return_value=(0.1, 64 * 1024))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_admits_within_memory(self):
+        controller = AdmissionController(memory_mb=3000, cpus=8)
+        controller.configure('q', default={'RSS_MB': 1000})
+        tickets = [controller.acquire('q') for i in range(3)]
+        self.assertIsNone(controller.acquire('q', running=lambda: False))
+        tickets[0].release()
+        self.assertIsNotNone(controller.acquire('q', running=lambda: False))
+
+    def test_admits_within_cpus(self):
+        controller = AdmissionController(memory_mb=10000, cpus=2)
+        controller.configure('q', default=Budget(100, 1))
+        controller.acquire('q')
+        controller.acquire('q')
+        self.assertIsNone(controller.acquire('q', running=lambda: False))
+
+    def test_always_admits_one_job(self):
+        controller = AdmissionController(memory_mb=1000, cpus=1)
+        controller.configure('q', default={'RSS_MB': 5000, 'CPUS': 4})
+        self.assertIsNotNone(controller.acquire('q'))
+
+    def test_problem_budget_replaces_queue_budget(self):
+        controller = AdmissionController(memory_mb=3000, cpus=8)
+        controller.configure('q', default={'RSS_MB': 500},
+                             problems={'big': {'RSS_MB': 2000}, 'small': {'RSS_MB': 200}})
+        ticket = controller.acquire('q')
+        self.assertEqual(ticket.budget.rss_mb, 2000)
+        ticket.assign('small')
+        self.assertEqual(ticket.budget, Budget(200, 1))
+        ticket.assign('other')
+        self.assertEqual(ticket.budget, Budget(500, 1))
+
+    def test_learns_budgets(self):
+        controller = AdmissionController(memory_mb=3000, cpus=8, margin=1)
+        controller.configure('q')
+        ticket = controller.acquire('q')
+        self.assertEqual(ticket.budget, admission.DEFAULT_BUDGET)
+        ticket.assign('p')
+        ticket.record(rss_mb=400, cpu_seconds=5, seconds=10)
+        ticket.release()
+        self.assertEqual(controller.budget('q', 'p'), Budget(400, 0.5))
+        self.assertEqual(controller.budget('q'), Budget(400, 0.5))
+        controller.record('q', 'p', 800, 10, 10)
+        budget = controller.budget('q', 'p')
+        self.assertAlmostEqual(budget.rss_mb, 520)
+        self.assertAlmostEqual(budget.cpus, 0.65)
+
+    def test_waiter_is_woken_by_release(self):
+        controller = AdmissionController(memory_mb=1000, cpus=8)
+        controller.configure('q', default={'RSS_MB': 1000})
+        first = controller.acquire('q')
+        admitted = []
+        waiter = threading.Thread(target=lambda: admitted.append(controller.acquire('q', poll=10)))
+        waiter.start()
+        time.sleep(0.1)
+        self.assertEqual(admitted, [])
+        first.release()
+        waiter.join(5)
+        self.assertEqual(len(admitted), 1)
+
+    def test_usage(self):
+        # Stands in for a kernel: allocates 64 MB and spins once told to
+        kernel = subprocess.Popen(
+            [sys.executable, '-c', 'import sys, time\n'
+             'sys.stdin.readline()\n'
+             'data = bytearray(64 * 2**20)\n'
+             'start = time.process_time()\n'
+             'while time.process_time() - start < 0.3: pass\n'
+             'print(flush=True)\n'
+             'sys.stdin.readline()\n'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        self.addCleanup(kernel.wait)
+        self.addCleanup(kernel.stdin.close)
+        with admission.Usage() as usage:
+            admission.Usage.sample(kernel.pid)
+            kernel.stdin.write('\n')
+            kernel.stdin.flush()
+            kernel.stdout.readline()
+            admission.Usage.sample(kernel.pid)
+        self.assertGreaterEqual(usage.result['rss_mb'], 64)
+        self.assertGreaterEqual(usage.result['cpu_seconds'], 0.25)
+        self.assertGreater(usage.result['seconds'], 0)
+
+    def test_usage_without_kernels(self):
+        with admission.Usage() as usage:
+            sum(range(100000))
+            admission.Usage.sample(None)
+        self.assertIsNone(usage.result)
+        # Nothing is measured once the job is graded
+        admission.Usage.sample(os.getpid())
+        self.assertEqual(usage.kernels, {})
+
+    def test_client_waits_before_pulling(self):
+        server = FakeXQueue([submission(i) for i in range(3)], expected=3)
+        self.addCleanup(server.close)
+        controller = AdmissionController(memory_mb=1000, cpus=8)
+        controller.configure('test', default={'RSS_MB': 1000})
+        blocker = controller.acquire('other')
+        tickets = []
+
+        def handler(content):
+            tickets.append(content.admission)
+            return {'correct': True, 'score': 1, 'msg': 'ok'}
+
+        c = client.XQueueClientThread('test', xqueue_server=server.url,
+                                      xqueue_auth=('lms', 'lms'), poll_interval=0.05,
+                                      admission=controller)
+        c.add_handler(handler)
+        self.addCleanup(c.shutdown)
+        c.start()
+        time.sleep(0.3)
+        self.assertEqual(len(server.submissions), 3)
+        blocker.release()
+        self.assertTrue(server.done.wait(5))
+        self.assertEqual(len(tickets), 3)
+        self.assertTrue(all(ticket.queue_name == 'test' for ticket in tickets))
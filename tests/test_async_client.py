@@ -0,0 +1,108 @@
+import json
+import threading
+import time
+import unittest
+
+from jupyter_grade_server import client
+from tests.fixtures.fake_xqueue import FakeXQueue, submission
+
+
+@unittest.skipIf(client.aiohttp is None, 'aiohttp is not installed')
+class AsyncClientTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeXQueue([submission(1)])
+        self.addCleanup(self.server.close)
+        self.client = client.XQueueClientAsync(
+            'test', xqueue_server=self.server.url, xqueue_auth=('lms', 'lms'),
+            poll_interval=0.05)
+
+    def test_grade_submission(self):
+        self.client.add_handler(lambda content: {'correct': True, 'score': 1, 'msg': 'ok'})
+        self.client.start()
+        self.assertTrue(self.server.done.wait(5))
+        self.client.shutdown()
+        self.assertTrue(self.client.join(5))
+        self.assertFalse(self.client.is_alive())
+        result, = self.server.results
+        self.assertEqual(json.loads(result['xqueue_body'][0])['score'], 1)
+        self.assertEqual(result['xqueue_header'], [json.dumps({'id': 1})])
+
+    def post_in_background(self, retries):
+        c = client.XQueueClientAsync(
+            'test', xqueue_server=self.server.url, xqueue_auth=('lms', 'lms'),
+            poll_interval=0.05, post_threads=1, post_retries=retries)
+        c.add_handler(lambda content: {'correct': True, 'score': 1, 'msg': 'ok'})
+        self.server.fail_posts = 1
+        c.start()
+        return c
+
+    def test_background_posts_are_retried(self):
+        c = self.post_in_background(retries=2)
+        self.assertTrue(self.server.done.wait(5))
+        c.shutdown()
+        self.assertTrue(c.join(5))
+        self.assertEqual(len(self.server.results), 1)
+        self.assertEqual(c.in_flight(), 0)
+
+    def test_background_posts_give_up_after_post_retries(self):
+        c = self.post_in_background(retries=1)
+        deadline = time.monotonic() + 5
+        while self.server.fail_posts and time.monotonic() < deadline:
+            time.sleep(0.01)
+        c.shutdown()
+        self.assertTrue(c.join(5))
+        self.assertEqual(self.server.results, [])
+        self.assertEqual(c.in_flight(), 0)
+
+    def test_workers_grade_at_once_and_count_in_flight(self):
+        self.server.submissions.append(submission(2))
+        self.server.expected = 2
+        started = threading.Semaphore(0)
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def handler(content):
+            started.release()
+            release.wait(5)
+            return {'correct': True, 'score': 1, 'msg': 'ok'}
+
+        c = client.XQueueClientAsync(
+            'test', xqueue_server=self.server.url, xqueue_auth=('lms', 'lms'),
+            poll_interval=0.05, workers=2)
+        c.add_handler(handler)
+        c.start()
+        for _ in range(2):
+            self.assertTrue(started.acquire(timeout=5))
+        self.assertEqual(c.in_flight(), 2)
+        release.set()
+        self.assertTrue(self.server.done.wait(5))
+        c.shutdown()
+        self.assertTrue(c.join(5))
+        self.assertEqual(c.in_flight(), 0)
+
+    def test_parse_response(self):
+        response = client._AsyncResponse('http://xqueue', 200, b'{"return_code": 0, "content": "hi"}')
+        self.assertEqual(self.client._parse_response(response), (True, 'hi'))
+        response = client._AsyncResponse('http://xqueue', 200, b'not json')
+        self.assertEqual(self.client._parse_response(response), (False, 'Could not parse xreply.'))
+
+    def test_clients_share_one_session_and_login(self):
+        session = client.SharedSession()
+        clients = [client.XQueueClientAsync('test', xqueue_server=self.server.url,
+                                            xqueue_auth=('lms', 'lms'), poll_interval=0.05,
+                                            session=session)
+                   for _ in range(3)]
+        for c in clients:
+            c.add_handler(lambda content: {'correct': True, 'score': 1, 'msg': 'ok'})
+            c.start()
+        self.assertTrue(self.server.done.wait(5))
+        deadline = time.monotonic() + 5
+        while session.aio_refs < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual({id(c.aio_session) for c in clients}, {id(session.aio_session)})
+        self.assertEqual(self.server.logins, 1)
+        for c in clients:
+            c.shutdown()
+            c.join(5)
+        self.assertEqual(session.aio_refs, 0)
+        self.assertIsNone(session.aio_session)
@@ -0,0 +1,118 @@
+import unittest
+
+from jupyter_grade_server import autoscaler, client
+from tests.fixtures.fake_xqueue import FakeXQueue, submission
+from tests.test_reload import manager, wait_for
+
+
+class AutoscalerTests(unittest.TestCase):
+    def make_scaler(self, **kwargs):
+        kwargs.setdefault('target_latency', 60)
+        kwargs.setdefault('cooldown', 100)
+        return autoscaler.Autoscaler(1, 8, **kwargs)
+
+    def test_grows_with_backlog(self):
+        scaler = self.make_scaler()
+        scaler.grade_time = 30
+        self.assertEqual(scaler.desired(1, 2, now=0), 1)
+        self.assertEqual(scaler.desired(1, 10, now=1), 5)
+        self.assertEqual(scaler.desired(5, 100, now=2), 8)
+
+    def test_unknown_grade_time_plans_a_client_per_submission(self):
+        scaler = self.make_scaler()
+        self.assertEqual(scaler.desired(1, 3, now=0), 3)
+
+    def test_shrinks_one_at_a_time_after_cooldown(self):
+        scaler = self.make_scaler()
+        scaler.grade_time = 30
+        self.assertEqual(scaler.desired(1, 10, now=0), 5)
+        self.assertEqual(scaler.desired(5, 0, now=50), 5)
+        self.assertEqual(scaler.desired(5, 0, now=100), 4)
+        self.assertEqual(scaler.desired(4, 0, now=150), 4)
+        self.assertEqual(scaler.desired(4, 0, now=200), 3)
+
+    def test_hysteresis(self):
+        scaler = self.make_scaler()
+        scaler.grade_time = 30
+        # 2 clients would do for 4 submissions, but 3 would be more than half busy
+        self.assertEqual(scaler.desired(4, 4, now=1000), 4)
+        self.assertEqual(scaler.desired(4, 3, now=1000), 3)
+
+    def test_headroom(self):
+        scaler = self.make_scaler(max_load=1.5, min_free_mb=512)
+        scaler.grade_time = 30
+        self.assertEqual(scaler.desired(2, 10, load=2.0, free_mb=4096, now=0), 2)
+        self.assertEqual(scaler.desired(2, 10, load=0.5, free_mb=100, now=0), 1)
+        self.assertEqual(scaler.desired(1, 10, load=0.5, free_mb=100, now=10), 1)
+
+    def test_bounds(self):
+        scaler = autoscaler.Autoscaler(2, 4)
+        self.assertEqual(scaler.clamp(0), 2)
+        self.assertEqual(scaler.clamp(10), 4)
+        self.assertEqual(scaler.desired(0, 0, now=0), 2)
+
+    def test_host_headroom(self):
+        load, free_mb = autoscaler.host_headroom()
+        for value in (load, free_mb):
+            self.assertTrue(value is None or value >= 0)
+
+    def test_get_queuelen(self):
+        server = FakeXQueue([submission(i) for i in range(3)])
+        self.addCleanup(server.close)
+        c = client.XQueueClient('test', xqueue_server=server.url, xqueue_auth=('lms', 'lms'))
+        self.assertEqual(c.get_queuelen(), 3)
+        c = client.XQueueClient('test', xqueue_server='http://127.0.0.1:9',
+                                xqueue_auth=('lms', 'lms'))
+        self.assertIsNone(c.get_queuelen())
+
+
+@unittest.skipIf(manager is None, 'requires codejail')
+class ManagerAutoscaleTests(unittest.TestCase):
+    def test_shrink_stops_the_worker_pools_of_the_retired_client(self):
+        server = FakeXQueue()
+        self.addCleanup(server.close)
+        m = manager.Manager()
+        m.manager_config.update(POLL_INTERVAL=0.05, MAX_POLL_INTERVAL=0.05, AUTOSCALE_COOLDOWN=0,
+                                AUTOSCALE_MAX_LOAD=None, AUTOSCALE_MIN_FREE_MB=None)
+        m.configure({'q': {
+            'SERVER': server.url,
+            'AUTH': ['lms', 'lms'],
+            'CONNECTIONS': 2,
+            'MIN_CONNECTIONS': 1,
+            'MAX_CONNECTIONS': 3,
+            'HANDLERS': [{'HANDLER': 'tests.fixtures.pool_handler.PoolHandler'}],
+        }})
+        m.start()
+        self.addCleanup(m.drain, 5)
+        clients = list(m.queue_clients['q'])
+        m.autoscale()
+        self.assertEqual(len(m.queue_clients['q']), 1)
+        retired, = [c for c in clients if c not in m.queue_clients['q']]
+        kept, = m.queue_clients['q']
+        wait_for(lambda: not any(p.is_alive() for p in retired.handlers[0].processes))
+        self.assertTrue(all(p.is_alive() for p in kept.handlers[0].processes))
+
+    def test_queue_that_cannot_grow_does_not_stop_the_others(self):
+        server = FakeXQueue()
+        self.addCleanup(server.close)
+        m = manager.Manager()
+        m.manager_config.update(POLL_INTERVAL=0.05, MAX_POLL_INTERVAL=0.05)
+        config = {'SERVER': server.url, 'AUTH': ['lms', 'lms'], 'MAX_CONNECTIONS': 3,
+                  'HANDLERS': [{'HANDLER': 'tests.fixtures.pool_handler.grade'}]}
+        m.configure({'q': config, 'r': config})
+        m.start()
+        self.addCleanup(m.drain, 5)
+        for scaler in m.autoscalers.values():
+            scaler.desired = lambda *args: 2
+        client_from_config = m.client_from_config
+
+        def broken_q(queue_name, config):
+            if queue_name == 'q':
+                raise ImportError('no_such')
+            return client_from_config(queue_name, config)
+
+        m.client_from_config = broken_q
+        with self.assertLogs(level='ERROR'):
+            m.autoscale()
+        self.assertEqual(len(m.queue_clients['q']), 1)
+        self.assertEqual(len(m.queue_clients['r']), 2)
@@ -0,0 +1,77 @@
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+from jupyter_grade_server import client, metrics
+from tests.fixtures.fake_xqueue import FakeXQueue, submission
+
+
+class MetricsTests(unittest.TestCase):
+    def test_render(self):
+        counter = metrics.Counter('jobs_total', 'Jobs')
+        counter.inc(queue='a')
+        counter.inc(2, queue='a')
+        counter.inc(queue='b"')
+        gauge = metrics.Gauge('depth', 'Depth', [({}, 1.5)])
+        self.assertEqual(metrics.render([counter, gauge]),
+                         '# HELP jobs_total Jobs\n'
+                         '# TYPE jobs_total counter\n'
+                         'jobs_total{queue="a"} 3\n'
+                         'jobs_total{queue="b\\""} 1\n'
+                         '# HELP depth Depth\n'
+                         '# TYPE depth gauge\n'
+                         'depth 1.5\n')
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('seconds', 'Seconds', buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value, queue='q')
+        samples = {(name, dict(labels).get('le')): value
+                   for name, labels, value in histogram.samples()}
+        self.assertEqual(samples[('seconds_bucket', '1')], 2)
+        self.assertEqual(samples[('seconds_bucket', '5')], 3)
+        self.assertEqual(samples[('seconds_bucket', '+Inf')], 4)
+        self.assertEqual(samples[('seconds_count', None)], 4)
+        self.assertEqual(samples[('seconds_sum', None)], 14.5)
+
+    def test_server(self):
+        problems = []
+        server = metrics.MetricsServer(
+            0, lambda: [metrics.Gauge('xqueue_clients_up', 'Up', [({'queue': 'q'}, 2)])],
+            lambda: problems, host='127.0.0.1')
+        self.addCleanup(server.close)
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+        with urllib.request.urlopen(url + '/metrics') as response:
+            body = response.read().decode()
+            self.assertIn('version=0.0.4', response.headers['Content-Type'])
+        self.assertIn('xqueue_clients_up{queue="q"} 2\n', body)
+        self.assertIn('# TYPE xqueue_grading_seconds histogram', body)
+        with urllib.request.urlopen(url + '/healthz') as response:
+            self.assertEqual(response.status, 200)
+        problems.append('draining')
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + '/healthz')
+        self.assertEqual(error.exception.code, 503)
+        self.assertEqual(error.exception.read(), b'draining\n')
+
+    def test_client_records_grades(self):
+        server = FakeXQueue([submission(i) for i in range(2)], expected=2)
+        self.addCleanup(server.close)
+        c = client.XQueueClientThread('metrics-test', xqueue_server=server.url,
+                                      xqueue_auth=('lms', 'lms'), poll_interval=0.05)
+        c.add_handler(lambda content: {'correct': True, 'score': 1, 'msg': 'ok'})
+        self.addCleanup(c.shutdown)
+        c.start()
+        self.assertTrue(server.done.wait(5))
+        deadline = time.monotonic() + 5
+        labels = (('queue', 'metrics-test'),)
+        while time.monotonic() < deadline:
+            graded = dict((key, value) for _, key, value in metrics.GRADED.samples())
+            if graded.get(labels) == 2:
+                break
+            time.sleep(0.05)
+        self.assertEqual(graded.get(labels), 2)
+        waits = [value for name, key, value in metrics.QUEUE_WAIT_SECONDS.samples()
+                 if name == 'xqueue_queue_wait_seconds_count' and key == labels]
+        self.assertEqual(waits, [2])
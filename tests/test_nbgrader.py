@@ -0,0 +1,317 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import nbformat
+from nbformat.v4 import new_code_cell, new_markdown_cell, new_notebook, new_output
+from path import Path
+
+from jupyter_grade_server import workspace
+
+try:
+    from jupyter_grade_server import nbgrader
+    from jupyter_grade_server.kernelpool import PreambleKernelPool
+except ImportError:
+    # Grading notebooks needs nbgrader
+    nbgrader = None
+
+COURSE = Path(__file__).dirname() / 'fixtures' / 'course'
+
+SOLUTION = 'def square(x):\n    return x * x'
+
+
+def release_course(root):
+    '''Copies the fixture course to root and releases lab1 into its gradebook.'''
+    COURSE.copytree(root)
+    subprocess.run([sys.executable, '-m', 'nbgrader', 'generate_assignment', 'lab1', '--force'],
+                   cwd=root, check=True, capture_output=True)
+
+
+def find_cell(nb, grade_id):
+    for cell in nb.cells:
+        if cell.metadata.get('nbgrader', {}).get('grade_id') == grade_id:
+            return cell
+    raise KeyError(grade_id)
+
+
+@unittest.skipIf(nbgrader is None, 'requires nbgrader')
+class ScoreTests(unittest.TestCase):
+    '''get_score() must agree with the gradebook nbgrader writes.'''
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.relocate = Path(cls.tmp.name) / 'relocate'
+        release_course(cls.relocate)
+        cls.engine = nbgrader.AutogradeEngine('lab1', cls.relocate)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def submission(self):
+        return nbformat.read(self.relocate / 'release' / 'lab1' / 'lab1.ipynb', as_version=4)
+
+    def autograde(self, nb):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        root = Path(tmp.name)
+        workspace.prepare_workspace(root, self.relocate, 'lab1')
+        path = root / 'submitted' / 'student' / 'lab1' / 'lab1.ipynb'
+        nbformat.write(nb, path)
+        self.engine.grade(path)
+        return root
+
+    def grade(self, nb):
+        root = self.autograde(nb)
+        score = nbgrader.get_score('lab1', root=root)
+        self.assertEqual(score, nbgrader.get_grade('lab1', root=root))
+        return score
+
+    def test_unchanged_solutions(self):
+        self.assertEqual(self.grade(self.submission()), (0, 6))
+
+    def test_solved(self):
+        nb = self.submission()
+        find_cell(nb, 'square').source = SOLUTION
+        self.assertEqual(self.grade(nb), (3, 6))
+
+    def test_errored_test_cell(self):
+        nb = self.submission()
+        find_cell(nb, 'square').source = 'def square(x):\n    return x * abs(x)'
+        self.assertEqual(self.grade(nb), (2, 6))
+
+    def test_deleted_grade_cell(self):
+        nb = self.submission()
+        find_cell(nb, 'square').source = SOLUTION
+        nb.cells.remove(find_cell(nb, 'test-1'))
+        self.assertEqual(self.grade(nb), (1, 6))
+
+    def test_manually_graded_code_cell(self):
+        nb = self.submission()
+        find_cell(nb, 'square').source = SOLUTION
+        find_cell(nb, 'answer').source = 'answer = 3'
+        # Counts towards the maximum, but is never scored by the autograder
+        self.assertEqual(self.grade(nb), (3, 6))
+
+    def test_submissions_do_not_share_state(self):
+        converters = []
+        resources = []
+        start = nbgrader.PooledAutograde.start
+        preprocess = nbgrader.PooledExecute.preprocess
+
+        def record_start(converter):
+            converters.append(converter)
+            return start(converter)
+
+        def record_preprocess(pp, nb, res, retries=None):
+            resources.append((pp, res))
+            return preprocess(pp, nb, res, retries)
+
+        solved = self.submission()
+        find_cell(solved, 'square').source = SOLUTION
+        with mock.patch.object(nbgrader.PooledAutograde, 'start', autospec=True,
+                               side_effect=record_start), \
+             mock.patch.object(nbgrader.PooledExecute, 'preprocess', autospec=True,
+                               side_effect=record_preprocess):
+            first = self.autograde(solved)
+            second = self.autograde(self.submission())
+
+        # The second grade sees nothing of the first
+        self.assertEqual(nbgrader.get_score('lab1', root=first), (3, 6))
+        self.assertEqual(nbgrader.get_score('lab1', root=second), (0, 6))
+        self.assertEqual(nbgrader.get_grade('lab1', root=second), (0, 6))
+        (first_pp, first_res), (second_pp, second_res) = resources
+        self.assertIsNot(first_pp, second_pp)
+        self.assertIsNot(first_res, second_res)
+        self.assertEqual(Path(first_res['metadata']['path']),
+                         first / 'autograded' / 'student' / 'lab1')
+        self.assertEqual(Path(second_res['metadata']['path']),
+                         second / 'autograded' / 'student' / 'lab1')
+        self.assertEqual([Path(c.coursedir.root) for c in converters], [first, second])
+        for converter in converters:
+            self.assertEqual(converter.coursedir.student_id, 'student')
+            self.assertEqual(converter.coursedir.assignment_id, 'lab1')
+        self.assertTrue({id(pp) for pp in converters[0].exporter._preprocessors}.isdisjoint(
+                        id(pp) for pp in converters[1].exporter._preprocessors))
+        # The engine's own course directory is left alone
+        self.assertEqual(Path(self.engine.app.coursedir.root), self.relocate)
+
+
+SETUP = """\
+import random
+with open('data.txt') as f:
+    DATA = f.read().strip()
+with open('made.txt', 'w') as f:
+    f.write(DATA)
+TOKEN = random.random()
+print(TOKEN)"""
+
+
+def notebook(setup=SETUP):
+    locked = {'nbgrader': {'grade_id': 'setup', 'locked': True, 'grade': False,
+                           'solution': False, 'schema_version': 3}}
+    return new_notebook(
+        cells=[new_code_cell(setup, metadata=locked),
+               new_code_cell('import os\nprint(TOKEN, os.getcwd())')],
+        metadata={'kernelspec': {'name': 'python3', 'display_name': 'Python 3'},
+                  'widgets': {'application/vnd.jupyter.widget-state+json': {'state': {}}}})
+
+
+def wait_for(predicate, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.05)
+
+
+@unittest.skipIf(nbgrader is None, 'requires nbgrader')
+class MatchSnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.execute = nbgrader.PooledExecute()
+        self.nb = new_notebook(cells=[
+            new_markdown_cell('# Lab'),
+            new_code_cell('a = 1'),
+            new_code_cell('  '),
+            new_code_cell('b = 2'),
+            new_code_cell('c = a + b')])
+        self.out = new_output('stream', name='stdout', text='1')
+
+    def test_match(self):
+        snapshot = [('a = 1', [self.out], 1), ('b = 2', [], 2)]
+        # Markdown and empty code cells are skipped
+        self.assertEqual(self.execute._match_snapshot(self.nb, snapshot),
+                         {1: ([self.out], 1), 3: ([], 2)})
+        self.assertEqual(self.execute._match_snapshot(self.nb, []), {})
+
+    def test_changed_source(self):
+        snapshot = [('a = 1', [], 1), ('b = 3', [], 2)]
+        self.assertIsNone(self.execute._match_snapshot(self.nb, snapshot))
+
+    def test_more_setup_cells_than_code_cells(self):
+        snapshot = [('a = 1', [], 1), ('b = 2', [], 2), ('c = a + b', [], 3), ('d = 4', [], 4)]
+        self.assertIsNone(self.execute._match_snapshot(self.nb, snapshot))
+
+
+@unittest.skipIf(nbgrader is None, 'requires nbgrader')
+class PooledExecuteTests(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.files = Path(tmp.name) / 'source'
+        self.files.mkdir()
+        (self.files / 'data.txt').write_text('data')
+        (self.files / 'lab1.ipynb').write_text('{}')
+        # Where nbgrader executes the submission, with the problem files copied
+        self.rundir = Path(tmp.name) / 'autograded'
+        self.rundir.mkdir()
+        (self.rundir / 'data.txt').write_text('data')
+
+    def execute(self, nb, cells):
+        pool = PreambleKernelPool(cells, size=1, files=self.files)
+        self.addCleanup(pool.shutdown)
+        wait_for(lambda: pool._ready.qsize())
+        checked_out = []
+
+        def checkout(*args, **kwargs):
+            checked_out.append(PreambleKernelPool.checkout(pool, *args, **kwargs))
+            return checked_out[-1]
+
+        pool.checkout = checkout
+        pp = nbgrader.PooledExecute()
+        pp.kernel_pool = pool
+        pp.preprocess(nb, {'metadata': {'path': str(self.rundir)}})
+        (km, snapshot), = checked_out
+        self.assertFalse(km.is_alive())
+        return snapshot
+
+    def test_reuses_snapshot(self):
+        nb = notebook()
+        snapshot = self.execute(nb, [SETUP])
+        (source, outputs, execution_count), = snapshot
+        # The setup cell was not run again: the kernel kept its state
+        self.assertEqual(nb.cells[0].outputs, outputs)
+        self.assertEqual(nb.cells[0].execution_count, execution_count)
+        token = outputs[0]['text'].strip()
+        self.assertEqual(nb.cells[1].outputs[0]['text'].split(),
+                         [token, str(self.rundir)])
+        # The setup cells ran next to a copy of the problem files, and what
+        # they wrote moved next to the submission
+        self.assertEqual((self.rundir / 'made.txt').read_text(), 'data')
+        self.assertFalse((self.rundir / 'lab1.ipynb').exists())
+        # Execute's notebook metadata is kept
+        self.assertEqual(nb.metadata['language_info']['name'], 'python')
+        self.assertNotIn('widgets', nb.metadata)
+
+    def test_changed_setup_cells_fall_back(self):
+        nb = notebook("TOKEN = 'fresh'")
+        self.execute(nb, ["TOKEN = 'pooled'"])
+        self.assertEqual(nb.cells[1].outputs[0]['text'].split(),
+                         ['fresh', str(self.rundir)])
+        self.assertEqual(nb.metadata['language_info']['name'], 'python')
+        self.assertNotIn('widgets', nb.metadata)
+
+
+@unittest.skipIf(nbgrader is None, 'requires nbgrader')
+class ReleaseInfoTests(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+        self.path = self.root / 'release' / 'lab1' / 'lab1.ipynb'
+        self.path.dirname().makedirs_p()
+        COURSE.joinpath('source', 'lab1', 'lab1.ipynb').copy(self.path)
+
+    def rewrite(self, nb):
+        # Move the modification time on, as a copy a second later would
+        mtime = self.path.stat().st_mtime_ns
+        nbformat.write(nb, self.path)
+        os.utime(self.path, ns=(mtime + 10**9, mtime + 10**9))
+
+    def test_cached_until_release_changes(self):
+        info = nbgrader.get_release_info(self.path)
+        self.assertIs(nbgrader.get_release_info(self.path), info)
+        self.assertEqual(list(info.missing_html), ['test-1', 'test-2', 'answer', 'explain'])
+        self.assertEqual(info.code_points, {'test-1': 2, 'test-2': 1, 'answer': 3})
+
+        nb = nbformat.read(self.path, as_version=4)
+        nb.cells.remove(find_cell(nb, 'test-2'))
+        self.rewrite(nb)
+        changed = nbgrader.get_release_info(self.path)
+        self.assertIsNot(changed, info)
+        self.assertEqual(list(changed.missing_html), ['test-1', 'answer', 'explain'])
+        self.assertEqual(changed.code_points, {'test-1': 2, 'answer': 3})
+
+    def test_workspaces_share_the_release(self):
+        info = nbgrader.get_release_info(self.path)
+        ws = self.root / 'ws'
+        ws.mkdir()
+        (self.root / 'release').symlink(ws / 'release')
+        self.assertIs(nbgrader.get_release_info(ws / 'release' / 'lab1' / 'lab1.ipynb'), info)
+
+    def test_feedback_follows_release(self):
+        empty = new_notebook()
+        feedback = nbgrader.get_feedback('lab1', empty, root=self.root)
+        self.assertEqual(feedback.count('(MISSING!)'), 4)
+
+        nb = nbformat.read(self.path, as_version=4)
+        nb.cells.remove(find_cell(nb, 'test-2'))
+        self.rewrite(nb)
+        feedback = nbgrader.get_feedback('lab1', empty, root=self.root)
+        self.assertEqual(feedback.count('(MISSING!)'), 3)
+        self.assertNotIn('Test 2 (MISSING!)', feedback)
+
+    def test_color_converter_per_thread(self):
+        converter = nbgrader.color_converter()
+        self.assertIs(nbgrader.color_converter(), converter)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(nbgrader.color_converter()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], converter)
+        self.assertIn('color', converter.convert('\x1b[0;31mError\x1b[0m', full=False))
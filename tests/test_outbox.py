@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+
+from jupyter_grade_server import outbox
+
+
+class OutboxTests(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, 'outbox.db')
+
+    def test_add_remove(self):
+        box = outbox.Outbox(self.path)
+        entry = box.add('test', {'xqueue_header': '1'})
+        self.assertEqual(box.size()[0], 1)
+        box.remove(entry)
+        self.assertEqual(box.size(), (0, 0))
+
+    def test_stale_replies_are_taken_once(self):
+        box = outbox.Outbox(self.path)
+        box.add('test', {'xqueue_header': '1'})
+        box.add('other', {'xqueue_header': '2'})
+        # Replies of this run are not stale
+        self.assertEqual(box.take_stale('test'), [])
+
+        restarted = outbox.Outbox(self.path)
+        restarted.add('test', {'xqueue_header': '3'})
+        (entry, reply), = restarted.take_stale('test')
+        self.assertEqual(reply, {'xqueue_header': '1'})
+        self.assertEqual(restarted.take_stale('test'), [])
+        restarted.remove(entry)
+        self.assertEqual(restarted.size()[0], 2)
+
+    def test_size_cap(self):
+        box = outbox.Outbox(self.path, max_bytes=100)
+        self.assertIsNotNone(box.add('test', {'body': 'x' * 50}))
+        self.assertIsNone(box.add('test', {'body': 'x' * 50}))
+        self.assertEqual(box.size()[0], 1)
@@ -0,0 +1,264 @@
+import concurrent.futures
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+from jupyter_grade_server import client, outbox
+from tests.fixtures.fake_xqueue import FakeXQueue, submission
+
+
+class PipelineTests(unittest.TestCase):
+    def make_client(self, server, **kwargs):
+        c = client.XQueueClientThread('test', xqueue_server=server.url,
+                                      xqueue_auth=('lms', 'lms'),
+                                      poll_interval=0.05, **kwargs)
+        self.addCleanup(c.shutdown)
+        return c
+
+    def test_workers_grade_concurrently(self):
+        server = FakeXQueue([submission(i) for i in range(4)], expected=4)
+        self.addCleanup(server.close)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def handler(content):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.2)
+            with lock:
+                running.pop()
+            return {'correct': True, 'score': 1, 'msg': 'ok'}
+
+        c = self.make_client(server, workers=2, prefetch=2)
+        c.add_handler(handler)
+        c.start()
+        self.assertTrue(server.done.wait(5))
+        c.shutdown()
+        c.join(5)
+        self.assertFalse(c.is_alive())
+        self.assertEqual(max(peak), 2)
+        ids = sorted(json.loads(r['xqueue_header'][0])['id'] for r in server.results)
+        self.assertEqual(ids, [0, 1, 2, 3])
+
+    def test_buffer_limit_follows_pull_timeout(self):
+        c = client.XQueueClient('test', workers=2, prefetch=10, pull_timeout=60)
+        self.assertEqual(c._buffer_limit(), 10)
+        c.grade_time = 15
+        self.assertEqual(c._buffer_limit(), 4)
+        c.grade_time = 40
+        self.assertEqual(c._buffer_limit(), 0)
+
+    def test_background_posting(self):
+        server = FakeXQueue([submission(i) for i in range(3)], expected=3)
+        self.addCleanup(server.close)
+        c = self.make_client(server, post_threads=2)
+        c.add_handler(lambda content: {'correct': True, 'score': 1, 'msg': 'ok'})
+        c.start()
+        self.assertTrue(server.done.wait(5))
+        c.shutdown()
+        c.join(5)
+        self.assertFalse(c.is_alive())
+        self.assertEqual(c.poster.posted, 3)
+
+    def test_outbox(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, 'outbox.db')
+        # A reply journaled by an earlier run that never reached XQueue
+        outbox.Outbox(path).add('test', {'xqueue_header': 'old', 'xqueue_body': '{}'})
+
+        box = outbox.Outbox(path)
+        server = FakeXQueue([submission(1)], expected=2)
+        self.addCleanup(server.close)
+        c = self.make_client(server, outbox=box)
+        c.add_handler(lambda content: {'correct': True, 'score': 1, 'msg': 'ok'})
+        c.start()
+        self.assertTrue(server.done.wait(5))
+        c.shutdown()
+        c.join(5)
+        self.assertEqual(server.results[0]['xqueue_header'], ['old'])
+        self.assertEqual(box.size(), (0, 0))
+
+
+class PollDelayTests(unittest.TestCase):
+    def test_backoff(self):
+        c = client.XQueueClient('test', poll_interval=1, max_poll_interval=8)
+        delays = [c._poll_delay(False) for _ in range(6)]
+        for delay, interval in zip(delays, [1, 2, 4, 8, 8, 8]):
+            self.assertGreaterEqual(delay, interval / 2)
+            self.assertLessEqual(delay, interval)
+        self.assertEqual(c._poll_delay(True), 0)
+        self.assertLessEqual(c._poll_delay(False), 1)
+
+    def test_failed_post_is_not_an_empty_queue(self):
+        server = FakeXQueue([submission(1)])
+        self.addCleanup(server.close)
+        server.fail_posts = 1
+        c = client.XQueueClient('test', xqueue_server=server.url, xqueue_auth=('lms', 'lms'))
+        self.addCleanup(c.shutdown)
+        c.add_handler(lambda content: {'correct': True, 'score': 1, 'msg': 'ok'})
+        self.assertFalse(c.process_one())
+        self.assertTrue(c._got_work)
+        c.process_one()
+        self.assertFalse(c._got_work)
+
+
+class SharedSessionTests(unittest.TestCase):
+    def test_clients_log_in_once(self):
+        server = FakeXQueue()
+        self.addCleanup(server.close)
+        session = client.SharedSession()
+        clients = [client.XQueueClient('test', xqueue_server=server.url,
+                                       xqueue_auth=('lms', 'lms'), session=session)
+                   for _ in range(3)]
+        self.assertEqual(session.refs, 3)
+        self.assertIs(clients[0].session, clients[2].session)
+        logins = []
+        original = client.XQueueClient._post_login
+
+        def post_login(c):
+            logins.append(c)
+            return original(c)
+
+        with unittest.mock.patch.object(client.XQueueClient, '_post_login', post_login):
+            generation = session.generation
+            threads = [threading.Thread(target=c._login, args=(generation,)) for c in clients]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(logins), 1)
+        self.assertEqual(session.generation, generation + 1)
+
+        for c in clients:
+            c.shutdown()
+        self.assertEqual(session.refs, 0)
+
+
+class ConcurrentHandlerTests(unittest.TestCase):
+    def test_handlers_run_concurrently_with_timeouts(self):
+        server = FakeXQueue(expected=2)
+        self.addCleanup(server.close)
+        c = client.XQueueClient('test', xqueue_server=server.url, xqueue_auth=(None, None),
+                                concurrent_handlers=True)
+        self.addCleanup(c.shutdown)
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def slow(content):
+            time.sleep(0.3)
+            return {'correct': True, 'score': 1, 'msg': 'slow'}
+
+        def fast(content):
+            return {'correct': True, 'score': 1, 'msg': 'fast'}
+
+        def stuck(content):
+            release.wait(5)
+            return {'correct': True, 'score': 1, 'msg': 'stuck'}
+
+        c.add_handler(slow)
+        c.add_handler(fast)
+        c.add_handler(stuck, timeout=0.5)
+        c._start_handler_executor()
+        self.addCleanup(c._handler_executor.shutdown, wait=False)
+        start = time.monotonic()
+        self.assertFalse(c._handle_submission(json.dumps(submission(1))))
+        self.assertLess(time.monotonic() - start, 0.9)
+        msgs = [json.loads(r['xqueue_body'][0])['msg'] for r in server.results]
+        self.assertEqual(msgs, ['fast', 'slow'])
+
+    def test_timeouts_start_when_the_handler_runs(self):
+        server = FakeXQueue(expected=2)
+        self.addCleanup(server.close)
+        c = client.XQueueClient('test', xqueue_server=server.url, xqueue_auth=(None, None),
+                                concurrent_handlers=True, poll_interval=0.05)
+        self.addCleanup(c.shutdown)
+
+        def slow(content):
+            time.sleep(0.3)
+            return {'correct': True, 'score': 1, 'msg': 'slow'}
+
+        def queued(content):
+            time.sleep(0.1)
+            return {'correct': True, 'score': 1, 'msg': 'queued'}
+
+        c.add_handler(slow)
+        c.add_handler(queued, timeout=0.25)
+        # As if a timed out handler still held the other thread
+        c._handler_executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.addCleanup(c._handler_executor.shutdown)
+        self.assertTrue(c._handle_submission(json.dumps(submission(1))))
+        msgs = [json.loads(r['xqueue_body'][0])['msg'] for r in server.results]
+        self.assertEqual(msgs, ['slow', 'queued'])
+
+    def test_run_shuts_down_the_handler_executor(self):
+        server = FakeXQueue([submission(1)])
+        self.addCleanup(server.close)
+        c = client.XQueueClientThread('test', xqueue_server=server.url, xqueue_auth=('lms', 'lms'),
+                                      concurrent_handlers=True, poll_interval=0.05)
+        c.add_handler(lambda content: {'correct': True, 'score': 1, 'msg': 'a'})
+        c.add_handler(lambda content: None)
+        c.start()
+        self.assertTrue(server.done.wait(5))
+        executor = c._handler_executor
+        c.shutdown()
+        c.join(5)
+        self.assertFalse(c.is_alive())
+        with self.assertRaises(RuntimeError):
+            executor.submit(print)
+
+
+class DrainTests(unittest.TestCase):
+    def test_in_flight_work_finishes_after_shutdown(self):
+        server = FakeXQueue([submission(i) for i in range(3)], expected=3)
+        self.addCleanup(server.close)
+        started = threading.Semaphore(0)
+
+        def handler(content):
+            started.release()
+            time.sleep(0.3)
+            return {'correct': True, 'score': 1, 'msg': 'ok'}
+
+        c = client.XQueueClientThread('test', xqueue_server=server.url,
+                                      xqueue_auth=('lms', 'lms'), poll_interval=0.01,
+                                      workers=2, prefetch=1, post_threads=1)
+        c.add_handler(handler)
+        c.start()
+        for _ in range(2):
+            self.assertTrue(started.acquire(timeout=5))
+        self.assertGreaterEqual(c.in_flight(), 2)
+        c.shutdown()
+        c.join(5)
+        self.assertFalse(c.is_alive())
+        self.assertEqual(c.in_flight(), 0)
+        # Everything pulled before the shutdown was graded and posted
+        self.assertEqual(len(server.results), 3 - len(server.submissions))
+
+    def test_process_client_reports_in_flight(self):
+        server = FakeXQueue([submission(1)])
+        self.addCleanup(server.close)
+
+        def handler(content):
+            time.sleep(0.5)
+            return {'correct': True, 'score': 1, 'msg': 'ok'}
+
+        c = client.XQueueClientProcess('test', xqueue_server=server.url,
+                                       xqueue_auth=('lms', 'lms'), poll_interval=0.01)
+        c.add_handler(handler)
+        c.start()
+        self.addCleanup(c.join, 5)
+        self.addCleanup(c.shutdown)
+        deadline = time.monotonic() + 5
+        while c.in_flight() == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(c.in_flight(), 1)
+        while c.in_flight() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(c.in_flight(), 0)
+        self.assertEqual(len(server.results), 1)
@@ -0,0 +1,85 @@
+import threading
+import time
+import unittest
+
+from jupyter_grade_server import poster
+
+
+class ResultPosterTests(unittest.TestCase):
+    def make_poster(self, post, **kwargs):
+        p = poster.ResultPoster(post, **kwargs)
+        self.addCleanup(p.close)
+        return p
+
+    def test_post(self):
+        posted = []
+        done = threading.Event()
+
+        def post(reply):
+            posted.append(reply)
+            done.set()
+            return True, ''
+
+        p = self.make_poster(post)
+        p.submit({'id': 1})
+        self.assertTrue(done.wait(5))
+        self.assertEqual(p.close(), 0)
+        self.assertEqual(posted, [{'id': 1}])
+        self.assertEqual(p.posted, 1)
+
+    def test_retry_with_backoff(self):
+        attempts = []
+        done = threading.Event()
+
+        def post(reply):
+            attempts.append(time.monotonic())
+            if len(attempts) < 3:
+                return False, 'XQueue is down'
+            done.set()
+            return True, ''
+
+        p = self.make_poster(post, backoff=0.05)
+        p.submit({'id': 1})
+        self.assertTrue(done.wait(5))
+        self.assertEqual(len(attempts), 3)
+        self.assertGreaterEqual(attempts[2] - attempts[1], attempts[1] - attempts[0])
+
+    def test_give_up(self):
+        p = self.make_poster(lambda reply: (False, 'rejected'), retries=2, backoff=0.01)
+        p.submit({'id': 1})
+        deadline = time.monotonic() + 5
+        while p.dropped == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(p.dropped, 1)
+        self.assertEqual(p.backlog, 0)
+
+    def test_backlog(self):
+        release = threading.Event()
+
+        def post(reply):
+            release.wait(5)
+            return True, ''
+
+        p = self.make_poster(post, threads=1)
+        for i in range(3):
+            p.submit({'id': i})
+        self.assertEqual(p.backlog, 3)
+        release.set()
+        self.assertEqual(p.close(), 0)
+        self.assertEqual(p.posted, 3)
+
+    def test_on_backlog(self):
+        backlogs = []
+        release = threading.Event()
+
+        def post(reply):
+            release.wait(5)
+            return True, ''
+
+        p = self.make_poster(post, threads=1, on_backlog=backlogs.append)
+        p.submit({'id': 1})
+        p.submit({'id': 2})
+        release.set()
+        self.assertEqual(p.close(), 0)
+        self.assertEqual(max(backlogs), 2)
+        self.assertEqual(backlogs[-1], 0)
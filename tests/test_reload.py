@@ -0,0 +1,142 @@
+import json
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+from path import Path
+
+from tests.fixtures.fake_xqueue import FakeXQueue, submission
+
+try:
+    from jupyter_grade_server import manager
+except ImportError:
+    # The manager needs codejail
+    manager = None
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.02)
+
+
+@unittest.skipIf(manager is None, 'requires codejail')
+class ReloadTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeXQueue()
+        self.addCleanup(self.server.close)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+        (self.root / 'conf.d').mkdir()
+        (self.root / 'xqwatcher.json').write_text(json.dumps({
+            'POLL_INTERVAL': 0.05, 'MAX_POLL_INTERVAL': 0.05, 'DRAIN_TIMEOUT': 5}))
+
+    def write_queues(self, **queues):
+        (self.root / 'conf.d' / 'queues.json').write_text(json.dumps(queues))
+
+    def queue(self, **config):
+        return {'SERVER': self.server.url, 'AUTH': ['lms', 'lms'],
+                'HANDLERS': [{'HANDLER': 'tests.fixtures.pool_handler.PoolHandler'}], **config}
+
+    def make_manager(self):
+        m = manager.Manager()
+        m.configure_from_directory(self.root)
+        m.start()
+        self.addCleanup(m.drain, 5)
+        return m
+
+    def test_removed_queue_stops_its_worker_pools(self):
+        self.write_queues(q=self.queue(CONNECTIONS=2))
+        m = self.make_manager()
+        processes = [p for c in m.queue_clients['q'] for p in c.handlers[0].processes]
+        self.assertEqual(len(processes), 2)
+        self.write_queues()
+        m.reload()
+        self.assertEqual(m.clients, [])
+        wait_for(lambda: not any(p.is_alive() for p in processes))
+
+    def test_changed_queue_stops_the_old_worker_pools(self):
+        self.write_queues(q=self.queue())
+        m = self.make_manager()
+        old = m.queue_clients['q'][0]
+        self.write_queues(q=self.queue(WORKERS=2))
+        m.reload()
+        new = m.queue_clients['q'][0]
+        self.assertIsNot(new, old)
+        wait_for(lambda: not old.handlers[0].processes[0].is_alive())
+        self.assertTrue(new.handlers[0].processes[0].is_alive())
+
+    def test_queue_that_fails_to_load_keeps_running(self):
+        self.write_queues(q=self.queue(CONNECTIONS=2))
+        m = self.make_manager()
+        old = list(m.clients)
+        config = m.queue_configs['q']
+        self.write_queues(q=self.queue(HANDLERS=[{'HANDLER': 'tests.fixtures.pool_handler.no_such'}]),
+                          new=self.queue())
+        with self.assertLogs('xqueue_watcher.manager', 'ERROR'):
+            m.reload()
+        self.assertEqual(m.queue_clients['q'], old)
+        self.assertEqual(m.queue_configs['q'], config)
+        self.assertEqual(m.retired, [])
+        self.assertTrue(all(c.is_alive() and c.running for c in old))
+        # Other queues are still reconfigured
+        new, = m.queue_clients['new']
+        self.assertEqual(m.clients, old + [new])
+
+    def test_failed_replacement_stops_the_clients_it_made(self):
+        self.write_queues(q=self.queue())
+        m = self.make_manager()
+        made = []
+        client_from_config = m.client_from_config
+
+        def fail_second(queue_name, config):
+            if made:
+                raise ImportError('no_such')
+            made.append(client_from_config(queue_name, config))
+            return made[0]
+
+        m.client_from_config = fail_second
+        self.write_queues(q=self.queue(CONNECTIONS=2, WORKERS=2))
+        with self.assertLogs('xqueue_watcher.manager', 'ERROR'):
+            m.reload()
+        self.assertNotIn(made[0], m.clients)
+        self.assertFalse(made[0].running)
+        self.assertFalse(made[0].handlers[0].processes[0].is_alive())
+
+    def test_retired_client_that_already_stopped_closes_its_handlers(self):
+        self.write_queues(q=self.queue())
+        m = self.make_manager()
+        dead, = m.clients
+        with unittest.mock.patch('threading.excepthook'):
+            dead.process_one = unittest.mock.Mock(side_effect=RuntimeError('crash'))
+            dead.join(5)
+        self.assertFalse(dead.is_alive())
+        m._retire(m._resize('q', 0))
+        wait_for(lambda: not m.retired)
+        self.assertFalse(dead.handlers[0].processes[0].is_alive())
+
+    def retire_busy_client(self):
+        self.server.submissions.append(submission(1))
+        self.write_queues(q=self.queue(HANDLERS=[{'HANDLER': 'tests.fixtures.pool_handler.slow_grade'}]))
+        m = self.make_manager()
+        busy, = m.clients
+        wait_for(lambda: busy.in_flight())
+        self.write_queues()
+        m.reload()
+        self.assertEqual(m.retired, [busy])
+        return m, busy
+
+    def test_drain_waits_for_retired_clients(self):
+        m, busy = self.retire_busy_client()
+        self.assertEqual(m.drain(), (1, 0))
+        self.assertFalse(busy.is_alive())
+        self.assertEqual(len(self.server.results), 1)
+        wait_for(lambda: not m.retired)
+
+    def test_drain_counts_retired_jobs_as_abandoned(self):
+        m, busy = self.retire_busy_client()
+        self.assertEqual(m.drain(timeout=0.1), (0, 1))
@@ -0,0 +1,89 @@
+import concurrent.futures
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from jupyter_grade_server import resultcache
+
+
+class ResultCacheTests(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+        self.path = os.path.join(self.tmpdir, 'results.db')
+
+    def test_get_put(self):
+        cache = resultcache.ResultCache(self.path)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', {'points': 3})
+        self.assertEqual(cache.get('a'), {'points': 3})
+        # Results survive reopening the cache
+        self.assertEqual(resultcache.ResultCache(self.path).get('a'), {'points': 3})
+
+    def test_lru_eviction(self):
+        cache = resultcache.ResultCache(self.path, max_entries=2)
+        cache.put('a', 1)
+        time.sleep(0.01)
+        cache.put('b', 2)
+        time.sleep(0.01)
+        cache.get('a')
+        time.sleep(0.01)
+        cache.put('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+
+    def test_ttl(self):
+        cache = resultcache.ResultCache(self.path, ttl=0.05)
+        cache.put('a', 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_cache_key(self):
+        key = resultcache.cache_key('lab1', b'{}', 'release')
+        self.assertEqual(key, resultcache.cache_key('lab1', b'{}', 'release'))
+        self.assertNotEqual(key, resultcache.cache_key('lab2', b'{}', 'release'))
+        self.assertNotEqual(key, resultcache.cache_key('lab1', b'{} ', 'release'))
+        self.assertNotEqual(key, resultcache.cache_key('lab1', b'{}', 'changed'))
+
+    def test_fingerprint_follows_content(self):
+        path = os.path.join(self.tmpdir, 'release.ipynb')
+        with open(path, 'w') as f:
+            f.write('one')
+        first = resultcache.fingerprint(path)
+        with open(path, 'w') as f:
+            f.write('two!')
+        self.assertNotEqual(resultcache.fingerprint(path), first)
+
+
+class CoalescerTests(unittest.TestCase):
+    def test_concurrent_calls_share_a_result(self):
+        coalescer = resultcache.Coalescer()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'graded'
+
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            first = executor.submit(coalescer.run, 'key', work)
+            started.wait(5)
+            second = executor.submit(coalescer.run, 'key', work)
+            time.sleep(0.05)
+            release.set()
+            self.assertEqual(first.result(), ('graded', False))
+            self.assertEqual(second.result(), ('graded', True))
+        self.assertEqual(len(calls), 1)
+        # Finished calls are not reused
+        self.assertEqual(coalescer.run('key', lambda: 'again'), ('again', False))
+
+    def test_exception_propagates(self):
+        coalescer = resultcache.Coalescer()
+        self.assertRaises(ValueError, coalescer.run, 'key', int, 'x')
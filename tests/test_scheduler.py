@@ -0,0 +1,183 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from jupyter_grade_server import client
+from jupyter_grade_server.scheduler import FairScheduler
+from tests.fixtures.fake_xqueue import FakeXQueue, submission
+
+
+class FairSchedulerTests(unittest.TestCase):
+    def fill(self, scheduler, queue_name, count, granted):
+        for i in range(count):
+            scheduler.request(queue_name, lambda: granted.append(queue_name))
+
+    def test_busy_queue_borrows_idle_slots(self):
+        scheduler = FairScheduler(4)
+        scheduler.configure('big', weight=3)
+        scheduler.configure('small', weight=1, min_slots=1)
+        granted = []
+        self.fill(scheduler, 'big', 6, granted)
+        self.assertEqual(granted, ['big'] * 4)
+        self.assertEqual(scheduler.waiting_jobs('big'), 2)
+
+    def test_minimum_slots_come_first(self):
+        scheduler = FairScheduler(4)
+        scheduler.configure('big', weight=10)
+        scheduler.configure('small', weight=1, min_slots=1)
+        granted = []
+        self.fill(scheduler, 'big', 6, granted)
+        self.fill(scheduler, 'small', 2, granted)
+        del granted[:]
+        scheduler.release('big')
+        self.assertEqual(granted, ['small'])
+        scheduler.release('big')
+        self.assertEqual(granted, ['small', 'big'])
+
+    def test_slots_follow_weights(self):
+        scheduler = FairScheduler(4)
+        scheduler.configure('big', weight=3)
+        scheduler.configure('small', weight=1)
+        granted = []
+        self.fill(scheduler, 'big', 10, granted)
+        self.fill(scheduler, 'small', 10, granted)
+        for i in range(4):
+            scheduler.release(granted[i])
+        self.assertEqual(scheduler.running['big'], 3)
+        self.assertEqual(scheduler.running['small'], 1)
+
+    def test_slot_limits_concurrency(self):
+        scheduler = FairScheduler(2)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def job():
+            with scheduler.slot('q'):
+                with lock:
+                    running.append(1)
+                    peak.append(len(running))
+                time.sleep(0.05)
+                with lock:
+                    running.pop()
+
+        threads = [threading.Thread(target=job) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(scheduler.running['q'], 0)
+
+    def test_aio_slot(self):
+        scheduler = FairScheduler(1)
+
+        async def main():
+            async with scheduler.aio_slot('q'):
+                waiter = asyncio.ensure_future(self.hold(scheduler))
+                await asyncio.sleep(0.05)
+                self.assertFalse(waiter.done())
+                cancelled = asyncio.ensure_future(self.hold(scheduler))
+                await asyncio.sleep(0)
+                cancelled.cancel()
+            await asyncio.wait_for(waiter, 1)
+
+        asyncio.run(main())
+        self.assertEqual(scheduler.running['q'], 0)
+        self.assertEqual(scheduler.waiting_jobs('q'), 0)
+
+    async def hold(self, scheduler):
+        async with scheduler.aio_slot('q'):
+            await asyncio.sleep(0)
+
+    def test_clients_share_slots(self):
+        server = FakeXQueue([submission(i) for i in range(4)], expected=4)
+        self.addCleanup(server.close)
+        scheduler = FairScheduler(1)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def handler(content):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+            return {'correct': True, 'score': 1, 'msg': 'ok'}
+
+        clients = []
+        for queue_name in ('a', 'b'):
+            c = client.XQueueClientThread(queue_name, xqueue_server=server.url,
+                                          xqueue_auth=('lms', 'lms'), poll_interval=0.05,
+                                          workers=2, scheduler=scheduler)
+            c.add_handler(handler)
+            self.addCleanup(c.shutdown)
+            clients.append(c)
+            c.start()
+        self.assertTrue(server.done.wait(5))
+        self.assertEqual(max(peak), 1)
+
+    def test_acquire_gives_up_when_stopped(self):
+        scheduler = FairScheduler(1)
+        scheduler.acquire('q')
+        running = [True]
+        waiter = threading.Thread(target=lambda: running.append(
+            scheduler.acquire('q', lambda: running[0], poll=0.01)))
+        waiter.start()
+        time.sleep(0.05)
+        running[0] = False
+        waiter.join(5)
+        self.assertEqual(running[1:], [False])
+        self.assertEqual(scheduler.waiting_jobs('q'), 0)
+        self.assertEqual(scheduler.running['q'], 1)
+
+    def test_aio_acquire_gives_up_when_stopped(self):
+        scheduler = FairScheduler(1)
+        scheduler.acquire('q')
+
+        async def main():
+            stopped = asyncio.Event()
+            waiter = asyncio.ensure_future(scheduler.aio_acquire('q', stopped))
+            await asyncio.sleep(0.05)
+            self.assertFalse(waiter.done())
+            stopped.set()
+            return await asyncio.wait_for(waiter, 1)
+
+        self.assertFalse(asyncio.run(main()))
+        self.assertEqual(scheduler.waiting_jobs('q'), 0)
+        self.assertEqual(scheduler.running['q'], 1)
+
+    def check_pulls_only_with_a_slot(self, klass, **kwargs):
+        server = FakeXQueue([submission(1)])
+        self.addCleanup(server.close)
+        scheduler = FairScheduler(1)
+        # Held by another queue
+        scheduler.acquire('other')
+        c = klass('q', xqueue_server=server.url, xqueue_auth=('lms', 'lms'),
+                  poll_interval=0.05, scheduler=scheduler, **kwargs)
+        c.add_handler(lambda content: {'correct': True, 'score': 1, 'msg': 'ok'})
+        self.addCleanup(c.shutdown)
+        c.start()
+        time.sleep(0.3)
+        # Still in XQueue rather than waiting for a slot after being pulled
+        self.assertEqual(len(server.submissions), 1)
+        self.assertEqual(c.in_flight(), 0)
+        scheduler.release('other')
+        self.assertTrue(server.done.wait(5))
+        c.shutdown()
+        c.join(5)
+        self.assertFalse(c.is_alive())
+        self.assertEqual(scheduler.running['q'], 0)
+
+    def test_thread_client_pulls_only_with_a_slot(self):
+        self.check_pulls_only_with_a_slot(client.XQueueClientThread)
+
+    def test_pipelined_client_pulls_only_with_a_slot(self):
+        self.check_pulls_only_with_a_slot(client.XQueueClientThread, workers=2, prefetch=1)
+
+    @unittest.skipIf(client.aiohttp is None, 'aiohttp is not installed')
+    def test_async_client_pulls_only_with_a_slot(self):
+        self.check_pulls_only_with_a_slot(client.XQueueClientAsync)
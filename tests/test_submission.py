@@ -0,0 +1,57 @@
+import json
+import unittest
+
+from jupyter_grade_server import submission
+from jupyter_grade_server.submission import Submission
+
+
+CONTENT = json.dumps({
+    'xqueue_header': json.dumps({'submission_id': 1, 'submission_key': 'k'}),
+    'xqueue_body': json.dumps({'grader_payload': json.dumps({'name': 'lab1'}),
+                               'student_response': ''}),
+    'xqueue_files': json.dumps({'lab1.ipynb': 'https://example.com/lab1.ipynb'}),
+})
+
+
+class SubmissionTests(unittest.TestCase):
+    def test_dict_api(self):
+        s = Submission.parse(CONTENT)
+        self.assertIsInstance(s, dict)
+        self.assertEqual(json.loads(s['xqueue_body'])['student_response'], '')
+        self.assertIs(Submission.parse(s), s)
+
+    def test_decoded_once(self):
+        s = Submission.parse(CONTENT)
+        self.assertEqual(s.grader_payload, {'name': 'lab1'})
+        self.assertIs(s.body, s.body)
+        self.assertEqual(s.files, {'lab1.ipynb': 'https://example.com/lab1.ipynb'})
+
+    def test_reply(self):
+        s = Submission.parse(CONTENT)
+        reply = s.reply({'correct': True, 'score': 1, 'msg': 'ok'})
+        self.assertEqual(reply['xqueue_header'], s['xqueue_header'])
+        self.assertEqual(json.loads(reply['xqueue_body']), {'correct': True, 'score': 1, 'msg': 'ok'})
+
+    def test_plain_dict(self):
+        s = Submission.parse(json.loads(CONTENT))
+        self.assertEqual(s.grader_payload, {'name': 'lab1'})
+
+    def test_backend(self):
+        self.assertEqual(submission.loads(submission.dumps({'a': [1, 2]})), {'a': [1, 2]})
+
+    def test_reply_accepts_what_json_accepts(self):
+        s = Submission.parse(CONTENT)
+        for result in ({'score': 1, 1: 'int key', None: 'null key'}, {'big': 2**70}):
+            reply = s.reply(result)
+            self.assertEqual(json.loads(reply['xqueue_body']), json.loads(json.dumps(result)))
+
+    def test_reply_with_numpy_scalars(self):
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is None or submission.orjson is None:
+            self.skipTest('requires numpy and orjson')
+        s = Submission.parse(CONTENT)
+        reply = s.reply({'score': numpy.float64(0.5), 'points': numpy.int64(3)})
+        self.assertEqual(json.loads(reply['xqueue_body']), {'score': 0.5, 'points': 3})
@@ -0,0 +1,156 @@
+import os
+import signal
+import time
+import unittest
+from unittest import mock
+
+from tests.fixtures.fake_xqueue import FakeXQueue
+from tests.test_reload import manager, wait_for
+
+
+@unittest.skipIf(manager is None, 'requires codejail')
+class SupervisionTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeXQueue()
+        self.addCleanup(self.server.close)
+
+    def make_manager(self, handler='tests.fixtures.pool_handler.grade', **config):
+        m = manager.Manager()
+        m.manager_config.update(POLL_INTERVAL=0.05, MAX_POLL_INTERVAL=0.05,
+                                RESTART_BACKOFF=0.2, RESTART_MAX_BACKOFF=10)
+        m.configure({'q': {
+            'SERVER': self.server.url,
+            'AUTH': ['lms', 'lms'],
+            'HANDLERS': [{'HANDLER': handler}],
+            **config,
+        }})
+        m.start()
+        self.addCleanup(m.drain, 5)
+        return m
+
+    def assert_restarted(self, m, victim):
+        wait_for(lambda: m._exited)
+        before = time.monotonic()
+        m.supervise()
+        after = time.monotonic()
+        self.assertNotIn(victim, m.clients)
+        (when, queue_name), = m._pending_restarts
+        self.assertEqual(queue_name, 'q')
+        self.assertTrue(before + 0.2 <= when <= after + 0.2)
+        self.assertEqual(m.restarts['q'], 0)
+
+        wait_for(lambda: time.monotonic() >= when)
+        m.supervise()
+        m.supervise()
+        replacement, = m.queue_clients['q']
+        self.assertIsNot(replacement, victim)
+        self.assertEqual(m.clients, [replacement])
+        self.assertTrue(replacement.is_alive())
+        self.assertEqual(m.restarts['q'], 1)
+        self.assertEqual(m._pending_restarts, [])
+        return replacement
+
+    def test_thread_client(self):
+        m = self.make_manager(handler='tests.fixtures.pool_handler.PoolHandler')
+        victim, = m.clients
+        with mock.patch('threading.excepthook') as excepthook:
+            victim.process_one = mock.Mock(side_effect=RuntimeError('crash'))
+            self.assert_restarted(m, victim)
+        excepthook.assert_called_once()
+        # The worker pool of the dead client's handler was stopped
+        self.assertFalse(victim.handlers[0].processes[0].is_alive())
+
+    def test_process_client(self):
+        m = self.make_manager(CLASS='XQueueClientProcess')
+        victim, = m.clients
+        os.kill(victim.pid, signal.SIGKILL)
+        self.assert_restarted(m, victim)
+        self.assertEqual(victim.exitcode, -signal.SIGKILL)
+
+    def test_async_client(self):
+        m = self.make_manager(CLASS='XQueueClientAsync')
+        victim, = m.clients
+        victim._future.cancel()
+        self.assert_restarted(m, victim)
+
+    def test_shut_down_clients_are_not_restarted(self):
+        m = self.make_manager(CONNECTIONS=2)
+        retired = m._resize('q', 1)
+        m._retire(retired)
+        wait_for(lambda: m._exited)
+        m.supervise()
+        self.assertEqual(m._pending_restarts, [])
+        self.assertEqual(len(m.clients), 1)
+
+    def test_failed_restart_is_retried_later(self):
+        m = self.make_manager()
+        m.supervise()
+        running, = m.clients
+        m.queue_clients['q'].remove(running)
+        m.clients.remove(running)
+        self.addCleanup(running.join, 5)
+        self.addCleanup(running.shutdown)
+        m.client_from_config = mock.Mock(side_effect=ImportError('no_such'))
+        m._pending_restarts.append((0, 'q'))
+        with self.assertLogs(level='ERROR'):
+            m.supervise()
+        (when, queue_name), = m._pending_restarts
+        self.assertEqual(queue_name, 'q')
+        self.assertGreater(when, time.monotonic())
+        self.assertEqual(m.restarts['q'], 0)
+
+    def test_restart_does_not_exceed_connections(self):
+        m = self.make_manager()
+        running, = m.clients
+        # Due after a reload has already replaced the dead client
+        m._pending_restarts.append((0, 'q'))
+        m.supervise()
+        self.assertEqual(m.clients, [running])
+        self.assertEqual(m.restarts['q'], 0)
+
+
+@unittest.skipIf(manager is None, 'requires codejail')
+class BackoffTests(unittest.TestCase):
+    def setUp(self):
+        self.m = manager.Manager()
+        self.m.manager_config.update(RESTART_BACKOFF=1, RESTART_MAX_BACKOFF=3)
+        self.m.queue_configs['q'] = {}
+
+    def die(self, ran=0):
+        """
+        Let a client of the queue die after running for `ran` seconds and
+        return the delay before it is restarted.
+        """
+        client = mock.Mock(queue_name='q', started_at=time.monotonic() - ran)
+        self.m.clients.append(client)
+        self.m.queue_clients.setdefault('q', []).append(client)
+        self.m._client_exited(client)
+        start = time.monotonic()
+        self.m.supervise()
+        client.shutdown.assert_called_once_with()
+        client.close_handlers.assert_called_once_with()
+        when, _ = self.m._pending_restarts[-1]
+        return when - start
+
+    def test_doubles_up_to_the_maximum(self):
+        for expected in (1, 2, 3, 3):
+            self.assertAlmostEqual(self.die(), expected, delta=0.1)
+        self.assertEqual(self.m.restarts['q'], 0)
+
+    def test_resets_after_running_long_enough(self):
+        self.die()
+        self.die()
+        self.assertAlmostEqual(self.die(ran=3), 1, delta=0.1)
+        self.assertAlmostEqual(self.die(), 2, delta=0.1)
+
+    def test_queues_back_off_separately(self):
+        self.die()
+        self.m.queue_configs['other'] = {}
+        client = mock.Mock(queue_name='other', started_at=time.monotonic())
+        self.m.clients.append(client)
+        self.m._client_exited(client)
+        start = time.monotonic()
+        self.m.supervise()
+        when, queue_name = self.m._pending_restarts[-1]
+        self.assertEqual(queue_name, 'other')
+        self.assertAlmostEqual(when - start, 1, delta=0.1)
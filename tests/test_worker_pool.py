@@ -0,0 +1,105 @@
+import concurrent.futures
+import os
+import tempfile
+import time
+import unittest
+
+from jupyter_grade_server import workerpool
+
+
+def square(x):
+    return x * x
+
+
+def getpid():
+    return os.getpid()
+
+
+def sleep_getpid(seconds):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def fail(msg):
+    raise ValueError(msg)
+
+
+def die():
+    os._exit(3)
+
+
+def marker(pid):
+    return os.path.join(tempfile.gettempdir(), f'worker-pool-test-{pid}')
+
+
+def write_marker():
+    with open(marker(os.getpid()), 'w') as f:
+        f.write('closed')
+
+
+class WorkerPoolTests(unittest.TestCase):
+    def make_pool(self, target, **kwargs):
+        pool = workerpool.WorkerPool(target, preload=(), **kwargs)
+        self.addCleanup(pool.shutdown)
+        return pool
+
+    def test_submit(self):
+        pool = self.make_pool(square, size=2)
+        self.assertEqual(pool.submit(3), 9)
+        self.assertEqual(pool.submit(x=4), 16)
+
+    def test_worker_is_reused(self):
+        pool = self.make_pool(getpid)
+        pid = pool.submit()
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(pool.submit(), pid)
+
+    def test_recycle_after_max_jobs(self):
+        pool = self.make_pool(getpid, max_jobs=2)
+        pids = [pool.submit() for _ in range(4)]
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+        self.assertEqual(pool.recycled, 2)
+
+    def test_recycle_after_max_rss(self):
+        pool = self.make_pool(getpid, max_rss_mb=0.001)
+        self.assertNotEqual(pool.submit(), pool.submit())
+
+    def test_exception(self):
+        pool = self.make_pool(fail)
+        self.assertRaises(ValueError, pool.submit, 'bad')
+
+    def test_dead_worker(self):
+        pool = self.make_pool(die)
+        self.assertRaises(workerpool.WorkerError, pool.submit)
+        pool.target = square
+        # Restart the pool with a working target
+        pool.shutdown()
+        self.assertEqual(pool.submit(2), 4)
+
+    def test_finalizer(self):
+        pool = self.make_pool(getpid, finalizer=write_marker)
+        pid = pool.submit()
+        pool.shutdown()
+        self.addCleanup(os.remove, marker(pid))
+        with open(marker(pid)) as f:
+            self.assertEqual(f.read(), 'closed')
+
+    def test_concurrent_jobs_share_a_worker(self):
+        pool = self.make_pool(sleep_getpid, threads=2)
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            start = time.monotonic()
+            pids = list(executor.map(lambda _: pool.submit(0.5), range(2)))
+            elapsed = time.monotonic() - start
+        self.assertEqual(pids[0], pids[1])
+        self.assertLess(elapsed, 0.9)
+
+    def test_busy(self):
+        pool = self.make_pool(sleep_getpid, size=2)
+        self.assertEqual(pool.busy(), 0)
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            future = executor.submit(pool.submit, 0.5)
+            time.sleep(0.3)
+            self.assertEqual(pool.busy(), 1)
+            future.result()
+        self.assertEqual(pool.busy(), 0)
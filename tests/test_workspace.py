@@ -0,0 +1,47 @@
+import tempfile
+import unittest
+from path import Path
+
+from jupyter_grade_server import workspace
+
+
+class WorkspacePoolTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.addCleanup(self.tmp.rmtree_p)
+        self.relocate = self.tmp / 'relocate'
+        for name in ('source', 'release'):
+            (self.relocate / name).makedirs_p()
+        (self.relocate / 'gradebook.db').write_text('db')
+        (self.relocate / 'nbgrader_config.py').write_text('')
+        self.root = self.tmp / 'workspaces'
+        self.root.mkdir()
+        self.pool = workspace.WorkspacePool(self.relocate, size=1, root=self.root)
+        self.addCleanup(self.pool.close)
+
+    def test_acquire_layout(self):
+        ws = self.pool.acquire('lab1')
+        self.assertTrue((ws / 'submitted' / 'student' / 'lab1').isdir())
+        self.assertEqual((ws / 'gradebook.db').read_text(), 'db')
+        for name in workspace.LINKED:
+            self.assertTrue((ws / name).islink())
+        self.assertEqual(ws.dirname(), self.root)
+
+    def test_release_scrubs_and_reuses(self):
+        first = self.pool.acquire('lab1')
+        self.pool._tasks.join()
+        # The pool was refilled, so a returned workspace is not needed
+        self.pool.release('lab1', first)
+        self.pool._tasks.join()
+        self.assertFalse(first.exists())
+
+        ws = self.pool.acquire('lab1')
+        (ws / 'autograded').mkdir()
+        (ws / 'gradebook.db').write_text('written')
+        self.pool.release('lab1', ws)
+        self.pool._tasks.join()
+        self.assertEqual(self.pool.acquire('lab1'), ws)
+        self.assertFalse((ws / 'autograded').exists())
+        self.assertEqual((ws / 'gradebook.db').read_text(), 'db')
+        self.assertTrue((ws / 'submitted' / 'student' / 'lab1').isdir())
+        self.assertTrue((self.relocate / 'source').isdir())